@@ -1,5 +1,6 @@
 import numpy as np
 import math
+import copy
 import functools
 
 import torch
@@ -73,15 +74,16 @@ def G_arch(ch=64, attention='64', ksize='333333', dilation='111111'):
 class Generator(nn.Module):
   #xiaodan: time_steps added by xiaodan
   def __init__(self, G_ch=64, dim_z=128, bottom_width=4, resolution=128,
-               G_kernel_size=3, G_attn='64', n_classes=1000, time_steps=12,
+               G_kernel_size=3, G_attn='64', G_attn_chunk=0, n_classes=1000, time_steps=12,
                num_G_SVs=1, num_G_SV_itrs=1,
                G_shared=True, shared_dim=0, hier=False,
                cross_replica=False, mybn=False,
                G_activation=nn.ReLU(inplace=False),
                G_lr=5e-5, G_B1=0.0, G_B2=0.999, adam_eps=1e-8,
                BN_eps=1e-5, SN_eps=1e-12, G_mixed_precision=False, G_fp16=False,
+               G_adam8bit=False,
                G_init='ortho', skip_init=False, no_optim=False,
-               G_param='SN', norm_style='bn',
+               G_param='SN', norm_style='bn', checkpoint='',
                **kwargs):
     super(Generator, self).__init__()
     # Channel width mulitplier
@@ -124,6 +126,10 @@ class Generator(nn.Module):
     self.SN_eps = SN_eps
     # fp16?
     self.fp16 = G_fp16
+    # Blocks and attention modules to recompute in backward
+    self.checkpoint_types = layers.checkpoint_types(
+      checkpoint, 'G', (layers.GBlock,),
+      (layers.FullAttention, layers.AxialAttention, layers.Attention))
     # Architecture dict
     self.arch = G_arch(self.ch, self.attention)[resolution]
     # xiaodan: added these flags
@@ -202,7 +208,8 @@ class Generator(nn.Module):
     if self.no_full_attn == False:
       print('Using full attention module...')
       self.fullAttn = layers.FullAttention(ch=self.arch['in_channels'][0],
-                                         time_steps=self.time_steps)
+                                         time_steps=self.time_steps,
+                                         chunk_size=G_attn_chunk)
                                          # which_conv = self.which_conv) #xiaodan: commented by xiaodan to use the default SNConv3d
     # self.blocks is a doubly-nested list of modules, the outer loop intended
     # to be over blocks at a given resolution (resblocks and/or self-attention)
@@ -222,9 +229,7 @@ class Generator(nn.Module):
         if self.no_sepa_attn == False:
           # xiaodan: add three seperable attention layers in G at certain resolution
           print('Adding separable attention layer in G at resolution %d' % self.arch['resolution'][index])
-          self.blocks[-1] += [layers.SelfAttention_width(self.arch['out_channels'][index], self.time_steps,self.which_conv)]
-          self.blocks[-1] += [layers.SelfAttention_height(self.arch['out_channels'][index], self.time_steps,self.which_conv)]
-          self.blocks[-1] += [layers.SelfAttention_time(self.arch['out_channels'][index], self.time_steps,self.which_conv)]
+          self.blocks[-1] += [layers.AxialAttention(self.arch['out_channels'][index], self.time_steps,self.which_conv)]
 
         else:
           print('Adding attention layer in G at resolution %d' % self.arch['resolution'][index])
@@ -233,6 +238,8 @@ class Generator(nn.Module):
 
     # Turn self.blocks into a ModuleList so that it's all properly registered.
     self.blocks = nn.ModuleList([nn.ModuleList(block) for block in self.blocks])
+    # Let checkpoints with the three separate attention modules load
+    self._register_load_state_dict_pre_hook(self._load_separable_attention)
 
     # output layer: batchnorm-relu-conv.
     # Consider using a non-spectral conv here
@@ -257,6 +264,12 @@ class Generator(nn.Module):
       self.optim = utils.Adam16(params=self.parameters(), lr=self.lr,
                            betas=(self.B1, self.B2), weight_decay=0,
                            eps=self.adam_eps)
+    elif G_adam8bit:
+      print('Using 8-bit adam in G...')
+      import utils
+      self.optim = utils.Adam8bit(params=self.parameters(), lr=self.lr,
+                                  betas=(self.B1, self.B2), weight_decay=0,
+                                  eps=self.adam_eps)
     else:
       self.optim = optim.Adam(params=self.parameters(), lr=self.lr,
                            betas=(self.B1, self.B2), weight_decay=0,
@@ -284,11 +297,48 @@ class Generator(nn.Module):
         self.param_count += sum([p.data.nelement() for p in module.parameters()])
     print('Param count for G''s initialized parameters: %d' % self.param_count)
 
+  # Gains and biases of every ccbn5D in the blocks, from one matmul per
+  # distinct entry of ys (one in total unless hier) instead of two small
+  # linears per layer. Returns, per block, a dict from each ccbn5D to its
+  # per-video (gain, bias), [B,C] views into the matmul's output.
+  def ccbn_conditioning(self, ys):
+    groups = {}
+    for index, blocklist in enumerate(self.blocks):
+      for module in blocklist.modules():
+        if isinstance(module, layers.ccbn5D):
+          groups.setdefault(id(ys[index]), (ys[index], []))[1].append((index, module))
+    conditioning = [{} for _ in self.blocks]
+    for y, members in groups.values():
+      out = layers.fused_projection(y, [linear for _, module in members
+                                        for linear in [module.gain, module.bias]])
+      for i, (index, module) in enumerate(members):
+        conditioning[index][module] = (1 + out[2 * i], out[2 * i + 1])
+    return conditioning
+
+  # Older checkpoints hold the width, height and time attention passes as
+  # blocks[i][1], [2] and [3]; move them under blocks[i][1].width/height/time.
+  def _load_separable_attention(self, state_dict, prefix, *args):
+    for index, blocklist in enumerate(self.blocks):
+      if (len(blocklist) < 2 or not isinstance(blocklist[1], layers.AxialAttention)
+          or '%sblocks.%d.1.gamma' % (prefix, index) not in state_dict):
+        continue
+      for position, axis in [(1, 'width'), (2, 'height'), (3, 'time')]:
+        old_prefix = '%sblocks.%d.%d.' % (prefix, index, position)
+        for key in [key for key in state_dict if key.startswith(old_prefix)]:
+          state_dict['%sblocks.%d.1.%s.%s' % (prefix, index, axis, key[len(old_prefix):])] = state_dict.pop(key)
+
   # Note on this forward function: we pass in a y vector which has
   # already been passed through G.shared to enable easy class-wise
   # interpolation later. If we passed in the one-hot and then ran it through
   # G.shared in this forward function, it would be harder to handle.
-  def forward(self, z, y):
+  # For videos longer than time_steps, pass the hidden state returned with
+  # return_hidden=True back in to generate the next time_steps frames;
+  # utils.stream_video does this chunk by chunk. A G without a ConvGRU has no
+  # state to carry, so it refuses both rather than make unconnected chunks.
+  def forward(self, z, y, hidden_state=None, return_hidden=False):
+    if self.no_convgru and (hidden_state is not None or return_hidden):
+      raise ValueError('G has no ConvGRU (no_convgru), so it has no hidden state '
+                       'to continue a video from')
     # print('z in G shape',z.shape)
     # y shape: [B,128], norm of each y is around 2.5 to 3
     # z shape: [B,128], norm of each z is around 10 to 11
@@ -308,10 +358,12 @@ class Generator(nn.Module):
         zy = torch.cat((z,y),1) # [B, 256]
       else:
         zy = z
-      layer_output_list, last_state_list = self.convgru(zy)
+      layer_output_list, last_state_list = self.convgru(zy, hidden_state,
+                                                        return_all_states=return_hidden)
       h = layer_output_list[-1] #[B,T,C,4,4]
       # h = h.contiguous().view(-1,*h.shape[2:]) #[BT,C,4,4]
     else:
+      last_state_list = None
       h = self.linear(z)
       # print('h size at 293',h.shape)
       h = h.contiguous().view(h.size(0), self.time_steps, -1, self.bottom_width, self.bottom_width) #[B, 1, C, 4, 4]
@@ -321,30 +373,155 @@ class Generator(nn.Module):
     # print('H shape after convgru',h.shape)
     #xiaodan: send h into full Attention
     if self.no_full_attn == False:
-      h = self.fullAttn(h)#[B,T,C,4,4]
+      h = layers.maybe_checkpoint(self.fullAttn, self.checkpoint_types, h)#[B,T,C,4,4]
     #Xiaodan: Moved out from the no_full_attn if statement by Xiaodan
-    h = h.contiguous().view(-1,*h.shape[2:]) #[BT,C,4,4]
+    h = h.reshape(-1,*h.shape[2:]) #[BT,C,4,4]
+    # Conditioning for each block: with shared embeddings, the gains and
+    # biases of every ccbn5D at once; otherwise the class indices, repeated
+    # once per frame for each distinct ys entry.
+    if self.G_shared:
+      ys_blocks = self.ccbn_conditioning(ys)
+    else:
+      ys_BT = {}
+      for item in ys:
+        if id(item) not in ys_BT:
+          ys_BT[id(item)] = item.repeat(self.time_steps,1).permute(1,0).contiguous().view(-1)
+      ys_blocks = [ys_BT[id(item)] for item in ys]
     # Loop over blocks
     for index, blocklist in enumerate(self.blocks):
       # Second inner loop in case block has multiple layers
       for block in blocklist:
-        # ys_BT = ys[index].repeat(self.time_steps,1,1).permute(1,0,2).contiguous().view(-1,y.shape[-1])
-        #xiaodan: added if else statement to account when G_shared==False
-        if len(y.shape)>1:
-            ys_BT = ys[index].repeat(self.time_steps,1,1).permute(1,0,2).contiguous().view(-1,y.shape[-1]) # [BT,128]
-        else:
-            ys_BT = ys[index].repeat(self.time_steps,1).permute(1,0).contiguous()
-        # print('ys_BT shape in G',ys_BT.shape)
-        # print('h first column',h[:,0,0,0])
-        # print('ys_BT first column',ys_BT[:,0])
-        # print('h norm',torch.norm(h.reshape(h.shape[0],-1),dim = 1).mean())
-
-        h = block(h, ys_BT) #[BT,C,H,W]
+        h = layers.maybe_checkpoint(block, self.checkpoint_types, h, ys_blocks[index]) #[BT,C,H,W]
         # print('ys_BT', ys_BT.get_device())
         # print('h', h.get_device())
 
     # Apply batchnorm-relu-conv-tanh at output
-    return torch.tanh(self.output_layer(h)).contiguous().view(-1,self.time_steps,3,*h.shape[2:]) #[B,T,3,H,W]
+    # Splitting the batch dim is a view in both NCHW and channels_last
+    out = torch.tanh(self.output_layer(h)).view(-1,self.time_steps,3,*h.shape[2:]) #[B,T,3,H,W]
+    if return_hidden:
+      return out, last_state_list
+    return out
+
+
+# Inference-only copy of a Generator, built by export_for_inference. SN
+# weights are baked in, and every eval-mode ccbn5D is folded into a
+# ccaffine5D whose scale and shift are affine in y. The maps of all layers
+# are stacked into one weight, and precomputed per class when y is a class
+# index, so a forward's conditioning is one table lookup (or one matmul).
+class InferenceGenerator(nn.Module):
+  def __init__(self, G):
+    super(InferenceGenerator, self).__init__()
+    G = layers.freeze_SN(copy.deepcopy(G).eval())
+    for name in ['dim_z', 'time_steps', 'bottom_width', 'n_classes', 'G_shared', 'hier',
+                 'z_chunk_size', 'no_convgru', 'no_full_attn', 'fp16', 'arch']:
+      setattr(self, name, getattr(G, name))
+    if self.hier and not self.G_shared:
+      raise NotImplementedError('Cannot export a hierarchical G without shared embeddings')
+    # shared is a passthrough, so G(z, G.shared(y)) in utils.sample hands the
+    # class indices straight to the per-class table
+    self.embedding = G.shared
+    self.shared = layers.identity()
+    if self.no_convgru:
+      self.linear = G.linear
+    else:
+      self.convgru = G.convgru
+    if not self.no_full_attn:
+      self.fullAttn = G.fullAttn
+    with torch.no_grad():
+      weights, biases, tables, self.block_rows = [], [], [], []
+      rows = 0
+      for blocklist in G.blocks:
+        start = rows
+        for module in [module for module in blocklist.modules()]:
+          for name, child in list(module.named_children()):
+            if not isinstance(child, layers.ccbn5D):
+              continue
+            mean, var, eps = layers.eval_bn_stats(child)
+            r = torch.rsqrt(var + eps)
+            if isinstance(child.gain, nn.Embedding):
+              # Per-class gains and biases: fold them row by row
+              scale = r * (1 + child.gain.weight)
+              tables += [scale, child.bias.weight - mean * scale]
+            else:
+              # scale = r (1 + W_g y + b_g), shift = W_b y + b_b - mean scale
+              b_g = child.gain.bias if child.gain.bias is not None else torch.zeros_like(r)
+              b_b = child.bias.bias if child.bias.bias is not None else torch.zeros_like(r)
+              weights += [r[:, None] * child.gain.weight,
+                          child.bias.weight - (mean * r)[:, None] * child.gain.weight]
+              biases += [r * (1 + b_g), b_b - mean * r * (1 + b_g)]
+            setattr(module, name, layers.ccaffine5D(child.output_size, self.time_steps))
+            rows += 2 * child.output_size
+        self.block_rows += [(start, rows)]
+      if weights:
+        self.register_buffer('cond_weight', torch.cat(weights))
+        self.register_buffer('cond_bias', torch.cat(biases))
+        table = (None if self.hier else
+                 F.linear(self.embedding.weight, self.cond_weight, self.cond_bias))
+      else:
+        self.cond_weight, self.cond_bias = None, None
+        table = torch.cat(tables, 1)
+      self.register_buffer('table', table)
+      self.blocks = G.blocks
+      # The output bn folds into a fixed per-channel affine map
+      output_bn = G.output_layer[0]
+      mean, var, eps = layers.eval_bn_stats(output_bn)
+      scale = output_bn.gain * torch.rsqrt(var + eps)
+      self.output_layer = nn.Sequential(layers.affine(scale, output_bn.bias - mean * scale),
+                                        *G.output_layer[1:])
+    for param in self.parameters():
+      param.requires_grad = False
+    self.eval()
+
+  # y is either class indices [B], looked up in the per-class table, or the
+  # shared embedding [B, D], as Generator takes it (e.g. for interpolation)
+  def forward(self, z, y, hidden_state=None, return_hidden=False):
+    if self.no_convgru and (hidden_state is not None or return_hidden):
+      raise ValueError('G has no ConvGRU (no_convgru), so it has no hidden state '
+                       'to continue a video from')
+    if self.hier:
+      zs = torch.split(z, self.z_chunk_size, 1)
+      z = zs[0]
+    gy = self.embedding(y) if (y.dim() == 1 and self.G_shared) else y
+    # Conditioning rows of each block, [B, rows]
+    if self.table is not None and y.dim() == 1:
+      cond = self.table[y]
+      conds = [cond[:, start:end] for start, end in self.block_rows]
+    elif not self.hier:
+      cond = F.linear(gy, self.cond_weight, self.cond_bias)
+      conds = [cond[:, start:end] for start, end in self.block_rows]
+    else:
+      conds = [F.linear(torch.cat([gy, item], 1), self.cond_weight[start:end], self.cond_bias[start:end])
+               for item, (start, end) in zip(zs[1:], self.block_rows)]
+    # Split each block's rows into its layers' (scale, shift)
+    ys_blocks = []
+    for blocklist, cond in zip(self.blocks, conds):
+      affines = [module for module in blocklist.modules() if isinstance(module, layers.ccaffine5D)]
+      out = torch.split(cond, [module.output_size for module in affines for _ in range(2)], 1)
+      ys_blocks += [{module: (out[2 * i], out[2 * i + 1]) for i, module in enumerate(affines)}]
+    if self.no_convgru:
+      last_state_list = None
+      h = self.linear(z).view(z.size(0), self.time_steps, -1, self.bottom_width, self.bottom_width)
+    else:
+      zy = torch.cat((z, gy), 1) if self.G_shared else z
+      layer_output_list, last_state_list = self.convgru(zy, hidden_state,
+                                                        return_all_states=return_hidden)
+      h = layer_output_list[-1] #[B,T,C,4,4]
+    if not self.no_full_attn:
+      h = self.fullAttn(h)
+    h = h.reshape(-1, *h.shape[2:]) #[BT,C,4,4]
+    for blocklist, ys in zip(self.blocks, ys_blocks):
+      for block in blocklist:
+        h = block(h, ys)
+    out = torch.tanh(self.output_layer(h)).view(-1, self.time_steps, 3, *h.shape[2:]) #[B,T,3,H,W]
+    if return_hidden:
+      return out, last_state_list
+    return out
+
+
+# Build a lean, eval-only copy of G for serving and metric runs; G itself is
+# left untouched. Accumulate standing stats on G first if using them.
+def export_for_inference(G):
+  return InferenceGenerator(G)
 
 
 # Discriminator architecture, same paradigm as G's above
@@ -425,7 +602,8 @@ class ImageDiscriminator(nn.Module):
                num_D_SVs=1, num_D_SV_itrs=1, D_activation=nn.ReLU(inplace=False),
                D_lr=2e-4, D_B1=0.0, D_B2=0.999, adam_eps=1e-8,
                SN_eps=1e-12, output_dim=1, D_mixed_precision=False, D_fp16=False,
-               D_init='ortho', skip_init=False, D_param='SN', **kwargs):
+               D_adam8bit=False,
+               D_init='ortho', skip_init=False, D_param='SN', checkpoint='', **kwargs):
     super(ImageDiscriminator, self).__init__()
     # Width multiplier
     self.ch = D_ch
@@ -449,6 +627,9 @@ class ImageDiscriminator(nn.Module):
     self.SN_eps = SN_eps
     # Fp16?
     self.fp16 = D_fp16
+    # Blocks and attention modules to recompute in backward
+    self.checkpoint_types = layers.checkpoint_types(
+      checkpoint, 'D', (layers.DBlock,), (layers.Attention,))
     # Architecture
     self.arch = D_img_arch(self.ch, self.attention)[resolution]
 
@@ -502,6 +683,11 @@ class ImageDiscriminator(nn.Module):
       import utils
       self.optim = utils.Adam16(params=self.parameters(), lr=self.lr,
                              betas=(self.B1, self.B2), weight_decay=0, eps=self.adam_eps)
+    elif D_adam8bit:
+      print('Using 8-bit adam in D...')
+      import utils
+      self.optim = utils.Adam8bit(params=self.parameters(), lr=self.lr,
+                                  betas=(self.B1, self.B2), weight_decay=0, eps=self.adam_eps)
     else:
       self.optim = optim.Adam(params=self.parameters(), lr=self.lr,
                              betas=(self.B1, self.B2), weight_decay=0, eps=self.adam_eps)
@@ -537,7 +723,7 @@ class ImageDiscriminator(nn.Module):
     # Loop over blocks
     for index, blocklist in enumerate(self.blocks):
       for block in blocklist:
-        h = block(h)
+        h = layers.maybe_checkpoint(block, self.checkpoint_types, h)
     # Apply global sum pooling as in SN-GAN
     h = torch.sum(self.activation(h), [2, 3])
     # Get initial class-unconditional output
@@ -622,7 +808,8 @@ class VideoDiscriminator(nn.Module):
                num_D_SVs=1, num_D_SV_itrs=1, D_activation=nn.ReLU(inplace=False),
                D_lr=2e-4, D_B1=0.0, D_B2=0.999, adam_eps=1e-8,
                SN_eps=1e-12, output_dim=1, D_mixed_precision=False, D_fp16=False,
-               D_init='ortho', skip_init=False, D_param='SN', **kwargs):
+               D_adam8bit=False,
+               D_init='ortho', skip_init=False, D_param='SN', checkpoint='', **kwargs):
     super(VideoDiscriminator, self).__init__()
     # Width multiplier
     self.ch = D_ch
@@ -648,6 +835,10 @@ class VideoDiscriminator(nn.Module):
     self.SN_eps = SN_eps
     # Fp16?
     self.fp16 = D_fp16
+    # Blocks and attention modules to recompute in backward
+    self.checkpoint_types = layers.checkpoint_types(
+      checkpoint, 'Dv', (layers.BasicBlock, layers.Conv3DBlock, layers.DBlock),
+      (layers.Attention,))
     # Architecture
     self.arch = D_vid_arch(self.ch, self.attention)[resolution]
     #Xiaodan: Added by xiaodan
@@ -746,6 +937,11 @@ class VideoDiscriminator(nn.Module):
       import utils
       self.optim = utils.Adam16(params=self.parameters(), lr=self.lr,
                              betas=(self.B1, self.B2), weight_decay=0, eps=self.adam_eps)
+    elif D_adam8bit:
+      print('Using 8-bit adam in D...')
+      import utils
+      self.optim = utils.Adam8bit(params=self.parameters(), lr=self.lr,
+                                  betas=(self.B1, self.B2), weight_decay=0, eps=self.adam_eps)
     else:
       self.optim = optim.Adam(params=self.parameters(), lr=self.lr,
                              betas=(self.B1, self.B2), weight_decay=0, eps=self.adam_eps)
@@ -779,7 +975,9 @@ class VideoDiscriminator(nn.Module):
     h = x #[B,T,C,H,W]
     # if tensor_writer != None and iteration % 1000 == 0:
     #     tensor_writer.add_video('Before Downsampling', (h[-2:] + 1)/2, iteration)
-    h = h.permute(0,2,1,3,4).contiguous() #[B,C,T,H,W]
+    # No copy here: a [B,T,C,H,W] video with channels_last frames permutes
+    # straight into a channels_last_3d [B,C,T,H,W] tensor
+    h = h.permute(0,2,1,3,4) #[B,C,T,H,W]
     h = self.InitDownsample(h) #[B,C,T,H/2,W/2]
     # if tensor_writer != None and iteration % 1000 == 0:
     #     tensor_writer.add_video('After Downsampling', (h[-2:].permute(0,2,1,3,4) + 1)/2, iteration)
@@ -787,9 +985,9 @@ class VideoDiscriminator(nn.Module):
     for index, blocklist in enumerate(self.blocks):
       if not self.arch['3D block'][index] and index > 0 and self.arch['3D block'][index-1]:
         h = h.permute(0,2,1,3,4)#[B,T*,C*,H*,W*]
-        h = h.contiguous().view(-1,*h.shape[2:]) #[BT*,C*,H*,W*]
+        h = h.reshape(-1,*h.shape[2:]) #[BT*,C*,H*,W*], a view if channels_last_3d
       for block in blocklist:
-        h = block(h)
+        h = layers.maybe_checkpoint(block, self.checkpoint_types, h)
     # [BT*,C*,H*,W*]
     # Apply global sum pooling as in SN-GAN
     h = torch.sum(self.activation(h), [2, 3]) # [BT*,C*]
@@ -819,33 +1017,88 @@ class VideoDiscriminator(nn.Module):
 # Parallelized G_D to minimize cross-gpu communication
 # Without this, Generator outputs would get all-gathered and then rebroadcast.
 class G_D(nn.Module):
-  def __init__(self, G, D, Dv = None, k=8, T_into_B=False):
+  def __init__(self, G, D, Dv = None, k=8, T_into_B=False, amp_dtype=None):
     super(G_D, self).__init__()
     self.G = G
     self.D = D
     self.Dv = Dv
     self.k = k
     self.T_into_B = T_into_B
+    # Autocast dtype for --amp, or None
+    self.amp_dtype = amp_dtype
+    # DistributedDataParallel wrappers of G, D and Dv, see distribute()
+    self.wrappers = {}
     # print('self.k',self.k)
-  def forward(self, z, gy, x=None, dy=None, train_G=False, return_G_z=False,
-              split_D=False, tensor_writer = None, iteration = None):
+
+  # Under --distributed, run G, D and Dv through DistributedDataParallel
+  # wrappers, which average their grads across processes. The plain nets stay
+  # as G_D's attributes, for their settings and for saving. Buffers aren't
+  # broadcast, so each process keeps its own BN stats and SN vectors and may
+  # skip G's forward on its own (e.g. with a fake replay buffer). G's first
+  # linear layer is kept (for its checkpoints) but unused when G starts from
+  # its ConvGRU, so DDP must then look for unused params in G. hooks maps a
+  # net's name to the (state, hook) of a DDP communication hook, if any.
+  def distribute(self, device_ids=None, hooks={}, **kwargs):
+    for name in ['G', 'D', 'Dv']:
+      net = getattr(self, name)
+      if net is not None:
+        find_unused = name == 'G' and not net.no_convgru
+        self.wrappers[name] = nn.parallel.DistributedDataParallel(
+          net, device_ids=device_ids, broadcast_buffers=False,
+          **{'find_unused_parameters': find_unused, **kwargs})
+        if hooks.get(name) is not None:
+          self.wrappers[name].register_comm_hook(*hooks[name])
+    return self
+
+  # Call G, D or Dv, through its DDP wrapper if distributed. A net this call
+  # doesn't train runs under no_sync, so that DDP doesn't wait for the grads
+  # it won't get (they may even be toggled off).
+  def call_net(self, name, train, *args, **kwargs):
+    net = self.wrappers.get(name)
+    if net is None:
+      return getattr(self, name)(*args, **kwargs)
+    if train:
+      return net(*args, **kwargs)
+    with net.no_sync():
+      return net(*args, **kwargs)
+
+  # With an amp_dtype, G, D and Dv run under autocast (entered here, so that
+  # each DataParallel replica thread has it on) and the outputs are returned
+  # in fp32 for the losses
+  def forward(self, z, gy, *args, **kwargs):
+    if self.amp_dtype is None:
+      return self._forward(z, gy, *args, **kwargs)
+    with torch.autocast(z.device.type, dtype=self.amp_dtype):
+      out = self._forward(z, gy, *args, **kwargs)
+    return tuple(item.float() for item in out)
+
+  # G_z: a G output (with its graph) from an earlier call to reuse instead of
+  # running G again; detach_G_z: run G with grad, for such reuse, but show D
+  # and Dv a detached copy. The returned G_z is never detached.
+  def _forward(self, z, gy, x=None, dy=None, train_G=False, return_G_z=False,
+               split_D=False, tensor_writer = None, iteration = None,
+               G_z=None, detach_G_z=False):
     # print('z shape in GD before with:',z.shape)
     # If training G, enable grad tape
-    with torch.set_grad_enabled(train_G):
-      # Get Generator output given noise
-      # print('Entering G in GD')
-      # print('z shape in GD:',z.shape)
-      # print('G.shared(gy) shape:',self.G.shared(gy).shape)
-      G_z = self.G(z, self.G.shared(gy)) #xiaodan: G_z:[B,T,C,H,W]
-      # if G_z.get_device() == 0:
-      #   print('G_z in G_D forward, B=0',G_z[0,:,0,0,0],G_z.get_device())
-      #   print('gy in G_D forward',gy,gy.get_device() )
-      # print('Left G in GD')
-      # Cast as necessary
-      if self.G.fp16 and not self.D.fp16:
-        G_z = G_z.float()
-      if self.D.fp16 and not self.G.fp16:
-        G_z = G_z.half()
+    if G_z is None:
+      with torch.set_grad_enabled(train_G):
+        # Get Generator output given noise
+        # print('Entering G in GD')
+        # print('z shape in GD:',z.shape)
+        # print('G.shared(gy) shape:',self.G.shared(gy).shape)
+        G_z = self.call_net('G', train_G, z, self.G.shared(gy)) #xiaodan: G_z:[B,T,C,H,W]
+        # if G_z.get_device() == 0:
+        #   print('G_z in G_D forward, B=0',G_z[0,:,0,0,0],G_z.get_device())
+        #   print('gy in G_D forward',gy,gy.get_device() )
+        # print('Left G in GD')
+        # Cast as necessary
+        if self.G.fp16 and not self.D.fp16:
+          G_z = G_z.float()
+        if self.D.fp16 and not self.G.fp16:
+          G_z = G_z.half()
+    G_z_out = G_z
+    if detach_G_z:
+      G_z = G_z.detach()
     #xiaodan: need to sample for k frames
     # print('gy,dy',gy.shape,dy.shape)
     import utils
@@ -854,7 +1107,7 @@ class G_D(nn.Module):
       # if sampled_G_z.get_device() == 0:
       #   print('sampled G_z in G_D forward shape',sampled_G_z.shape,sampled_G_z.get_device())
       #   print('sampled gy in G_D forward shape',sampled_gy.shape,sampled_gy.get_device())
-      sampled_G_z = sampled_G_z.contiguous().view(-1,*G_z.shape[2:])# [B*8,C,H,W]
+      sampled_G_z = sampled_G_z.reshape(-1,*G_z.shape[2:])# [B*8,C,H,W]
       sampled_gy = sampled_gy.contiguous().view(-1) # [B*8]
       # if sampled_G_z.get_device() == 0:
       #   print('sampled G_z in G_D forward, B=0~1',sampled_G_z[:16,0,0,0],sampled_G_z.get_device())
@@ -867,7 +1120,7 @@ class G_D(nn.Module):
       # print('x and dy shape',x.shape,dy.shape)
       if self.k > 1:
         sampled_x, sampled_dy = utils.sample_frames(x,dy,self.k) # [B,8,C,H,W], [B,8]
-        sampled_x = sampled_x.contiguous().view(-1,*x.shape[2:])# [B*8,C,H,W]
+        sampled_x = sampled_x.reshape(-1,*x.shape[2:])# [B*8,C,H,W]
         sampled_dy = sampled_dy.contiguous().view(-1,*dy.shape[2:]) # [B*8]
       else:
         sampled_x, sampled_dy = x.squeeze(), dy
@@ -885,27 +1138,31 @@ class G_D(nn.Module):
 
     # Split_D means to run D once with real data and once with fake,
     # rather than concatenating along the batch dimension.
+    # D and Dv train when given real data. Under DDP only their last forward
+    # before backward may sync, so with split_D the fake halves never do; the
+    # backward still brings all of their grads to the sync.
+    train_D = x is not None
     if split_D:
-      D_fake = self.D(sampled_G_z, sampled_gy)
+      D_fake = self.call_net('D', False, sampled_G_z, sampled_gy)
       if self.Dv != None:
-        Dv_fake, repetition = self.Dv(G_z, duplicated_gy)
+        Dv_fake, repetition = self.call_net('Dv', False, G_z, duplicated_gy)
       if x is not None:
-        D_real = self.D(sampled_x, sampled_dy)
+        D_real = self.call_net('D', train_D, sampled_x, sampled_dy)
         if self.Dv != None:
-          Dv_real, repetition = self.Dv(x, duplicated_dy, tensor_writer=tensor_writer, iteration=iteration)
-          return D_fake, D_real, Dv_fake, Dv_real, G_z
+          Dv_real, repetition = self.call_net('Dv', train_D, x, duplicated_dy, tensor_writer=tensor_writer, iteration=iteration)
+          return D_fake, D_real, Dv_fake, Dv_real, G_z_out
         else:
-          return D_fake, D_real, G_z
+          return D_fake, D_real, G_z_out
       else:
         if return_G_z:
           if self.Dv != None:
-            return D_fake, sampled_G_z, Dv_fake, G_z
+            return D_fake, sampled_G_z, Dv_fake, G_z_out
           else:
-            return D_fake, sampled_G_z, G_z
+            return D_fake, sampled_G_z, G_z_out
         else:
           if self.Dv != None:
-            return D_fake, Dv_fake, G_z
-          return D_fake, G_z
+            return D_fake, Dv_fake, G_z_out
+          return D_fake, G_z_out
     # If real data is provided, concatenate it with the Generator's output
     # along the batch dimension for improved efficiency.
     else:
@@ -915,28 +1172,28 @@ class G_D(nn.Module):
       Dv_class = torch.cat([duplicated_gy, duplicated_dy], 0) if dy is not None else duplicated_gy
       # print('duplicated gy dy', duplicated_gy.shape,duplicated_dy.shape)
       # Get Discriminator output
-      D_out = self.D(D_input, D_class)
+      D_out = self.call_net('D', train_D, D_input, D_class)
       if self.Dv != None:
         # print('Entering line 890')
-        Dv_out, repetition = self.Dv(Dv_input, Dv_class, tensor_writer=tensor_writer, iteration=iteration)
+        Dv_out, repetition = self.call_net('Dv', train_D, Dv_input, Dv_class, tensor_writer=tensor_writer, iteration=iteration)
         # print('Left line 890')
       if x is not None:
         if self.Dv != None:
           # print('repetition,Dv_out,G_z,x',repetition,Dv_out.shape,G_z.shape,x.shape)
           D_out_fake, D_out_real, Dv_out_fake, Dv_out_real = list(torch.split(D_out, [sampled_G_z.shape[0], sampled_x.shape[0]])) + list(torch.split(Dv_out, [repetition*G_z.shape[0], repetition*x.shape[0]])) # D_fake, D_real
           # print('Shapes:',D_out_fake.shape, D_out_real.shape, Dv_out_fake.shape, Dv_out_real.shape, G_z.shape)
-          return D_out_fake, D_out_real, Dv_out_fake, Dv_out_real, G_z
+          return D_out_fake, D_out_real, Dv_out_fake, Dv_out_real, G_z_out
         else:
           D_out_fake, D_out_real = list(torch.split(D_out, [sampled_G_z.shape[0], sampled_x.shape[0]]))  # D_fake, D_real
-          return D_out_fake, D_out_real, G_z
+          return D_out_fake, D_out_real, G_z_out
       else:
         if return_G_z:
           if self.Dv != None:
-            return D_out, sampled_G_z, Dv_out, G_z
+            return D_out, sampled_G_z, Dv_out, G_z_out
           else:
-            return D_out, sampled_G_z, G_z
+            return D_out, sampled_G_z, G_z_out
         else:
           if self.Dv != None:
-            return D_out, Dv_out, G_z
+            return D_out, Dv_out, G_z_out
           else:
-            return D_out, G_z
+            return D_out, G_z_out
@@ -0,0 +1,1162 @@
+''' Benchmarks
+    This script times the data stores, layers and training options against
+    the paths they replace and prints a small table for each, so the numbers
+    behind a change can be reproduced on any machine.
+    Run e.g. python benchmark.py --dataset Kinetics400 --which clip_store
+    With --check, the run fails if a path differs from the one it replaces
+    by more than its tolerance. '''
+import os
+import sys
+import copy
+import math
+import time
+import random
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+
+import utils
+import layers
+import datasets as dset
+
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def add_benchmark_parser(parser):
+  parser.add_argument(
+    '--which', type=str, default='',
+    help='Comma separated benchmarks to run, out of %s (default: all)'
+         % ', '.join(benchmarks))
+  parser.add_argument(
+    '--num_trials', type=int, default=20,
+    help='Number of timed repetitions per measurement (default: %(default)s)')
+  parser.add_argument(
+    '--num_clips', type=int, default=64,
+    help='Number of videos to sample for the clip store benchmark '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--check', action='store_true', default=False,
+    help='Exit with an error if any equivalence check exceeds its tolerance? '
+         '(default: %(default)s)')
+  return parser
+
+
+# Average wall time of fn() over num_trials calls, after a short warmup
+def timeit(fn, num_trials=20, warmup=2):
+  for _ in range(warmup):
+    fn()
+  if device == 'cuda':
+    torch.cuda.synchronize()
+  start = time.perf_counter()
+  for _ in range(num_trials):
+    fn()
+  if device == 'cuda':
+    torch.cuda.synchronize()
+  return (time.perf_counter() - start) / num_trials
+
+
+# Fill in the settings train.py derives from the dataset and build a model
+def prepare_config(config):
+  config['resolution'] = utils.imsize_dict[config['dataset']]
+  config['n_classes'] = utils.nclass_dict[config['dataset']]
+  config['G_activation'] = utils.activation_dict[config['G_nl']]
+  config['D_activation'] = utils.activation_dict[config['D_nl']]
+  return config
+
+def build_net(config, which='Generator', **kwargs):
+  model = __import__(config['model'])
+  return getattr(model, which)(**{**config, 'skip_init': True, 'no_optim': True,
+                                  **kwargs}).to(device)
+
+def build_G(config, **kwargs):
+  return build_net(config, 'Generator', **kwargs)
+
+def build_nets(config, **kwargs):
+  return [build_net(config, which, **kwargs)
+          for which in ['Generator', 'ImageDiscriminator']
+                       + ([] if config['no_Dv'] else ['VideoDiscriminator'])]
+
+def build_GD(config, nets, **kwargs):
+  model = __import__(config['model'])
+  return model.G_D(nets[0], nets[1], nets[2] if len(nets) > 2 else None,
+                   config['k'], config['T_into_B'], **kwargs)
+
+
+# A random batch of z, y and real videos x on the benchmark device
+def random_batch(config, B=None):
+  B = B or config['batch_size']
+  z = torch.randn(B, config['dim_z'], device=device)
+  y = torch.randint(0, config['n_classes'], (B,), device=device)
+  x = torch.randn(B, config['time_steps'], 3, config['resolution'], config['resolution'],
+                  device=device)
+  return z, y, x
+
+# One G_D forward, a D step if x is given and a G step otherwise, and the
+# backward of the sum of its outputs' means; returns the outputs
+def GD_backward(GD, config, z, gy, x=None, dy=None, **kwargs):
+  kwargs = {'train_G': x is None, 'split_D': config['split_D'], **kwargs}
+  outs = GD(z, gy, x, gy if x is not None and dy is None else dy, **kwargs)
+  sum(out.mean() for out in outs[:-1]).backward()
+  return outs
+
+
+# Number of operators dispatched, on the CPU side, by one call of fn()
+def count_ops(fn):
+  with torch.autograd.profiler.profile() as prof:
+    fn()
+  return sum(event.count for event in prof.key_averages())
+
+# What fn() returns, and the peak MB allocated during it on GPU ('-' on CPU)
+def peak_memory(fn):
+  if device == 'cuda':
+    torch.cuda.reset_peak_memory_stats()
+  out = fn()
+  return out, '%.1f' % (torch.cuda.max_memory_allocated() / 1e6) if device == 'cuda' else '-'
+
+# Bytes of the distinct tensors autograd saves for backward during fn()
+def saved_bytes(fn):
+  saved = {}
+  def pack(tensor):
+    saved[(tensor.data_ptr(), tensor.dtype)] = tensor.numel() * tensor.element_size()
+    return tensor
+  with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+    out = fn()
+  return out, sum(saved.values())
+
+# A table row per (name, fn) path: ops dispatched by one call, and ms per call
+def time_paths(paths, config, ops=True, digits=2):
+  return [[name] + ([count_ops(fn)] if ops else [])
+          + ['%.*f' % (digits, 1000 * timeit(fn, config['num_trials']))]
+          for name, fn in paths]
+
+
+# Max abs difference of two tensors, or of two lists of tensors
+def max_abs_diff(a, b):
+  if torch.is_tensor(a):
+    return (a.detach().float() - b.detach().float()).abs().max().item()
+  return max(max_abs_diff(a_item, b_item) for a_item, b_item in zip(a, b))
+
+# Report the max abs difference of a path from the one it replaces; --check
+# fails the run if any exceeds its tolerance
+failed_checks = []
+def check(what, error, tolerance):
+  passed = error <= tolerance
+  print('Max abs difference %s: %.3g (tolerance %.3g)%s'
+        % (what, error, tolerance, '' if passed else ', FAILED'))
+  if not passed:
+    failed_checks.append(what)
+
+
+def print_table(header, rows):
+  widths = [max(len(str(item)) for item in column) for column in zip(header, *rows)]
+  for row in [header] + rows:
+    print('  '.join(str(item).rjust(width) for item, width in zip(row, widths)))
+
+
+# Run each setting from the same RNG state and print a table of what they
+# cost. run(setting) returns the setting's row and the state (outputs, grads,
+# weights) it should share with the first setting. Later settings are checked
+# against the first under tolerance, or without one, diff(state, first) is
+# shown as the last column. Returns the states.
+def compare_settings(config, header, settings, run, what='', tolerance=None,
+                     diff=max_abs_diff):
+  rows, states = [], []
+  for setting in settings:
+    utils.seed_rng(config['seed'])
+    row, state = run(setting)
+    rows += [row]
+    states += [state]
+  errors = [diff(state, states[0]) for state in states]
+  if tolerance is None:
+    rows = [row + ['%.3g' % error] for row, error in zip(rows, errors)]
+  print_table(header, rows)
+  if tolerance is not None:
+    for row, error in zip(rows[1:], errors[1:]):
+      check('%s, %s' % (what, row[0]), error, tolerance)
+  return states
+
+
+# Run fn(rank, world_size, config) in world_size CPU processes joined in a
+# gloo process group, as torchrun would launch them, and return what rank 0's
+# call returns
+def run_gloo(fn, config, world_size=2):
+  import torch.multiprocessing as mp
+  context = mp.get_context('spawn')
+  queue = context.SimpleQueue()
+  port = str(random.randint(20000, 40000))
+  processes = [context.Process(target=gloo_worker,
+                               args=(fn, rank, world_size, port, config, queue))
+               for rank in range(world_size)]
+  for process in processes:
+    process.start()
+  result = queue.get()
+  for process in processes:
+    process.join()
+  return result
+
+def gloo_worker(fn, rank, world_size, port, config, queue):
+  global device
+  device = 'cpu'
+  os.environ['MASTER_ADDR'] = '127.0.0.1'
+  os.environ['MASTER_PORT'] = port
+  torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+  try:
+    result = fn(rank, world_size, config)
+  finally:
+    torch.distributed.destroy_process_group()
+  if rank == 0:
+    queue.put(result)
+
+
+# Bytes, files and per-clip load time of the JPEG frame tree versus the mp4
+# store. Raw is the uncompressed uint8 size of the same frames, as a
+# reference for any store that keeps decoded frames.
+def clip_store(config):
+  store = dset.mp4_clip_dataset(config['mp4_store_root'],
+                                clip_length_in_frames=config['time_steps'])
+  jpeg = dset.vid2frame_dataset(cache_csv_path=config['cache_csv_path'],
+                                clip_length_in_frames=config['time_steps'],
+                                cache_exists=True)
+  jpeg_index = {os.path.basename(os.path.normpath(path)): i
+                for i, path in enumerate(jpeg.cache_df['path'])}
+  pairs = [(i, jpeg_index[os.path.splitext(store.paths[i])[0]])
+           for i in random.sample(range(len(store)), min(config['num_clips'], len(store)))
+           if os.path.splitext(store.paths[i])[0] in jpeg_index]
+  frame_size = int(np.load(os.path.join(config['mp4_store_root'], 'index.npz'))['frame_size'])
+  raw_bytes = sum(int(store.num_frames[i]) for i, _ in pairs) * frame_size * frame_size * 3
+  mp4_bytes = sum(os.path.getsize(os.path.join(store.store_root, store.paths[i])) for i, _ in pairs)
+  jpeg_files = [os.path.join(jpeg.cache_df.iloc[j]['path'], name)
+                for _, j in pairs for name in os.listdir(jpeg.cache_df.iloc[j]['path'])]
+  jpeg_bytes = sum(os.path.getsize(name) for name in jpeg_files)
+
+  def load_all(dataset, which):
+    for pair in pairs:
+      dataset[pair[which]]
+  mp4_time = timeit(lambda: load_all(store, 0), config['num_trials'], warmup=1) / len(pairs)
+  jpeg_time = timeit(lambda: load_all(jpeg, 1), config['num_trials'], warmup=1) / len(pairs)
+  print('Clip store over %d videos, %d-frame clips:' % (len(pairs), config['time_steps']))
+  print_table(['store', 'MB/video', 'files/video', 'ms/clip'],
+              [['raw uint8', '%.2f' % (raw_bytes / 1e6 / len(pairs)), '-', '-'],
+               ['jpeg', '%.2f' % (jpeg_bytes / 1e6 / len(pairs)),
+                '%.1f' % (len(jpeg_files) / float(len(pairs))), '%.2f' % (1000 * jpeg_time)],
+               ['mp4', '%.2f' % (mp4_bytes / 1e6 / len(pairs)), '1.0',
+                '%.2f' % (1000 * mp4_time)]])
+
+
+# Sampling time of G in eval mode with the SN weights recomputed on every
+# forward (the old behaviour), cached, and frozen into plain layers. Cached
+# and frozen samples must match recomputed ones.
+def sn_cache(config):
+  G = build_G(config).eval()
+  z_, y_ = utils.prepare_z_y(config['G_batch_size'] or config['batch_size'],
+                             G.dim_z, config['n_classes'], device=device)
+  sn_layers = [module for module in G.modules() if isinstance(module, layers.SN)]
+  def sample(clear_cache=False):
+    if clear_cache:
+      for module in sn_layers:
+        module._W_cache = None
+    return utils.sample(G, z_, y_, {'parallel': False})[0]
+  def seeded_sample():
+    utils.seed_rng(config['seed'])
+    return sample()
+  utils.seed_rng(config['seed'])
+  recomputed = sample(True)
+  rows = time_paths([('recomputed', lambda: sample(True)), ('cached', sample)], config, ops=False)
+  cached = seeded_sample()
+  G = layers.freeze_SN(G)
+  rows += time_paths([('frozen', sample)], config, ops=False)
+  print('G sampling with %d SN layers, batch %d:' % (len(sn_layers), z_.shape[0]))
+  print_table(['SN weights', 'ms/batch'], rows)
+  check('of cached samples', max_abs_diff(cached, recomputed), 1e-5)
+  check('of frozen samples', max_abs_diff(seeded_sample(), cached), 1e-4)
+
+
+# One training step's worth of SN work in G, D and Dv: the power iterations
+# and the normalized weights, with their backward, per layer versus batched
+# by an SNManager. Also checks both end up with the same u and sigma.
+def sn_batched(config):
+  nets = build_nets(config)
+  managed_nets = copy.deepcopy(nets)
+  manager = layers.SNManager(*managed_nets)
+  def step(nets, manager=None):
+    if manager is not None:
+      manager.update()
+    sum(module.W_().sum() for net in nets for module in net.modules()
+        if isinstance(module, layers.SN)).backward()
+  rows = time_paths([('per layer', lambda: step(nets)),
+                     ('batched', lambda: step(managed_nets, manager))], config)
+  # Both copies took the same number of steps
+  pairs = [(module, managed) for net, managed_net in zip(nets, managed_nets)
+           for module, managed in zip(net.modules(), managed_net.modules())
+           if isinstance(module, layers.SN)]
+  print('SN work per step for %d layers in %d groups:' % (manager.num_layers, len(manager.groups)))
+  print_table(['power iteration', 'ops', 'ms/step'], rows)
+  check('in u', max_abs_diff([module.u[0] for module, _ in pairs],
+                             [managed.u[0] for _, managed in pairs]), 1e-4)
+  check('in sigma', max_abs_diff([module.sv[0] for module, _ in pairs],
+                                 [managed.sv[0] for _, managed in pairs]), 1e-3)
+
+
+# The attention forwards as they were before the fused projection, kept
+# here as the reference to time and check the current modules against.
+def reference_full_attention(self, x):
+  y = x.permute(0, 2, 1, 3, 4)
+  theta = self.theta(y).contiguous().view(-1, self.ch//8, self.T*x.shape[3]*x.shape[4])
+  phi = self.phi(y).contiguous().view(-1, self.ch//8, self.T*x.shape[3]*x.shape[4])
+  g = self.g(y).contiguous().view(-1, self.ch//2, self.T*x.shape[3]*x.shape[4])
+  beta = F.softmax(torch.bmm(theta.transpose(1, 2), phi), -1)
+  o = self.o(torch.bmm(g, beta.transpose(1,2)).contiguous().view(-1, self.ch // 2, self.T, x.shape[3], x.shape[4])).permute(0,2,1,3,4)
+  return self.gamma * o + x
+
+def reference_attention(self, x):
+  theta = self.theta(x)
+  phi = F.max_pool2d(self.phi(x), [2,2])
+  g = F.max_pool2d(self.g(x), [2,2])
+  theta = theta.view(-1, self. ch // 8, x.shape[2] * x.shape[3])
+  phi = phi.view(-1, self. ch // 8, x.shape[2] * x.shape[3] // 4)
+  g = g.view(-1, self. ch // 2, x.shape[2] * x.shape[3] // 4)
+  beta = F.softmax(torch.bmm(theta.transpose(1, 2), phi), -1)
+  o = self.o(torch.bmm(g, beta.transpose(1,2)).view(-1, self.ch // 2, x.shape[2], x.shape[3]))
+  return self.gamma * o + x
+
+
+# Forward + backward time of FullAttention at G's bottom resolution and of
+# the 2D Attention at 32x32, fused projection versus the reference forwards.
+# Runs on CPU; modules are in eval mode so SN's u is fixed and both paths see
+# the same weights.
+def attention(config):
+  B, T = 4, config['time_steps']
+  cases = [('FullAttention', layers.FullAttention(256, T), reference_full_attention,
+            torch.randn(B, T, 256, 4, 4)),
+           ('Attention', layers.Attention(64), reference_attention,
+            torch.randn(B * T, 64, 32, 32))]
+  rows, errors = [], []
+  for name, module, reference, x in cases:
+    module = module.eval()
+    x = x.requires_grad_()
+    with torch.no_grad():
+      module.gamma.fill_(1.)
+    errors += [max_abs_diff(module(x), reference(module, x))]
+    times = time_paths([('reference', lambda: reference(module, x).sum().backward()),
+                        ('fused', lambda: module(x).sum().backward())], config, ops=False)
+    rows += [[name, tuple(x.shape)] + [item[-1] for item in times]]
+  print_table(['module', 'input', 'reference ms', 'fused ms'], rows)
+  for (name, _, _, _), error in zip(cases, errors):
+    check('of %s' % name, error, 1e-4)
+
+
+# FullAttention with the full THW x THW map versus chunked online softmax,
+# on an 8x8 latent: outputs and input gradients must agree, and on GPU the
+# peak memory of forward + backward is reported.
+def attention_chunked(config):
+  B, T, ch, width = 2, config['time_steps'], 256, 8
+  chunk_size = config['G_attn_chunk'] or 64
+  module = layers.FullAttention(ch, T).to(device).eval()
+  chunked = copy.deepcopy(module)
+  chunked.chunk_size = chunk_size
+  with torch.no_grad():
+    module.gamma.fill_(1.)
+    chunked.gamma.fill_(1.)
+  x = torch.randn(B, T, ch, width, width, device=device, requires_grad=True)
+  def run(setting):
+    name, net = setting
+    def step():
+      x.grad = None
+      out = net(x)
+      out.sum().backward()
+      return out.detach(), x.grad.clone()
+    state, peak = peak_memory(step)
+    return [name, peak] + time_paths([(name, step)], config, ops=False)[0][1:], state
+  print('FullAttention over %d positions:' % (T * width * width))
+  states = compare_settings(config, ['attention', 'peak MB', 'ms/step'],
+                            [('full', module), ('chunk %d' % chunk_size, chunked)], run,
+                            'in output', 1e-4, diff=lambda a, b: max_abs_diff(a[0], b[0]))
+  check('in input grad', max_abs_diff(states[1][1], states[0][1]), 1e-3)
+
+
+# The SelfAttention_width/height/time forwards replaced by AxialAttention,
+# as (permutation of [B,T,c,H,W] that puts the attended axis last, and the
+# permutation back); used as the reference for the axial benchmark.
+separable_permutes = {'width': ((0,1,3,2,4), (0,1,3,2,4)),
+                      'height': ((0,1,4,2,3), (0,1,3,4,2)),
+                      'time': ((0,3,4,2,1), (0,4,3,1,2))}
+def reference_separable_pass(self, x):
+  into, back = separable_permutes[self.axis]
+  theta, phi, g = self.theta(x), self.phi(x), self.g(x)
+  rows = lambda h, c: h.contiguous().view(-1, self.T, c, *x.shape[2:]).permute(*into).contiguous()
+  theta, phi, g = rows(theta, self.ch // 8), rows(phi, self.ch // 8), rows(g, self.ch // 2)
+  shape = g.shape
+  theta, phi, g = [h.view(-1, *h.shape[-2:]) for h in [theta, phi, g]]
+  beta = F.softmax(torch.bmm(theta.transpose(1, 2), phi), -1)
+  attn_g = torch.bmm(g, beta.transpose(1, 2)).contiguous().view(shape).permute(*back)
+  o = self.o(attn_g.contiguous().view(-1, self.ch // 2, *x.shape[2:]))
+  return self.gamma * o + x
+
+def reference_separable_attention(self, x):
+  for attention_pass in [self.width, self.height, self.time]:
+    x = reference_separable_pass(attention_pass, x)
+  return x
+
+
+# AxialAttention at 16x16 and 32x32 versus the three separable modules:
+# bytes saved for backward, forward + backward time, and the outputs must
+# agree.
+def axial_attention(config):
+  B, T = 2, config['time_steps']
+  rows, errors = [], []
+  for ch, width in [(256, 16), (128, 32)]:
+    module = layers.AxialAttention(ch, T).to(device).eval()
+    with torch.no_grad():
+      for attention_pass in [module.width, module.height, module.time]:
+        attention_pass.gamma.fill_(1.)
+    x = torch.randn(B * T, ch, width, width, device=device, requires_grad=True)
+    out, axial_bytes = saved_bytes(lambda: module(x))
+    reference_out, reference_bytes = saved_bytes(lambda: reference_separable_attention(module, x))
+    errors += [(tuple(x.shape), max_abs_diff(out, reference_out))]
+    times = time_paths([('separable', lambda: reference_separable_attention(module, x).sum().backward()),
+                        ('axial', lambda: module(x).sum().backward())], config, ops=False)
+    rows += [[tuple(x.shape), '%.1f' % (reference_bytes / 1e6), '%.1f' % (axial_bytes / 1e6)]
+             + [item[-1] for item in times]]
+  print_table(['input', 'separable MB', 'axial MB', 'separable ms', 'axial ms'], rows)
+  for shape, error in errors:
+    check('at %s' % (shape,), error, 1e-4)
+
+
+# G's block loop with the conditioning recomputed per layer, as it was before
+# ccbn_conditioning, versus the hoisted and fused conditioning.
+def reference_block_loop(G, h, ys):
+  for index, blocklist in enumerate(G.blocks):
+    for block in blocklist:
+      ys_BT = ys[index].repeat(G.time_steps,1,1).permute(1,0,2).contiguous().view(-1,ys[index].shape[-1])
+      h = block(h, ys_BT)
+  return h
+
+def block_loop(G, h, ys):
+  ys_blocks = G.ccbn_conditioning(ys)
+  for index, blocklist in enumerate(G.blocks):
+    for block in blocklist:
+      h = block(h, ys_blocks[index])
+  return h
+
+# Ops dispatched and time of G's blocks in eval mode with shared embeddings.
+def ccbn_conditioning(config):
+  G = build_G(config, G_shared=True).eval()
+  B = config['G_batch_size'] or config['batch_size']
+  y = G.shared(torch.randint(0, config['n_classes'], (B,), device=device))
+  if G.hier:
+    ys = [torch.cat([y, item], 1) for item in torch.randn(B, G.dim_z, device=device).split(G.z_chunk_size, 1)[1:]]
+  else:
+    ys = [y] * len(G.blocks)
+  h = torch.randn(B * G.time_steps, G.arch['in_channels'][0], G.bottom_width, G.bottom_width, device=device)
+  with torch.no_grad():
+    error = max_abs_diff(block_loop(G, h, ys), reference_block_loop(G, h, ys))
+    rows = time_paths([('per layer', lambda: reference_block_loop(G, h, ys)),
+                       ('fused', lambda: block_loop(G, h, ys))], config)
+  print('G blocks, batch %d x %d frames:' % (B, G.time_steps))
+  print_table(['conditioning', 'ops', 'ms/forward'], rows)
+  check('of the fused conditioning', error, 1e-4)
+
+
+# ConvGRULinear as it ran before the input path was split out: the input
+# repeated T times and concatenated with h for both convs at every step.
+def reference_convgru(self, zy):
+  x = self.linear(zy).view(-1, self.ch0, *self.input_size)
+  cell = self.convgru.cell_list[0]
+  h = torch.zeros(x.shape[0], cell.hidden_dim, *x.shape[2:], device=x.device, dtype=x.dtype)
+  x = x.repeat(self.time, 1, 1, 1, 1).permute(1, 0, 2, 3, 4)
+  out = []
+  for t in range(self.time):
+    gamma, beta = torch.split(cell.conv_gates(torch.cat([x[:, t], h], 1)), cell.hidden_dim, 1)
+    reset_gate, update_gate = torch.sigmoid(gamma), torch.sigmoid(beta)
+    cnm = torch.tanh(cell.conv_can(torch.cat([x[:, t], reset_gate * h], 1)))
+    h = (1 - update_gate) * h + update_gate * cnm
+    out += [h]
+  return torch.stack(out, 1)
+
+# G's ConvGRU forward + backward, split input/hidden convs versus the
+# reference; outputs and the grads of the ConvGRU's params must agree
+def convgru(config):
+  G = build_G(config)
+  B = config['G_batch_size'] or config['batch_size']
+  zy = torch.randn(B, G.convgru.linear.in_features, device=device)
+  def run(setting):
+    name, fn = setting
+    G.convgru.zero_grad(set_to_none=True)
+    out = fn()
+    out.sum().backward()
+    state = (out.detach(), [param.grad.clone() for param in G.convgru.parameters()])
+    return time_paths([(name, lambda: fn().sum().backward())], config)[0], state
+  print('ConvGRU over %d steps, batch %d:' % (G.time_steps, B))
+  states = compare_settings(config, ['input path', 'ops', 'ms/step'],
+                            [('concatenated', lambda: reference_convgru(G.convgru, zy)),
+                             ('split', lambda: G.convgru(zy)[0][-1])], run,
+                            'in output', 1e-4, diff=lambda a, b: max_abs_diff(a[0], b[0]))
+  check('in param grads', max_abs_diff(states[1][1], states[0][1]), 1e-3)
+
+
+# Streaming 4 chunks of frames: the first chunk must match a plain forward,
+# and peak memory (on GPU) should not grow with the number of chunks.
+def stream_video(config):
+  G = build_G(config).eval()
+  if G.no_convgru:
+    print('G has no ConvGRU, so there is no state to stream with')
+    return
+  z_, y_ = utils.prepare_z_y(config['G_batch_size'] or config['batch_size'],
+                             G.dim_z, config['n_classes'], device=device)
+  z_.sample_()
+  y_.sample_()
+  with torch.no_grad():
+    reference = G(z_, G.shared(y_))
+  rows, frames = [], []
+  for num_chunks in [1, 4]:
+    start = time.perf_counter()
+    frames, peak = peak_memory(lambda: [frame for frame in utils.stream_video(G, z_, y_, num_chunks)])
+    elapsed = time.perf_counter() - start
+    rows += [[num_chunks, len(frames), peak, '%.1f' % (len(frames) / elapsed)]]
+  print_table(['chunks', 'frames', 'peak MB', 'frames/s'], rows)
+  check('of the first chunk', max_abs_diff(torch.stack(frames[:G.time_steps], 1), reference), 1e-5)
+
+
+# Eval-mode G versus its export_for_inference copy on CPU: ms per sample,
+# and the outputs must agree.
+def export_for_inference(config):
+  model = __import__(config['model'])
+  G = build_G(config).cpu().eval()
+  G_inference = model.export_for_inference(G)
+  B = config['G_batch_size'] or config['batch_size']
+  z = torch.randn(B, G.dim_z)
+  y = torch.randint(0, config['n_classes'], (B,))
+  with torch.no_grad():
+    error = max_abs_diff(G(z, G.shared(y)), G_inference(z, G_inference.shared(y)))
+    rows = [[name, '%.2f' % (1000 * timeit(lambda: net(z, net.shared(y)), config['num_trials']) / B)]
+            for name, net in [('Generator', G), ('exported', G_inference)]]
+  print('CPU sampling, batch %d:' % B)
+  print_table(['G', 'ms/sample'], rows)
+  check('of the exported G', error, 1e-4)
+
+
+# Forward + backward time of each block of G, D and Dv (and Dv's pooling
+# stem) on CPU, NCHW versus channels_last, or channels_last_3d for the 3D
+# blocks. Block inputs are captured from one eval-mode forward of each net,
+# and each block is timed in the default layout, then converted in place.
+def channels_last(config):
+  B, T = 2, config['time_steps']
+  nets = [net.cpu().eval() for net in build_nets(config)]
+  z = torch.randn(B, nets[0].dim_z)
+  y = torch.randint(0, config['n_classes'], (B,))
+  x = torch.randn(B, T, 3, config['resolution'], config['resolution'])
+  inputs = {'Generator': (z, nets[0].shared(y)),
+            'ImageDiscriminator': (x.view(-1, *x.shape[2:]), y.repeat_interleave(T)),
+            'VideoDiscriminator': (x, y)}
+  captured, hooks = [], []
+  for net in nets:
+    net_name = type(net).__name__
+    modules = [('%s.InitDownsample' % net_name, net.InitDownsample)] if hasattr(net, 'InitDownsample') else []
+    modules += [('%s.blocks.%d.%d' % (net_name, i, j), block)
+                for i, blocklist in enumerate(net.blocks) for j, block in enumerate(blocklist)]
+    for name, module in modules:
+      hooks += [module.register_forward_pre_hook(
+        lambda module, args, name=name: captured.append((name, module, args)))]
+    with torch.no_grad():
+      net(*inputs[net_name])
+  for hook in hooks:
+    hook.remove()
+
+  def layout(h):
+    return h.contiguous(memory_format=torch.channels_last if h.dim() == 4
+                        else torch.channels_last_3d)
+  rows, errors = [], []
+  for name, module, args in captured:
+    h = args[0].detach().contiguous().requires_grad_()
+    h_cl = layout(args[0].detach()).requires_grad_()
+    step = lambda h: module(h, *args[1:]).sum().backward()
+    with torch.no_grad():
+      reference = module(h, *args[1:])
+    default_time = timeit(lambda: step(h), config['num_trials'])
+    utils.to_channels_last(module)
+    with torch.no_grad():
+      errors += [max_abs_diff(module(h_cl, *args[1:]), reference)]
+    cl_time = timeit(lambda: step(h_cl), config['num_trials'])
+    rows += [[name, tuple(h.shape), '%.2f' % (1000 * default_time),
+              '%.2f' % (1000 * cl_time), '%.2fx' % (default_time / cl_time)]]
+  print_table(['block', 'input', 'NCHW ms', 'channels_last ms', 'speedup'], rows)
+  check('of the channels_last blocks', max(errors), 1e-4)
+
+
+# One G + D + Dv forward and backward on real and fake videos for several
+# --checkpoint settings: bytes autograd saves, peak memory on GPU and time per
+# step. The gradients and SN's u must match no checkpointing; every setting
+# starts from the same weights and RNG state.
+def checkpointing(config):
+  z, y, x = random_batch(config)
+  def run(setting):
+    nets = build_nets({**config, 'checkpoint': setting})
+    GD = build_GD(config, nets)
+    def step():
+      utils.seed_rng(config['seed'])
+      for net in nets:
+        net.zero_grad(set_to_none=True)
+      GD_backward(GD, config, z, y, x, train_G=True)
+    (_, saved), peak = peak_memory(lambda: saved_bytes(step))
+    state = [item.detach().clone() for net in nets for param in net.parameters()
+             for item in [param.grad] if item is not None]
+    state += [module.u[0].clone() for net in nets for module in net.modules()
+              if isinstance(module, layers.SN)]
+    elapsed = timeit(step, config['num_trials'], warmup=1)
+    return [setting or 'none', '%.1f' % (saved / 1e6), peak, '%.1f' % (1000 * elapsed)], state
+  print('G + D + Dv step, batch %d, %d frames:' % (config['batch_size'], config['time_steps']))
+  compare_settings(config, ['checkpoint', 'saved MB', 'peak MB', 'ms/step'],
+                   ['', 'attn', 'G', 'G_attn', 'D_Dv', 'G_D_Dv_attn'], run,
+                   'of grads and SN u', 1e-4)
+
+
+# One G + D + Dv forward and backward under each --amp setting against fp32:
+# bytes saved for backward, peak memory on GPU, time per step, the dtypes of
+# the buffers, and the max difference of D's and Dv's outputs and of G's
+# output frames. bf16 runs on CPU; fp16 only on GPU. Every setting starts from
+# the same weights.
+def amp(config):
+  z, y, x = random_batch(config)
+  def run(setting):
+    nets = build_nets(config)
+    GD = build_GD(config, nets, amp_dtype=utils.amp_dtype_dict[setting])
+    def step():
+      utils.seed_rng(config['seed'])
+      for net in nets:
+        net.zero_grad(set_to_none=True)
+      return GD_backward(GD, config, z, y, x, train_G=True)
+    (outs, saved), peak = peak_memory(lambda: saved_bytes(step))
+    # SN vectors and BN running stats must have stayed fp32
+    dtypes = set(buffer.dtype for net in nets for buffer in net.buffers()
+                 if buffer.is_floating_point())
+    elapsed = timeit(step, config['num_trials'], warmup=1)
+    return ([setting or 'fp32', '%.1f' % (saved / 1e6), peak, '%.1f' % (1000 * elapsed),
+             ','.join(sorted(str(item)[6:] for item in dtypes))],
+            [item.detach() for item in outs])
+  print('G + D + Dv step, batch %d, %d frames:' % (config['batch_size'], config['time_steps']))
+  compare_settings(config, ['amp', 'saved MB', 'peak MB', 'ms/step', 'buffers', 'max abs diff'],
+                   ['', 'bf16'] + (['fp16'] if device == 'cuda' else []), run)
+
+
+# Adam16.step as it was before the multi-tensor update: one parameter at a
+# time, reassigning p.data to a fresh half copy of the master weights.
+def reference_adam16_step(self):
+  for group in self.param_groups:
+    for p in group['params']:
+      if p.grad is None:
+        continue
+      grad = p.grad.data.float()
+      state = self.state[p]
+      if len(state) == 0:
+        state['step'] = 0
+        state['exp_avg'] = grad.new().resize_as_(grad).zero_()
+        state['exp_avg_sq'] = grad.new().resize_as_(grad).zero_()
+        state['fp32_p'] = p.data.float()
+      exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+      beta1, beta2 = group['betas']
+      state['step'] += 1
+      if group['weight_decay'] != 0:
+        grad = grad.add(state['fp32_p'], alpha=group['weight_decay'])
+      exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+      exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+      denom = exp_avg_sq.sqrt().add_(group['eps'])
+      bias_correction1 = 1 - beta1 ** state['step']
+      bias_correction2 = 1 - beta2 ** state['step']
+      step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+      state['fp32_p'].addcdiv_(exp_avg, denom, value=-step_size)
+      p.data = state['fp32_p'].half()
+
+
+# Adam16 steps over the fp16 parameters of G, D and Dv, per-parameter loop
+# versus multi-tensor: ops dispatched and time per step, and the master
+# weights must agree after the timed steps.
+def adam16(config):
+  params = [[p.detach().half().requires_grad_() for net in build_nets(config)
+             for p in net.parameters()] for _ in range(2)]
+  for grads in zip(*params):
+    grads[0].grad = torch.randn_like(grads[0])
+    grads[1].grad = grads[0].grad.clone()
+  optims = [utils.Adam16(item, lr=1e-4, betas=(0.0, 0.999), weight_decay=1e-5)
+            for item in params]
+  rows = time_paths([('loop', lambda: reference_adam16_step(optims[0])),
+                     ('foreach', optims[1].step)], config)
+  print('Adam16 over %d params (%.1fM values):'
+        % (len(params[0]), sum(p.numel() for p in params[0]) / 1e6))
+  print_table(['step', 'ops', 'ms/step'], rows)
+  check('of the master weights', max_abs_diff([optims[0].state[p]['fp32_p'] for p in params[0]],
+                                              [optims[1].state[p]['fp32_p'] for p in params[1]]), 1e-5)
+
+
+# utils.ema.update as it was: every state_dict entry, buffers included,
+# blended through two temporaries and copied back.
+def reference_ema_update(self, itr=None):
+  decay = 0.0 if itr and itr < self.start_itr else self.decay
+  with torch.no_grad():
+    for key in self.source_dict:
+      self.target_dict[key].copy_(self.target_dict[key] * decay
+                                  + self.source_dict[key] * (1 - decay))
+
+# Reset G to initial and call update(itr) after each of num_itrs random
+# steps of its params; returns the time spent in update
+def ema_run(config, G, initial, update, num_itrs):
+  G.load_state_dict(initial)
+  utils.seed_rng(config['seed'])
+  elapsed = 0.
+  for itr in range(1, num_itrs + 1):
+    with torch.no_grad():
+      for param in G.parameters():
+        param.add_(torch.randn_like(param), alpha=1e-2)
+    start = time.perf_counter()
+    update(itr)
+    elapsed += time.perf_counter() - start
+  return elapsed
+
+
+# Cost of one EMA update of G, the per-key loop versus the foreach update
+# (every step, and every 4 steps). After the same run of perturbed source
+# weights, the foreach average must match the loop's; every 4 steps' is shown.
+def ema(config):
+  G = build_G(config)
+  targets = [build_G(config) for _ in range(3)]
+  emas = [utils.ema(G, target, config['ema_decay'], update_every=every)
+          for target, every in zip(targets, [1, 1, 4])]
+  updates = [('loop', lambda itr: reference_ema_update(emas[0], itr)),
+             ('foreach', emas[1].update),
+             ('foreach, every 4', emas[2].update)]
+  initial = copy.deepcopy(G.state_dict())
+  for _, update in updates:
+    ema_run(config, G, initial, update, 8)
+  error, every_error = [max_abs_diff(list(targets[0].parameters()), list(target.parameters()))
+                        for target in targets[1:]]
+  rows = time_paths([(name, lambda update=update: update(None)) for name, update in updates],
+                    config, digits=3)
+  print('EMA update of G:')
+  print_table(['update', 'ops', 'ms/update'], rows)
+  print('Max abs difference of the params averaged every 4 steps: %.3g' % every_error)
+  check('of the foreach averaged params', error, 1e-5)
+
+
+# The offloaded EMA against utils.ema over the same run of perturbed G
+# weights, updating every 2 steps: time the training thread spends in
+# update(), bytes of G_ema kept on the training device, and the averaged
+# params and buffers must agree.
+def offloaded_ema(config):
+  G = build_G(config)
+  emas = [utils.ema(G, build_G(config), config['ema_decay'], update_every=2),
+          utils.offloaded_ema(G, build_G(config), config['ema_decay'], update_every=2)]
+  initial = copy.deepcopy(G.state_dict())
+  rows = []
+  for name, item in zip(['synchronous', 'offloaded'], emas):
+    elapsed = ema_run(config, G, initial, item.update, 12)
+    on_device = sum(tensor.numel() * tensor.element_size() for tensor in item.target_dict.values()
+                    if tensor.device.type == device)
+    rows += [[name, '%.3f' % (1000 * elapsed / 6), '%.1f' % (on_device / 1e6)]]
+  G_ema = emas[1].materialize(device)
+  print('EMA of G, updated every 2 of 12 steps:')
+  print_table(['EMA', 'ms/update', 'MB on %s' % device], rows)
+  check('of the EMA weights and buffers', max_abs_diff(list(emas[0].target.state_dict().values()),
+                                                       list(G_ema.state_dict().values())), 1e-5)
+
+
+# utils.ortho as it was: one eye and two matmuls per parameter
+def reference_ortho(model, strength=1e-4, blacklist=[]):
+  with torch.no_grad():
+    for param in model.parameters():
+      if len(param.shape) < 2 or any([param is item for item in blacklist]):
+        continue
+      w = param.reshape(param.shape[0], -1)
+      grad = (2 * torch.mm(torch.mm(w, w.t())
+              * (1. - torch.eye(w.shape[0], device=w.device)), w))
+      param.grad.data += strength * grad.view(param.shape)
+
+
+# Modified ortho reg on G, D and Dv, per parameter versus batched by shape:
+# ops and time per call, and the resulting grads must agree.
+def ortho(config):
+  rows, errors = [], []
+  for net in build_nets(config):
+    for param in net.parameters():
+      param.grad = torch.zeros_like(param)
+    reference_ortho(net, config['G_ortho'] or 1e-4)
+    expected = [param.grad.clone() for param in net.parameters()]
+    for param in net.parameters():
+      param.grad.zero_()
+    utils.ortho(net, config['G_ortho'] or 1e-4)
+    errors += [(type(net).__name__, max_abs_diff([param.grad for param in net.parameters()], expected))]
+    times = time_paths([('loop', lambda: reference_ortho(net)),
+                        ('batched', lambda: utils.ortho(net))], config)
+    rows += [[type(net).__name__, len(utils.ortho_groups(net)), times[0][1], times[1][1],
+              times[0][2], times[1][2]]]
+  print_table(['net', 'groups', 'loop ops', 'batched ops', 'loop ms', 'batched ms'], rows)
+  for name, error in errors:
+    check('of %s ortho grads' % name, error, 1e-6)
+
+
+# A few GAN iterations (num_D_steps D steps, then a G step, with Adam) under
+# several SN update schedules: time per iteration, and how far the singular
+# values logged by utils.get_SVs end up from updating in every forward.
+def sn_update(config):
+  z, y, x = random_batch(config)
+  def run(setting):
+    name, every, per_step = setting
+    nets = build_nets(config)
+    named = dict(zip(['G', 'D', 'Dv'], nets))
+    schedule = layers.SNSchedule(named, every, per_step) if every > 1 or per_step else None
+    GD = build_GD(config, nets)
+    optims = {key: torch.optim.Adam(net.parameters(), lr=1e-4, betas=(0.0, 0.999))
+              for key, net in named.items()}
+    itr = [0]
+    def iteration():
+      itr[0] += 1
+      for _ in range(config['num_D_steps']):
+        if schedule is not None:
+          schedule.prepare(itr[0], ['D', 'Dv'])
+        GD_backward(GD, config, z, y, x)
+        for key in ['D', 'Dv']:
+          if key in optims:
+            optims[key].step()
+            optims[key].zero_grad(set_to_none=True)
+      if schedule is not None:
+        schedule.prepare(itr[0], ['G'])
+      GD_backward(GD, config, z, y)
+      optims['G'].step()
+      for optim in optims.values():
+        optim.zero_grad(set_to_none=True)
+    elapsed = timeit(iteration, config['num_trials'], warmup=0)
+    svs = {}
+    for key, net in named.items():
+      svs.update(utils.get_SVs(net, key))
+    return [name, '%.1f' % (1000 * elapsed)], svs
+  print('%d GAN iterations with %d D steps:' % (config['num_trials'], config['num_D_steps']))
+  compare_settings(config, ['SN update', 'ms/itr', 'max rel diff of logged SVs'],
+                   [('every forward', 1, False), ('every 4 itrs', 4, False),
+                    ('per optimizer step', 1, True)], run,
+                   diff=lambda svs, reference: max(abs(svs[key] - reference[key]) / abs(reference[key])
+                                                   for key in svs))
+
+
+# One GAN iteration that runs G again for the G step against one that reuses
+# G's output from the last D step: time per iteration and peak memory on GPU.
+# Both train G on the last D step's z and y, and both advance SN once per
+# optimizer step, so G's gradients must agree up to nondeterminism.
+def reuse_G_forward(config):
+  z, y, x = random_batch(config)
+  def run(reuse):
+    nets = build_nets(config)
+    named = dict(zip(['G', 'D', 'Dv'], nets))
+    schedule = layers.SNSchedule(named, 1, True)
+    GD = build_GD(config, nets)
+    initial = [copy.deepcopy(net.state_dict()) for net in nets]
+    def iteration():
+      for net, state in zip(nets, initial):
+        net.load_state_dict(state)
+      optims = {key: torch.optim.Adam(net.parameters(), lr=1e-4, betas=(0.0, 0.999))
+                for key, net in named.items() if key != 'G'}
+      for net in nets:
+        net.zero_grad(set_to_none=True)
+      for step_index in range(config['num_D_steps']):
+        keep_G = reuse and step_index == config['num_D_steps'] - 1
+        schedule.prepare(1, ['D', 'Dv'] + (['G'] if keep_G else []))
+        outs = GD_backward(GD, config, z, y, x, train_G=keep_G, detach_G_z=keep_G)
+        for optim in optims.values():
+          optim.step()
+          optim.zero_grad(set_to_none=True)
+      schedule.prepare(1, [] if reuse else ['G'])
+      GD_backward(GD, config, z, y, G_z=outs[-1] if reuse else None)
+    _, peak = peak_memory(iteration)
+    grads = [param.grad.detach().clone() for param in nets[0].parameters()
+             if param.grad is not None]
+    elapsed = timeit(iteration, config['num_trials'], warmup=1)
+    return ['reuse' if reuse else 'rerun G', '%.1f' % (1000 * elapsed), peak], grads
+  print('GAN iteration with %d D steps, batch %d, %d frames:'
+        % (config['num_D_steps'], config['batch_size'], config['time_steps']))
+  compare_settings(config, ['G step', 'ms/itr', 'peak MB'], [False, True], run,
+                   'of G grads', 1e-4)
+
+
+# GAN iterations whose D passes draw fakes from a FakeReplayBuffer, on device
+# or in host memory, against always running G: time per iteration, the share
+# of D passes that skipped G, and the speed-up over always running G.
+def fake_replay(config):
+  _, y, x = random_batch(config)
+  utils.seed_rng(config['seed'])
+  nets = build_nets(config)
+  named = dict(zip(['G', 'D', 'Dv'], nets))
+  GD = build_GD(config, nets)
+  optims = {key: torch.optim.Adam(net.parameters(), lr=1e-4, betas=(0.0, 0.999))
+            for key, net in named.items()}
+  z_, y_ = utils.prepare_z_y(config['batch_size'], config['dim_z'], config['n_classes'],
+                             device=device)
+  rows, baseline = [], None
+  for name, replay in [('off', None),
+                       ('device', utils.FakeReplayBuffer(config['fake_replay_size'] or 4,
+                                                         config['fake_replay_max_age'],
+                                                         config['fake_replay_prob'])),
+                       ('host', utils.FakeReplayBuffer(config['fake_replay_size'] or 4,
+                                                       config['fake_replay_max_age'],
+                                                       config['fake_replay_prob'], offload=True))]:
+    itr = [0]
+    def iteration():
+      itr[0] += 1
+      for _ in range(config['num_D_steps']):
+        replayed = replay.draw(itr[0]) if replay is not None else None
+        if replayed is None:
+          z_.sample_()
+          y_.sample_()
+        G_z, gy = (None, y_) if replayed is None else replayed
+        outs = GD_backward(GD, config, z_, gy, x, y, G_z=G_z)
+        if replay is not None and replayed is None:
+          replay.add(outs[-1], gy, itr[0])
+        for key in ['D', 'Dv']:
+          if key in optims:
+            optims[key].step()
+            optims[key].zero_grad(set_to_none=True)
+      z_.sample_()
+      y_.sample_()
+      GD_backward(GD, config, z_, y_)
+      optims['G'].step()
+      for optim in optims.values():
+        optim.zero_grad(set_to_none=True)
+    elapsed = timeit(iteration, config['num_trials'])
+    if baseline is None:
+      baseline = elapsed
+    hits = '%.2f' % replay.hit_ratio() if replay is not None else '-'
+    rows += [[name, '%.1f' % (1000 * elapsed), hits, '%.2fx' % (baseline / elapsed)]]
+  print('GAN iterations with %d D steps, batch %d, %d frames, replay prob %.2f, '
+        'max age %d:' % (config['num_D_steps'], config['batch_size'], config['time_steps'],
+                         config['fake_replay_prob'], config['fake_replay_max_age']))
+  print_table(['fake replay', 'ms/itr', 'hit ratio', 'speed-up'], rows)
+
+
+# One process's share of a cross-replica bn forward and backward against the
+# same bn over the whole batch in a single process. Returns the table rows and
+# the checks for the parent process to report.
+def dist_bn_worker(rank, world_size, config):
+  C, H, B = config['G_ch'], config['resolution'], config['batch_size']
+  torch.manual_seed(config['seed'])
+  x = torch.randn(world_size * B, C, H, H) * 3 + 1
+  weight = torch.randn(x.shape)
+  rows, checks = [], []
+  for name, cross_replica in [('distBN', True), ('local', False)]:
+    module = layers.bn(C, cross_replica=cross_replica)
+    reference = layers.bn(C)
+    x_full = x.clone().requires_grad_()
+    (reference(x_full) * weight).sum().backward()
+    x_local = x[rank * B:(rank + 1) * B].clone().requires_grad_()
+    def step():
+      module.zero_grad(set_to_none=True)
+      x_local.grad = None
+      out = module(x_local)
+      (out * weight[rank * B:(rank + 1) * B]).sum().backward()
+      return out
+    out = step()
+    # Summed over processes, the gain and bias grads are the full batch's
+    grads = torch.cat([module.gain.grad, module.bias.grad])
+    torch.distributed.all_reduce(grads)
+    out_error = max_abs_diff(out, reference(x_full)[rank * B:(rank + 1) * B])
+    grad_error = max_abs_diff([x_local.grad, grads],
+                              [x_full.grad[rank * B:(rank + 1) * B],
+                               torch.cat([reference.gain.grad, reference.bias.grad])])
+    elapsed = timeit(step, config['num_trials'])
+    rows += [[name, '%.2f' % (1000 * elapsed), '%.3g' % out_error, '%.3g' % grad_error]]
+    # Local bn is shown for scale; only distBN has to match the full batch
+    if cross_replica:
+      checks += [('of distBN outputs', out_error, 1e-4), ('of distBN grads', grad_error, 1e-4)]
+  return rows, checks
+
+# layers.bn with --cross_replica under torch.distributed, in 2 gloo processes
+# on CPU, against the same bn in one process over both processes' batches,
+# and against plain per-process bn
+def dist_bn(config):
+  rows, checks = run_gloo(dist_bn_worker, config)
+  print('bn over 2 x %d samples, %d channels, %dx%d:'
+        % (config['batch_size'], config['G_ch'], config['resolution'], config['resolution']))
+  print_table(['bn', 'ms/step', 'max abs diff out', 'max abs diff grads'], rows)
+  for item in checks:
+    check(*item)
+
+
+# One process's GAN steps under each DDP comm hook and bucket size, counting
+# the bytes it hands to all_reduce. Without a hook, DDP's all_reduce runs in
+# C++ where it can't be counted, so the baseline is the equivalent Python
+# allreduce_hook.
+def comm_hooks_worker(rank, world_size, config):
+  from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+  torch.manual_seed(config['seed'] + rank)
+  z, y, x = random_batch(config)
+  sent = [0]
+  all_reduce = torch.distributed.all_reduce
+  def counting_all_reduce(tensor, *args, **kwargs):
+    sent[0] += tensor.numel() * tensor.element_size()
+    return all_reduce(tensor, *args, **kwargs)
+  torch.distributed.all_reduce = counting_all_reduce
+  rows = []
+  for hook in ['', 'fp16', 'bf16', 'powerSGD']:
+    for bucket_cap_mb in [1, config['bucket_cap_mb']]:
+      utils.seed_rng(config['seed'])
+      nets = build_nets(config)
+      GD = build_GD(config, nets)
+      hooks = {name: utils.comm_hook(hook, config['powerSGD_rank'], 2)
+                     or (None, default_hooks.allreduce_hook)
+               for name in ['G', 'D', 'Dv']}
+      GD.distribute(None, hooks, bucket_cap_mb=bucket_cap_mb)
+      def step():
+        for net in nets:
+          net.zero_grad(set_to_none=True)
+        GD_backward(GD, config, z, y, x)
+        GD_backward(GD, config, z, y)
+      elapsed = timeit(step, config['num_trials'])
+      sent[0] = 0
+      step()
+      rows += [[hook or 'fp32', bucket_cap_mb, '%.2f' % (sent[0] / 1e6),
+                '%.1f' % (1000 * elapsed)]]
+  torch.distributed.all_reduce = all_reduce
+  return rows
+
+# A D step and a G step (D and Dv, then G, communicate their grads) under
+# each DDP comm hook and bucket size, in 2 gloo processes on CPU: MB handed
+# to all_reduce per process, and time per step
+def comm_hooks(config):
+  rows = run_gloo(comm_hooks_worker, config)
+  print('D step + G step over 2 gloo processes, batch %d, %d frames, PowerSGD rank %d:'
+        % (config['batch_size'], config['time_steps'], config['powerSGD_rank']))
+  print_table(['comm hook', 'bucket MB', 'MB sent', 'ms/step'], rows)
+
+
+# Optimizer state bytes of a process, over all of its tensors
+def optim_state_bytes(optim):
+  local = optim.optim if hasattr(optim, 'consolidate_state_dict') else optim
+  return sum(item.numel() * item.element_size() for state in local.state.values()
+             for item in state.values() if torch.is_tensor(item))
+
+# One process's G + D + Dv training steps with full and with sharded
+# optimizers. Returns the table rows, and the check that G's weights after 3
+# steps agree for the parent process to report.
+def zero_optim_worker(rank, world_size, config):
+  torch.manual_seed(config['seed'] + rank)
+  z, y, x = random_batch(config)
+  rows, weights = [], []
+  for sharded in [False, True]:
+    utils.seed_rng(config['seed'])
+    nets = build_nets(config, no_optim=False)
+    if sharded:
+      for net in nets:
+        utils.shard_optimizer(net)
+    GD = build_GD(config, nets).distribute()
+    def step():
+      for net in nets:
+        net.optim.zero_grad()
+      GD_backward(GD, config, z, y, x)
+      GD_backward(GD, config, z, y)
+      for net in nets:
+        net.optim.step()
+    for _ in range(3):
+      step()
+    weights += [[param.detach().clone() for param in nets[0].parameters()]]
+    state = sum(optim_state_bytes(net.optim) for net in nets)
+    elapsed = timeit(step, config['num_trials'])
+    rows += [['ZeRO-1' if sharded else 'full', '%.2f' % (state / 1e6),
+              '%.1f' % (1000 * elapsed)]]
+  return rows, [('of G after 3 ZeRO-1 steps', max_abs_diff(weights[1], weights[0]), 1e-5)]
+
+# Optimizer state per process and step time of full against --zero_optim
+# sharded optimizers, in 2 gloo processes on CPU; G's weights after 3 steps
+# must agree
+def zero_optim(config):
+  rows, checks = run_gloo(zero_optim_worker, config)
+  print('G + D + Dv steps over 2 gloo processes, batch %d, %d frames:'
+        % (config['batch_size'], config['time_steps']))
+  print_table(['optimizer', 'state MB/process', 'ms/step'], rows)
+  for item in checks:
+    check(*item)
+
+
+# A short GAN run of G, D and Dv with Adam against Adam8bit from the same
+# weights and data: optimizer state size, time per iteration, the hinge
+# losses averaged over the last quarter of the run, and how far G's weights
+# moved apart. Runs on CPU unless a GPU is available.
+def adam8bit(config):
+  _, y, x = random_batch(config)
+  z_, y_ = utils.prepare_z_y(config['batch_size'], config['dim_z'], config['n_classes'],
+                             device=device)
+  num_itrs = 4 * max(config['num_trials'] // 4, 1)
+  def run(quantized):
+    nets = build_nets(config, no_optim=False, G_adam8bit=quantized, D_adam8bit=quantized)
+    GD = build_GD(config, nets)
+    D_losses, G_losses = [], []
+    start = time.perf_counter()
+    for itr in range(num_itrs):
+      for net in nets[1:]:
+        net.optim.zero_grad()
+      z_.sample_()
+      y_.sample_()
+      outs = GD(z_, y_, x, y, train_G=False, split_D=config['split_D'])
+      D_loss = sum(F.relu(1. + fake).mean() + F.relu(1. - real).mean()
+                   for fake, real in zip(outs[:-1:2], outs[1:-1:2]))
+      D_loss.backward()
+      for net in nets[1:]:
+        net.optim.step()
+      nets[0].optim.zero_grad()
+      z_.sample_()
+      y_.sample_()
+      outs = GD(z_, y_, train_G=True, split_D=config['split_D'])
+      G_loss = -sum(out.mean() for out in outs[:-1])
+      G_loss.backward()
+      nets[0].optim.step()
+      D_losses += [D_loss.item()]
+      G_losses += [G_loss.item()]
+    elapsed = (time.perf_counter() - start) / num_itrs
+    state = sum(optim_state_bytes(net.optim) for net in nets)
+    return (['8-bit' if quantized else 'fp32', '%.2f' % (state / 1e6),
+             '%.1f' % (1000 * elapsed), '%.4f' % np.mean(D_losses[-num_itrs // 4:]),
+             '%.4f' % np.mean(G_losses[-num_itrs // 4:])],
+            [param.detach().clone() for param in nets[0].parameters()])
+  print('%d GAN iterations, batch %d, %d frames:'
+        % (num_itrs, config['batch_size'], config['time_steps']))
+  compare_settings(config, ['adam moments', 'state MB', 'ms/itr', 'D loss', 'G loss',
+                            'max rel diff of G'], [False, True], run,
+                   diff=lambda weights, reference: max(
+                     ((a - b).norm() / b.norm().clamp(min=1e-12)).item()
+                     for a, b in zip(weights, reference)))
+
+
+benchmarks = {'clip_store': clip_store, 'sn_cache': sn_cache, 'sn_batched': sn_batched,
+              'attention': attention, 'attention_chunked': attention_chunked,
+              'axial_attention': axial_attention, 'ccbn_conditioning': ccbn_conditioning,
+              'convgru': convgru, 'stream_video': stream_video,
+              'export_for_inference': export_for_inference,
+              'channels_last': channels_last, 'checkpointing': checkpointing,
+              'amp': amp, 'adam16': adam16,
+              'ema': ema, 'offloaded_ema': offloaded_ema,
+              'ortho': ortho, 'sn_update': sn_update,
+              'reuse_G_forward': reuse_G_forward, 'fake_replay': fake_replay,
+              'dist_bn': dist_bn, 'comm_hooks': comm_hooks,
+              'zero_optim': zero_optim, 'adam8bit': adam8bit}
+
+
+def run(config):
+  config = prepare_config(config)
+  utils.seed_rng(config['seed'])
+  which = config['which'].split(',') if config['which'] else list(benchmarks)
+  for name in which:
+    print('=== %s ===' % name)
+    benchmarks[name](config)
+  if failed_checks:
+    print('Failed checks: %s' % ', '.join(failed_checks))
+    if config['check']:
+      sys.exit(1)
+
+
+def main():
+  # parse command line and run
+  parser = utils.prepare_parser()
+  parser = add_benchmark_parser(parser)
+  config = vars(parser.parse_args())
+  print(config)
+  run(config)
+
+if __name__ == '__main__':
+  main()
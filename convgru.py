@@ -1,7 +1,7 @@
 import os
 import torch
 from torch import nn
-from torch.autograd import Variable
+import torch.nn.functional as F
 
 
 class ConvGRUCell(nn.Module):
@@ -40,12 +40,28 @@ class ConvGRUCell(nn.Module):
                               padding=self.padding,
                               bias=self.bias)
 
-    def init_hidden(self, batch_size):
-        hidden_state = Variable(torch.zeros(batch_size, self.hidden_dim, self.height, self.width)).type(self.dtype)
-        # print("hidden state's device", hidden_state.get_device())
-        return hidden_state
+    def init_hidden(self, batch_size, device=None, dtype=None):
+        """
+        Zero hidden state on the given device and dtype, those of the input
+        """
+        return torch.zeros(batch_size, self.hidden_dim, self.height, self.width,
+                           device=device, dtype=dtype)
+
+    def input_conv(self, input_tensor):
+        """
+        The input half of conv_gates and conv_can, with their biases, as one conv.
+        conv([x, h]) equals conv_x(x) + conv_h(h), so this only needs to run once
+        per input, however many steps reuse it.
+        :param input_tensor: (b, c, h, w)
+        :return: gates_x (b, 2*c_hidden, h, w), can_x (b, c_hidden, h, w)
+        """
+        input_dim = input_tensor.size(1)
+        weight = torch.cat([self.conv_gates.weight[:, :input_dim], self.conv_can.weight[:, :input_dim]])
+        bias = torch.cat([self.conv_gates.bias, self.conv_can.bias]) if self.bias else None
+        input_conv = F.conv2d(input_tensor, weight, bias, padding=self.padding)
+        return torch.split(input_conv, [2 * self.hidden_dim, self.hidden_dim], dim=1)
 
-    def forward(self, input_tensor, h_cur):
+    def forward(self, input_tensor, h_cur, input_conv=None):
         """
 
         :param self:
@@ -53,19 +69,22 @@ class ConvGRUCell(nn.Module):
             input is actually the target_model
         :param h_cur: (b, c_hidden, h, w)
             current hidden and cell states respectively
+        :param input_conv: (gates_x, can_x) from input_conv(input_tensor), if already computed
         :return: h_next,
             next hidden state
         """
-#         print(input_tensor.shape,h_cur.shape)
-        combined = torch.cat([input_tensor, h_cur], dim=1)
-        combined_conv = self.conv_gates(combined)
+        gates_x, can_x = self.input_conv(input_tensor) if input_conv is None else input_conv
+        # Only the hidden half of the convs depends on the step
+        input_dim = self.conv_gates.weight.size(1) - self.hidden_dim
+        combined_conv = gates_x + F.conv2d(h_cur, self.conv_gates.weight[:, input_dim:],
+                                           padding=self.padding)
 
         gamma, beta = torch.split(combined_conv, self.hidden_dim, dim=1)
         reset_gate = torch.sigmoid(gamma)
         update_gate = torch.sigmoid(beta)
 
-        combined = torch.cat([input_tensor, reset_gate*h_cur], dim=1)
-        cc_cnm = self.conv_can(combined)
+        cc_cnm = can_x + F.conv2d(reset_gate*h_cur, self.conv_can.weight[:, input_dim:],
+                                  padding=self.padding)
         cnm = torch.tanh(cc_cnm)
 
         h_next = (1 - update_gate) * h_cur + update_gate * cnm
@@ -129,37 +148,56 @@ class ConvGRU(nn.Module):
         # convert python list to pytorch module
         self.cell_list = nn.ModuleList(cell_list)
 
-    def forward(self, input_tensor, hidden_state=None):
+    def forward(self, input_tensor, hidden_state=None, seq_len=None, return_all_states=False):
         """
 
         :param input_tensor: (b, t, c, h, w) or (t,b,c,h,w) depends on if batch first or not
             extracted features from alexnet
-        :param hidden_state:
+            or (b, c, h, w), the same input at each of seq_len steps
+        :param hidden_state: list with each layer's (b, c_hidden, h, w) state to start
+            from, or the last_state_list of a previous call, to continue a sequence
+        :param seq_len: int, number of steps for a (b, c, h, w) input
+        :param return_all_states: bool, return every layer's last state even
+            without return_all_layers, so that it can be passed back in
         :return: layer_output_list, last_state_list
         """
-        if not self.batch_first:
+        if input_tensor.dim() == 5 and not self.batch_first:
             # (t, b, c, h, w) -> (b, t, c, h, w)
             input_tensor = input_tensor.permute(1, 0, 2, 3, 4)
 
-        # Implement stateful ConvLSTM
+        # Stateful ConvGRU: start from the given states, or from zeros
         if hidden_state is not None:
-            raise NotImplementedError()
+            hidden_state = [h[0] if isinstance(h, (list, tuple)) else h for h in hidden_state]
+            if len(hidden_state) != self.num_layers:
+                raise ValueError('hidden_state has %d layer states, the ConvGRU has %d layers; '
+                                 'pass back the last_state_list of a call with return_all_states=True'
+                                 % (len(hidden_state), self.num_layers))
         else:
-            hidden_state = self._init_hidden(batch_size=input_tensor.size(0))
+            hidden_state = self._init_hidden(batch_size=input_tensor.size(0),
+                                             device=input_tensor.device, dtype=input_tensor.dtype)
 
         layer_output_list = []
         last_state_list   = []
 
-        seq_len = input_tensor.size(1)
+        if input_tensor.dim() == 5:
+            seq_len = input_tensor.size(1)
         cur_layer_input = input_tensor
 
         for layer_idx in range(self.num_layers):
             h = hidden_state[layer_idx]
+            cell = self.cell_list[layer_idx]
+            # The input half of the convs runs once for all steps, either on the
+            # constant input or on all t frames of the previous layer's output
+            if cur_layer_input.dim() == 4:
+                input_conv = [cell.input_conv(cur_layer_input)] * seq_len
+            else:
+                b, t = cur_layer_input.shape[:2]
+                input_conv = list(zip(*[item.view(b, t, *item.shape[1:]).unbind(1) for item in
+                                        cell.input_conv(cur_layer_input.reshape(b * t, *cur_layer_input.shape[2:]))]))
             output_inner = []
             for t in range(seq_len):
                 # input current hidden and cell state then compute the next hidden and cell state through ConvLSTMCell forward function
-                h = self.cell_list[layer_idx](input_tensor=cur_layer_input[:, t, :, :, :], # (b,t,c,h,w)
-                                              h_cur=h)
+                h = cell(input_tensor=None, h_cur=h, input_conv=input_conv[t])
                 output_inner.append(h)
 
             layer_output = torch.stack(output_inner, dim=1)
@@ -172,14 +210,15 @@ class ConvGRU(nn.Module):
 
         if not self.return_all_layers:
             layer_output_list = layer_output_list[-1:]
-            last_state_list   = last_state_list[-1:]
+            if not return_all_states:
+                last_state_list = last_state_list[-1:]
 
         return layer_output_list, last_state_list
 
-    def _init_hidden(self, batch_size):
+    def _init_hidden(self, batch_size, device=None, dtype=None):
         init_states = []
         for i in range(self.num_layers):
-            init_states.append(self.cell_list[i].init_hidden(batch_size))
+            init_states.append(self.cell_list[i].init_hidden(batch_size, device, dtype))
         return init_states
 
     @staticmethod
@@ -212,11 +251,13 @@ class ConvGRULinear(nn.Module):
                                 bias = bias,
                                 return_all_layers = return_all_layers)
         self.linear = nn.Linear(noise_size, self.ch0*self.input_size[0]*self.input_size[1],bias=linearBias)
-    def forward(self, input_vectors):
+    def forward(self, input_vectors, hidden_state=None, return_all_states=False):
         output_vectors=self.linear(input_vectors)
         # print('ch0,input_size',self.ch0,self.input_size)
         # print('output vectors shape', output_vectors.shape)
-        input_features=(output_vectors.view(-1,self.ch0,*self.input_size)).repeat(self.time,1,1,1,1).permute(1,0,2,3,4)
+        # The same features feed every step; ConvGRU convolves them once
+        input_features=output_vectors.view(-1,self.ch0,*self.input_size)
         # print('input features shape', input_features.shape)
-        layer_output_list, last_state_list = self.convgru(input_features)
+        layer_output_list, last_state_list = self.convgru(input_features, hidden_state, seq_len=self.time,
+                                                          return_all_states=return_all_states)
         return layer_output_list, last_state_list
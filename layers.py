@@ -1,6 +1,8 @@
 ''' Layers
     This file contains various layers for the BigGAN models.
 '''
+import math
+import threading
 import numpy as np
 import torch
 import torch.nn as nn
@@ -8,6 +10,7 @@ from torch.nn import init
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.nn import Parameter as P
+from torch.utils.checkpoint import checkpoint
 
 from sync_batchnorm import SynchronizedBatchNorm2d as SyncBN2d
 
@@ -50,12 +53,52 @@ def power_iteration(W, u_, update=True, eps=1e-12):
   return svs, us, vs
 
 
+# Gram-Schmidt for stacks of row vectors; x and each of ys are [L, 1, n]
+def batched_gram_schmidt(x, ys):
+  for y in ys:
+    x = x - (x * y).sum(-1, keepdim=True) / (y * y).sum(-1, keepdim=True) * y
+  return x
+
+
+# Copy a list of tensors into another in as few launches as available
+def foreach_copy_(targets, sources):
+  if hasattr(torch, '_foreach_copy_'):
+    torch._foreach_copy_(targets, sources)
+  else:
+    for target, source in zip(targets, sources):
+      target.copy_(source)
+
+
+# targets += weight * (sources - targets) over lists of tensors, in place
+def foreach_lerp_(targets, sources, weight):
+  if hasattr(torch, '_foreach_lerp_'):
+    torch._foreach_lerp_(targets, sources, weight)
+  else:
+    torch._foreach_mul_(targets, 1 - weight)
+    torch._foreach_add_(targets, sources, alpha=weight)
+
+
+# Autocast switched off, for the parts of a forward that stay in fp32 under
+# --amp (SN's power iteration and sigma)
+def fp32_region(tensor):
+  return torch.autocast(tensor.device.type, enabled=False)
+
+
 # Convenience passthrough function
 class identity(nn.Module):
   def forward(self, input):
     return input
 
 
+# Set while a checkpointed block re-runs its forward during backward, so
+# layers with training side effects (SN power iterations, BN running stats)
+# don't apply them a second time; see checkpoint_module.
+_recompute = threading.local()
+
+def recomputing():
+  return getattr(_recompute, 'active', False)
+
+
 # Spectral normalization base class
 class SN(object):
   def __init__(self, num_svs, num_itrs, num_outputs, transpose=False, eps=1e-12):
@@ -71,6 +114,18 @@ class SN(object):
     for i in range(self.num_svs):
       self.register_buffer('u%d' % i, torch.randn(1, num_outputs))
       self.register_buffer('sv%d' % i, torch.ones(1))
+    # Normalized weight cached for eval mode, with the versions it was built from
+    self._W_cache = None
+    # Set by an SNManager that runs this layer's power iteration for it
+    self._SN_managed = False
+    # The first singular vectors (u, v) of the last training forward, and the
+    # ones a checkpointed recompute must reuse instead of iterating again
+    self._last_uv = None
+    self._recompute_uv = None
+    # Whether a training forward advances u; if not, it reuses the u and v
+    # buffers of the last update, which are then kept (see SNSchedule)
+    self._SN_update = True
+    self._SN_keep_v = False
 
   # Singular vectors (u side)
   @property
@@ -83,11 +138,51 @@ class SN(object):
   def sv(self):
    return [getattr(self, 'sv%d' % i) for i in range(self.num_svs)]
 
-  # Compute the spectrally-normalized weight
+  # Singular vectors (v side), only kept for layers with an SNManager or
+  # an SNSchedule
+  @property
+  def v(self):
+    return [getattr(self, 'v%d' % i) for i in range(self.num_svs)]
+
+  # The weight as the matrix the power iteration runs on
+  def W_mat(self):
+    # reshape, not view: a channels_last weight needs a copy to flatten
+    W_mat = self.weight.reshape(self.weight.size(0), -1)
+    return W_mat.t() if self.transpose else W_mat
+
+  # Storage and version of the weight and the u vectors; any in-place write
+  # to them (optimizer steps, EMA updates, load_state_dict) or moving them
+  # to another device or dtype changes this key.
+  def _W_key(self):
+    return tuple((t.data_ptr(), t._version) for t in [self.weight] + self.u)
+
+  # Compute the spectrally-normalized weight. Under autocast this runs in
+  # fp32; the layer using the result still casts it for its own op.
   def W_(self):
-    W_mat = self.weight.view(self.weight.size(0), -1)
-    if self.transpose:
-      W_mat = W_mat.t()
+    with fp32_region(self.weight):
+      return self._W()
+
+  def _W(self):
+    # In eval mode u is not updated, so W / sigma is constant until the weight
+    # or u change; outside of autograd reuse it instead of re-running the
+    # power iteration on every forward.
+    cacheable = not self.training and not torch.is_grad_enabled()
+    if cacheable and self._W_cache is not None and self._W_cache[0] == self._W_key():
+      return self._W_cache[1]
+    W_mat = self.W_mat()
+    # With an SNManager, u and v were already advanced for this forward; a
+    # checkpointed recompute replays the u and v of the first forward, and a
+    # forward that doesn't update reuses those of the last update. Only
+    # sigma, which carries the gradient, is left to compute.
+    if self.training and (self._SN_managed or self._recompute_uv is not None
+                          or not self._SN_update):
+      if self._recompute_uv is not None:
+        u, v = self._recompute_uv
+      else:
+        u, v = self.u[0], self.v[0]
+        self._last_uv = None
+      sv = torch.squeeze(torch.matmul(torch.matmul(v, W_mat.t()), u.t()))
+      return self.weight / sv
     # Apply num_itrs power iterations
     for _ in range(self.num_itrs):
       svs, us, vs = power_iteration(W_mat, self.u, update=self.training, eps=self.eps)
@@ -96,7 +191,12 @@ class SN(object):
       with torch.no_grad(): # Make sure to do this in a no_grad() context or you'll get memory leaks!
         for i, sv in enumerate(svs):
           self.sv[i][:] = sv
-    return self.weight / svs[0]
+        if self._SN_keep_v:
+          foreach_copy_(self.v, vs)
+      self._last_uv = (us[0], vs[0])
+    W = self.weight / svs[0]
+    self._W_cache = (self._W_key(), W) if cacheable else None
+    return W
 
 
 # 2D Conv layer with spectral norm
@@ -149,8 +249,221 @@ class SNEmbedding(nn.Embedding, SN):
     return F.embedding(x, self.W_())
 
 
+# Runs the power iteration of many SN layers together. Layers whose weight
+# matrices share a shape, dtype, device and SN settings are stacked, so each
+# power iteration step is a couple of bmm calls per group instead of a chain
+# of small matmuls per layer; the layers themselves only compute sigma in
+# their forward. Call update() once before each forward of the managed nets
+# in training mode, which is when each layer would have run its own step.
+class SNManager(object):
+  def __init__(self, *nets):
+    groups = {}
+    for net in nets:
+      if net is None:
+        continue
+      for module in net.modules():
+        if isinstance(module, SN):
+          W_mat = module.W_mat()
+          key = (tuple(W_mat.shape), module.num_svs, module.num_itrs, module.eps,
+                 W_mat.dtype, W_mat.device)
+          groups.setdefault(key, []).append(module)
+    self.groups = list(groups.items())
+    for (shape, num_svs, _, _, dtype, device), group in self.groups:
+      for module in group:
+        for i in range(num_svs):
+          module.register_buffer('v%d' % i, torch.zeros(1, shape[1], dtype=dtype, device=device),
+                                 persistent=False)
+        module._SN_managed = True
+    # Fill in v from the current u, so a forward before the first update()
+    # still gets a sensible sigma
+    self.update(update=False)
+
+  @property
+  def num_layers(self):
+    return sum(len(group) for _, group in self.groups)
+
+  def update(self, update=True):
+    with torch.no_grad():
+      for (_, num_svs, num_itrs, eps, _, _), group in self.groups:
+        W = torch.stack([module.W_mat() for module in group]) # [L, out, in]
+        us = [torch.stack([module.u[i] for module in group]) for i in range(num_svs)] # [L, 1, out]
+        for _ in range(num_itrs):
+          new_us, vs = [], []
+          for u in us:
+            v = F.normalize(batched_gram_schmidt(torch.bmm(u, W), vs), dim=-1, eps=eps)
+            vs += [v]
+            u = torch.bmm(v, W.transpose(1, 2))
+            u = F.normalize(batched_gram_schmidt(u, new_us), dim=-1, eps=eps)
+            new_us += [u]
+          if update:
+            us = new_us
+        svs = [torch.bmm(torch.bmm(v, W.transpose(1, 2)), u.transpose(1, 2))
+               for u, v in zip(new_us, vs)] # [L, 1, 1]
+        targets, sources = [], []
+        for i in range(num_svs):
+          for j, module in enumerate(group):
+            targets += [module.v[i]]
+            sources += [vs[i][j]]
+            if update:
+              targets += [module.u[i], module.sv[i]]
+              sources += [new_us[i][j], svs[i][j].view(1)]
+        foreach_copy_(targets, sources)
+
+
+# Decides which training forwards advance the SN power iterations of G, D
+# and Dv. With every=N, u only advances on every Nth iteration. With
+# per_step, it advances once per optimizer step: in the first forward of a
+# net after it stepped. prepare() is called before each G_D call. Forwards
+# that don't update reuse the u and v of the last update and only recompute
+# sigma, which carries the gradient. v is kept in non-persistent buffers, so
+# updates made in DataParallel's first replica reach the original layers.
+# With an SNManager, its batched update() is called or skipped instead.
+class SNSchedule(object):
+  def __init__(self, nets, every=1, per_step=False, manager=None):
+    self.every, self.per_step, self.manager = every, per_step, manager
+    self.layers = {name: [module for module in net.modules() if isinstance(module, SN)]
+                   for name, net in nets.items() if net is not None}
+    with torch.no_grad():
+      for module in sum(self.layers.values(), []):
+        if module._SN_managed:
+          continue
+        W_mat = module.W_mat()
+        for i, u in enumerate(module.u):
+          module.register_buffer('v%d' % i, F.normalize(torch.matmul(u, W_mat), eps=module.eps),
+                                 persistent=False)
+        module._SN_keep_v = True
+
+  # first_forward: names of the nets this G_D call is the first forward of
+  # since their last optimizer step
+  def prepare(self, itr, first_forward):
+    names = first_forward if self.per_step else list(self.layers)
+    active = not (itr % self.every) and len(names) > 0
+    if self.manager is not None:
+      if active:
+        self.manager.update()
+      return
+    for name, modules in self.layers.items():
+      for module in modules:
+        module._SN_update = active and name in names
+
+
+# Replace every spectrally-normalized layer in a module with the plain layer
+# it wraps, holding the normalized weight W / sigma, for deployment. The frozen
+# module has no u or sv buffers, so it cannot load training checkpoints.
+def freeze_SN(module):
+  for name, child in module.named_children():
+    if isinstance(child, SN):
+      setattr(module, name, _freeze_SN_layer(child))
+    else:
+      freeze_SN(child)
+  return module
+
+def _freeze_SN_layer(layer):
+  training = layer.training
+  layer.eval()
+  with torch.no_grad():
+    W = layer.W_()
+  layer.train(training)
+  if isinstance(layer, (nn.Conv2d, nn.Conv3d)):
+    which_conv = nn.Conv2d if isinstance(layer, nn.Conv2d) else nn.Conv3d
+    frozen = which_conv(layer.in_channels, layer.out_channels, layer.kernel_size,
+                        layer.stride, layer.padding, layer.dilation, layer.groups,
+                        bias=layer.bias is not None)
+  elif isinstance(layer, nn.Linear):
+    frozen = nn.Linear(layer.in_features, layer.out_features,
+                       bias=layer.bias is not None)
+  elif isinstance(layer, nn.Embedding):
+    frozen = nn.Embedding(layer.num_embeddings, layer.embedding_dim, layer.padding_idx,
+                          layer.max_norm, layer.norm_type, layer.scale_grad_by_freq,
+                          layer.sparse)
+  else:
+    raise NotImplementedError('Cannot freeze spectral norm in %s' % type(layer).__name__)
+  frozen = frozen.to(W.device, W.dtype).train(training)
+  with torch.no_grad():
+    frozen.weight.copy_(W)
+    if getattr(layer, 'bias', None) is not None:
+      frozen.bias.copy_(layer.bias)
+  return frozen
+
+
+# Weight of a layer as it is applied, normalized for SN layers
+def effective_weight(layer):
+  return layer.W_() if isinstance(layer, SN) else layer.weight
+
+
+# Bias of several fused layers: their biases concatenated, with zeros for
+# the layers that have none, or None if no layer has one.
+def fused_bias(convs):
+  biases = [conv.bias for conv in convs if conv.bias is not None]
+  if not biases:
+    return None
+  return torch.cat([conv.bias if conv.bias is not None
+                    else biases[0].new_zeros(conv.weight.shape[0]) for conv in convs])
+
+
+# Apply several 1x1 convs or linears to the same input as a single matmul.
+# x has its channels last, [..., C]; returns one [..., out_channels] view per layer.
+def fused_projection(x, convs):
+  weights = [effective_weight(conv) for conv in convs]
+  weight = torch.cat([item.reshape(item.shape[0], -1) for item in weights])
+  bias = fused_bias(convs)
+  return torch.split(F.linear(x, weight, bias), [item.shape[0] for item in weights], -1)
+
+
+# The same for a channels-first input, as one 1x1 conv; returns one
+# [N, out_channels, ...] view per conv.
+def fused_conv(x, convs):
+  weight = torch.cat([effective_weight(conv) for conv in convs])
+  bias = fused_bias(convs)
+  which_conv = F.conv3d if weight.dim() == 5 else F.conv2d
+  return torch.split(which_conv(x, weight, bias), [conv.out_channels for conv in convs], 1)
+
+
+# Attention of each query over all keys, softmax(q k^T) v, for q [N, L, d],
+# k [N, S, d] and v [N, S, dv] in rows. The logits are left unscaled, as in
+# SA-GAN; scaled_dot_product_attention divides by sqrt(d), so q is scaled up
+# to cancel it, and it avoids materializing the attention map where it can.
+def attention(q, k, v):
+  if hasattr(F, 'scaled_dot_product_attention'):
+    return F.scaled_dot_product_attention(q * math.sqrt(q.shape[-1]), k, v)
+  beta = F.softmax(torch.bmm(q, k.transpose(1, 2)), -1)
+  return torch.bmm(beta, v)
+
+
+# Memory-bounded version of attention(): queries are taken chunk_size at a
+# time, and each chunk folds in the keys chunk_size at a time with a running
+# (online) softmax, so no more than a chunk_size x chunk_size block of logits
+# exists at once. Query chunks are checkpointed, so backward recomputes them
+# rather than storing their logits, and memory stays linear in the sequence.
+def chunked_attention(q, k, v, chunk_size):
+  out = []
+  for q_chunk in torch.split(q, chunk_size, 1):
+    if torch.is_grad_enabled():
+      out += [checkpoint(_online_softmax_attention, q_chunk, k, v, chunk_size,
+                         use_reentrant=False)]
+    else:
+      out += [_online_softmax_attention(q_chunk, k, v, chunk_size)]
+  return torch.cat(out, 1)
+
+def _online_softmax_attention(q, k, v, chunk_size):
+  # Running max of the logits, softmax denominator and unnormalized output
+  m = q.new_full((*q.shape[:2], 1), -float('inf'))
+  l = q.new_zeros((*q.shape[:2], 1))
+  o = q.new_zeros((*q.shape[:2], v.shape[-1]))
+  for k_chunk, v_chunk in zip(torch.split(k, chunk_size, 1), torch.split(v, chunk_size, 1)):
+    logits = torch.bmm(q, k_chunk.transpose(1, 2))
+    m_new = torch.max(m, logits.max(-1, keepdim=True)[0])
+    p = torch.exp(logits - m_new)
+    # Rescale what has been accumulated so far to the new max
+    correction = torch.exp(m - m_new)
+    l = l * correction + p.sum(-1, keepdim=True)
+    o = o * correction + torch.bmm(p, v_chunk)
+    m = m_new
+  return o / l
+
+
 class FullAttention(nn.Module):
-  def __init__(self, ch, time_steps, which_conv=SNConv3d, name='full_attention'):
+  def __init__(self, ch, time_steps, which_conv=SNConv3d, chunk_size=0, name='full_attention'):
     super(FullAttention, self).__init__()  #assume input tensor as (B,T, C, H, W)
     # Channel multiplier
     self.ch = ch
@@ -160,30 +473,22 @@ class FullAttention(nn.Module):
     self.phi = self.which_conv(self.ch, self.ch // 8, kernel_size=1, padding=0, bias=False)
     self.g = self.which_conv(self.ch, self.ch // 2, kernel_size=1, padding=0, bias=False)
     self.o = self.which_conv(self.ch // 2, self.ch, kernel_size=1, padding=0, bias=False)
+    # Query/key chunk length for memory-bounded attention; 0 for the full map
+    self.chunk_size = chunk_size
     # Learnable gain parameter
     self.gamma = P(torch.tensor(0.), requires_grad=True)
   def forward(self, x, y=None):
     # xiaodan: x = [B,T,C,H,W]
-    # Apply convs
-    # xiaodan: y = [B,C,T,H,W]
-    y = x.permute(0, 2, 1, 3, 4)
-    theta = self.theta(y) # [B,C//8, T,H,W]
-    # print('theta shape',theta.shape)
-    # phi = self.phi(x).contiguous().view(-1, self.T, self.ch//8, x.shape[2], x.shape[3]).permute(0, 2, 1, 3, 4)
-    phi = self.phi(y) # [B,C//8, T,H,W]
-    # g = self.g(x).contiguous().view(-1, self.T, self.ch//2, x.shape[2], x.shape[3]).permute(0, 2, 1, 3, 4)
-    g = self.g(y)# [B,C//2, T,H,W]
-    # Perform reshapes
-    # theta = theta.contiguous().view(-1, self.T, self.ch//8, x.shape[2], x.shape[3])
-    # theta.permute(0, 2, 1, 3, 4)
-    # print('ch//8 and T,H,W:',self.ch//8,self.T,x.shape[3],x.shape[4])
-    theta = theta.contiguous().view(-1, self.ch//8, self.T*x.shape[3]*x.shape[4]) #[B,C//8, THW]
-    phi = phi.contiguous().view(-1, self.ch//8, self.T*x.shape[3]*x.shape[4])#[B,C//8, THW]
-    g = g.contiguous().view(-1, self.ch//2, self.T*x.shape[3]*x.shape[4])#[B,C//2, THW]
-    # Matmul and softmax to get attention maps
-    beta = F.softmax(torch.bmm(theta.transpose(1, 2), phi), -1) # [B, THW, |THW|]
-    # Attention map times g path
-    o = self.o(torch.bmm(g, beta.transpose(1,2)).contiguous().view(-1, self.ch // 2, self.T, x.shape[3], x.shape[4])).permute(0,2,1,3,4)
+    B, T, C, H, W = x.shape
+    # Apply the theta, phi and g convs at once, channels last: [B,T,H,W,c]
+    theta, phi, g = fused_projection(x.permute(0, 1, 3, 4, 2), [self.theta, self.phi, self.g])
+    # Every position attends over all THW positions
+    q, k, v = [h.reshape(B, T * H * W, -1) for h in [theta, phi, g]]
+    if self.chunk_size:
+      o = chunked_attention(q, k, v, self.chunk_size) # [B,THW,C//2]
+    else:
+      o = attention(q, k, v) # [B,THW,C//2]
+    o = fused_projection(o, [self.o])[0].view(B, T, H, W, C).permute(0, 1, 4, 2, 3)
     return self.gamma * o + x #[B,T,C,W,H]
 
 # A non-local block as used in SA-GAN
@@ -202,98 +507,31 @@ class Attention(nn.Module):
     # Learnable gain parameter
     self.gamma = P(torch.tensor(0.), requires_grad=True)
   def forward(self, x, y=None):
-    # Apply convs
-    theta = self.theta(x)
-    phi = F.max_pool2d(self.phi(x), [2,2])
-    g = F.max_pool2d(self.g(x), [2,2])
-    # Perform reshapes
-    theta = theta.view(-1, self. ch // 8, x.shape[2] * x.shape[3])
-    phi = phi.view(-1, self. ch // 8, x.shape[2] * x.shape[3] // 4)
-    g = g.view(-1, self. ch // 2, x.shape[2] * x.shape[3] // 4)
-    # Matmul and softmax to get attention maps
-    beta = F.softmax(torch.bmm(theta.transpose(1, 2), phi), -1)
-    # Attention map times g path
-    o = self.o(torch.bmm(g, beta.transpose(1,2)).view(-1, self.ch // 2, x.shape[2], x.shape[3]))
-    return self.gamma * o + x
-
-class SelfAttention_width(nn.Module):# Assume [B,T,C,H,W]
-  def __init__(self, ch, time_steps,which_conv=SNConv2d, name='attention_width'):
-    super(SelfAttention_width, self).__init__()
-    # Channel multiplier
-    self.ch = ch
-    self.T = time_steps
-    self.which_conv = which_conv
-    self.theta = self.which_conv(self.ch, self.ch // 8, kernel_size=1, padding=0, bias=False)
-    self.phi = self.which_conv(self.ch, self.ch // 8, kernel_size=1, padding=0, bias=False)
-    self.g = self.which_conv(self.ch, self.ch // 2, kernel_size=1, padding=0, bias=False)
-    self.o = self.which_conv(self.ch // 2, self.ch, kernel_size=1, padding=0, bias=False)
-    # Learnable gain parameter
-    self.gamma = P(torch.tensor(0.), requires_grad=True)
-  def forward(self, x, y=None):
-    # x:[BT,C,H,W]
-    # Apply convs
-    theta = self.theta(x)
-    phi = self.phi(x)
-    g = self.g(x)
-    # Perform reshapes
-    theta = theta.contiguous().view(-1,self.T,self.ch//8,*x.shape[2:])
-    theta = theta.permute(0,1,3,2,4)
-    theta = theta.contiguous().view(-1, self. ch // 8, x.shape[3]) #[BTH,C//8,W]
-    phi = phi.contiguous().view(-1,self.T,self.ch//8,*x.shape[2:])
-    phi = phi.permute(0,1,3,2,4)
-    phi = phi.contiguous().view(-1, self. ch // 8,x.shape[3]) # [BTH,C//8,W]
-    g = g.contiguous().view(-1,self.T,self.ch//2,*x.shape[2:])
-    g = g.permute(0,1,3,2,4)
-    g = g.contiguous().view(-1, self. ch // 2, x.shape[3]) # [BTH,C//2,W]
-    # Matmul and softmax to get attention maps
-    beta = F.softmax(torch.bmm(theta.transpose(1, 2), phi), -1)
-    # Attention map times g path
-    attn_g = torch.bmm(g, beta.transpose(1,2)).contiguous().view(-1, self.T, x.shape[2],self.ch // 2, x.shape[3]).permute(0,1,3,2,4)
-    o = self.o(attn_g.contiguous().view(-1,self.ch//2,*x.shape[2:]))
-    return self.gamma * o + x
-
-class SelfAttention_height(nn.Module):# Assume [B,T,C,H,W]
-  def __init__(self, ch, time_steps,which_conv=SNConv2d, name='attention_height'):
-    super(SelfAttention_height, self).__init__()
-    # Channel multiplier
-    self.ch = ch
-    self.T = time_steps
-    self.which_conv = which_conv
-    self.theta = self.which_conv(self.ch, self.ch // 8, kernel_size=1, padding=0, bias=False)
-    self.phi = self.which_conv(self.ch, self.ch // 8, kernel_size=1, padding=0, bias=False)
-    self.g = self.which_conv(self.ch, self.ch // 2, kernel_size=1, padding=0, bias=False)
-    self.o = self.which_conv(self.ch // 2, self.ch, kernel_size=1, padding=0, bias=False)
-    # Learnable gain parameter
-    self.gamma = P(torch.tensor(0.), requires_grad=True)
-  def forward(self, x, y=None):
-    # x:[BT,C,H,W]
-    # Apply convs
-    theta = self.theta(x)
-    phi = self.phi(x)
-    g = self.g(x)
-    # Perform reshapes
-    theta = theta.contiguous().view(-1,self.T,self.ch//8,*x.shape[2:]) #[B,T,C//8,H,W]
-    theta = theta.permute(0,1,4,2,3) #[B,T,W,C,H]
-    theta = theta.contiguous().view(-1, self. ch // 8, x.shape[2]) #[BTW,C//8,H]
-    phi = phi.contiguous().view(-1,self.T,self.ch//8,*x.shape[2:])#[B,T,C//8,H,W]
-    phi = phi.permute(0,1,4,2,3) #[B,T,W,C,H]
-    phi = phi.contiguous().view(-1, self. ch // 8,x.shape[2]) #[BTW,C//8,H]
-    g = g.contiguous().view(-1,self.T,self.ch//2,*x.shape[2:])#[B,T,C//2,H,W]
-    g = g.permute(0,1,4,2,3)#[B,T,W,C,H]
-    g = g.contiguous().view(-1, self. ch // 2, x.shape[2]) # [BTW,C//2,H]
-    # Matmul and softmax to get attention maps
-    beta = F.softmax(torch.bmm(theta.transpose(1, 2), phi), -1)#[BTW,H,|H|]
-    # Attention map times g path
-    attn_g = torch.bmm(g, beta.transpose(1,2)).contiguous().view(-1, self.T, x.shape[3],self.ch // 2, x.shape[2]).permute(0,1,3,4,2) #[B,T,C,H,W]
-    o = self.o(attn_g.contiguous().view(-1,self.ch//2,*x.shape[2:]))# [BT,C,H,W]
+    B, C, H, W = x.shape
+    # Apply convs at once, channels last: [B,H,W,c]
+    theta, phi, g = fused_projection(x.permute(0, 2, 3, 1), [self.theta, self.phi, self.g])
+    # Keys and values are max-pooled to a quarter of the positions
+    pool = lambda h: F.max_pool2d(h.permute(0, 3, 1, 2), [2,2]).flatten(2).transpose(1, 2)
+    o = attention(theta.reshape(B, H * W, -1), pool(phi), pool(g)) # [B,HW,C//2]
+    o = fused_projection(o, [self.o])[0].view(B, H, W, C).permute(0, 3, 1, 2)
     return self.gamma * o + x
 
-class SelfAttention_time(nn.Module):# Assume [B,T,C,H,W]
-  def __init__(self, ch, time_steps,which_conv=SNConv2d, name='attention_time'):
-    super(SelfAttention_time, self).__init__()
+# One pass of AxialAttention: attention along a single axis of the
+# [B,T,C,H,W] activation. The pass works on views of the [BT,C,H,W] input
+# and contracts over the attended axis with einsum, so the activation is
+# never permuted into a contiguous copy.
+class AxialAttentionPass(nn.Module):
+  # Einsum equations for the logits and the output; the attended axis comes
+  # last in the logits, so the softmax runs over dim -1
+  equations = {'width': ('btchw,btchv->bthwv', 'bthwv,btchv->btchw'),
+               'height': ('btchw,btcgw->btwhg', 'btwhg,btcgw->btchw'),
+               'time': ('btchw,bschw->bhwts', 'bhwts,bschw->btchw')}
+  def __init__(self, ch, time_steps, axis, which_conv=SNConv2d):
+    super(AxialAttentionPass, self).__init__()
     # Channel multiplier
     self.ch = ch
     self.T = time_steps
+    self.axis = axis
     self.which_conv = which_conv
     self.theta = self.which_conv(self.ch, self.ch // 8, kernel_size=1, padding=0, bias=False)
     self.phi = self.which_conv(self.ch, self.ch // 8, kernel_size=1, padding=0, bias=False)
@@ -301,28 +539,27 @@ class SelfAttention_time(nn.Module):# Assume [B,T,C,H,W]
     self.o = self.which_conv(self.ch // 2, self.ch, kernel_size=1, padding=0, bias=False)
     # Learnable gain parameter
     self.gamma = P(torch.tensor(0.), requires_grad=True)
+  def forward(self, x):
+    # x:[BT,C,H,W]; theta, phi and g come out of one conv as [B,T,c,H,W] views
+    theta, phi, g = [h.view(-1, self.T, *h.shape[1:])
+                     for h in fused_conv(x, [self.theta, self.phi, self.g])]
+    logits_eq, out_eq = self.equations[self.axis]
+    beta = F.softmax(torch.einsum(logits_eq, theta, phi), -1)
+    o = torch.einsum(out_eq, beta, g).reshape(-1, self.ch // 2, *x.shape[2:]) # [BT,C//2,H,W]
+    return self.gamma * self.o(o) + x
+
+
+# Factorized attention over width, then height, then time, replacing the
+# separate SelfAttention_width/height/time modules. Each pass keeps the
+# parameters those modules had, under .width, .height and .time.
+class AxialAttention(nn.Module):
+  def __init__(self, ch, time_steps, which_conv=SNConv2d, name='axial_attention'):
+    super(AxialAttention, self).__init__()
+    self.width = AxialAttentionPass(ch, time_steps, 'width', which_conv)
+    self.height = AxialAttentionPass(ch, time_steps, 'height', which_conv)
+    self.time = AxialAttentionPass(ch, time_steps, 'time', which_conv)
   def forward(self, x, y=None):
-    # x:[BT,C,H,W]
-    # Apply convs
-    theta = self.theta(x) #[BT,C//8,H,W]
-    phi = self.phi(x) #[BT,C//8,H,W]
-    g = self.g(x) #[BT,C//2,H,W]
-    # Perform reshapes
-    theta = theta.contiguous().view(-1,self.T,self.ch//8,*x.shape[2:]) #[B,T,C//8,H,W]
-    theta = theta.permute(0,3,4,2,1) #[B,H,W,C//8,T]
-    theta = theta.contiguous().view(-1, self. ch // 8, self.T) #[BHW,C//8,T]
-    phi = phi.contiguous().view(-1,self.T,self.ch//8,*x.shape[2:])#[B,T,C//8,H,W]
-    phi = phi.permute(0,3,4,2,1) #[B,H,W,C//8,T]
-    phi = phi.contiguous().view(-1, self. ch // 8,self.T) #[BHW,C//8,T]
-    g = g.contiguous().view(-1,self.T,self.ch//2,*x.shape[2:])#[B,T,C,H,W]
-    g = g.permute(0,3,4,2,1)#[B,H,W,C//2,T]
-    g = g.contiguous().view(-1, self. ch // 2, self.T) # [BHW,C//2,T]
-    # Matmul and softmax to get attention maps
-    beta = F.softmax(torch.bmm(theta.transpose(1, 2), phi), -1)#[BHW,T,|T|]
-    # Attention map times g path
-    attn_g = torch.bmm(g, beta.transpose(1,2)).contiguous().view(-1, x.shape[2], x.shape[3],self.ch // 2, self.T).permute(0,4,3,1,2) #[B,T,C//2,H,W]
-    o = self.o(attn_g.contiguous().view(-1,self.ch//2,*x.shape[2:]))# [BT,C,H,W]
-    return self.gamma * o + x
+    return self.time(self.height(self.width(x)))
 
 # Fused batchnorm op
 def fused_bn(x, mean, var, gain=None, bias=None, eps=1e-5):
@@ -363,6 +600,26 @@ def manual_bn(x, gain=None, bias=None, return_mean_var=False, eps=1e-5):
     return fused_bn(x, m, var, gain, bias, eps)
 
 
+# Batchnorm of a [B,T,C,H,W] tensor over its C channels, i.e. F.batch_norm
+# on the [BT,C,H,W] frames, computed elementwise on the 5D view instead, so a
+# channels_last input keeps its layout. Stats are taken in fp32 and only the
+# normalization runs in x's dtype.
+def batch_norm_5D(x, running_mean, running_var, training, momentum=0.1, eps=1e-5):
+  shape = (1, 1, x.shape[2], 1, 1)
+  if training:
+    var, mean = torch.var_mean(x.float(), [0, 1, 3, 4], unbiased=False)
+    if not recomputing():
+      with torch.no_grad():
+        n = x.numel() // mean.numel()
+        running_mean.mul_(1 - momentum).add_(mean, alpha=momentum)
+        running_var.mul_(1 - momentum).add_(var * (n / max(n - 1, 1)),
+                                            alpha=momentum)
+  else:
+    mean, var = running_mean, running_var
+  scale = torch.rsqrt(var.view(shape) + eps)
+  return x * scale.to(x.dtype) - (mean.view(shape) * scale).to(x.dtype)
+
+
 # My batchnorm, supports standing stats
 class myBN(nn.Module):
   def __init__(self, num_channels, eps=1e-5, momentum=0.1):
@@ -389,6 +646,9 @@ class myBN(nn.Module):
   def forward(self, x, gain, bias):
     if self.training:
       out, mean, var = manual_bn(x, gain, bias, return_mean_var=True, eps=self.eps)
+      # A checkpointed recompute already counted these stats
+      if recomputing():
+        return out
       # If accumulating standing stats, increment them
       if self.accumulate_standing:
         self.stored_mean[:] = self.stored_mean + mean.data
@@ -410,6 +670,93 @@ class myBN(nn.Module):
       return fused_bn(x, mean, var, gain, bias, self.eps)
 
 
+# Per-channel batch mean and (biased) variance of x across every process of a
+# torch.distributed group. Each process sums x and x ** 2 over all but the
+# channel axis in fp32, and a single all_reduce of the packed sums and count
+# totals them. The all_reduce is differentiable, so in backward the grads of
+# the stats are summed across the group too. Also returns the total count.
+def all_reduce_bn_stats(x, group=None):
+  import torch.distributed.nn
+  float_x = x.float()
+  dims = [0] + list(range(2, x.dim()))
+  count = float_x.new_full([1], float(float_x.numel() // float_x.shape[1]))
+  stats = torch.cat([float_x.sum(dims), (float_x ** 2).sum(dims), count])
+  if group is None:
+    stats = torch.distributed.nn.functional.all_reduce(stats)
+  else:
+    stats = torch.distributed.nn.functional.all_reduce(stats, group=group)
+  mean, mean_sq = stats[:-1].view(2, -1) / stats[-1]
+  return mean, (mean_sq - mean ** 2).clamp(min=0), stats[-1]
+
+
+# While active, distBN layers normalize with local batch stats only, for
+# forwards that only some processes run (sampling, testing, standing stats
+# on the main process)
+_local_bn = threading.local()
+
+class local_bn(object):
+  def __enter__(self):
+    self.previous = getattr(_local_bn, 'active', False)
+    _local_bn.active = True
+  def __exit__(self, *args):
+    _local_bn.active = self.previous
+
+
+# Cross-replica batchnorm over a torch.distributed process group, for
+# --cross_replica under --distributed: in training, every process normalizes
+# with the batch stats of the whole group, so each layer's forward is one
+# collective that all processes must run. Same interface as myBN.
+class distBN(nn.Module):
+  def __init__(self, num_channels, eps=1e-5, momentum=0.1, group=None):
+    super(distBN, self).__init__()
+    self.eps = eps
+    self.momentum = momentum
+    self.group = group
+    self.register_buffer('running_mean', torch.zeros(num_channels))
+    self.register_buffer('running_var', torch.ones(num_channels))
+    # As in SyncBN2d, so that checkpoints load into either
+    self.register_buffer('num_batches_tracked', torch.tensor(0, dtype=torch.long))
+
+  def forward(self, x, gain=None, bias=None):
+    if not self.training:
+      mean, var = self.running_mean, self.running_var
+    else:
+      if getattr(_local_bn, 'active', False):
+        float_x = x.float()
+        dims = [0] + list(range(2, x.dim()))
+        var, mean = torch.var_mean(float_x, dims, unbiased=False)
+        n = mean.new_tensor(float(float_x.numel() // float_x.shape[1]))
+      else:
+        mean, var, n = all_reduce_bn_stats(x, self.group)
+      # A checkpointed recompute already counted these stats
+      if not recomputing():
+        with torch.no_grad():
+          self.num_batches_tracked += 1
+          self.running_mean.mul_(1 - self.momentum).add_(mean, alpha=self.momentum)
+          self.running_var.mul_(1 - self.momentum).add_(var * n / (n - 1).clamp(min=1),
+                                                        alpha=self.momentum)
+    shape = (1, -1) + (1,) * (x.dim() - 2)
+    return fused_bn(x, mean.view(shape).to(x.dtype), var.view(shape).to(x.dtype),
+                    gain, bias, self.eps)
+
+
+# The cross-replica batchnorm for --cross_replica: over the process group
+# under torch.distributed, else synchronized across DataParallel replicas
+def cross_replica_bn(num_channels, eps=1e-5, momentum=0.1):
+  if torch.distributed.is_available() and torch.distributed.is_initialized():
+    return distBN(num_channels, eps=eps, momentum=momentum)
+  return SyncBN2d(num_channels, eps=eps, momentum=momentum, affine=False)
+
+
+# Running stats for F.batch_norm / F.instance_norm: none while recomputing a
+# checkpointed training forward, which then normalizes with the batch stats
+# without updating the running ones again
+def running_stats(module):
+  if module.training and recomputing():
+    return None, None
+  return module.stored_mean, module.stored_var
+
+
 # Simple function to handle groupnorm norm stylization
 def groupnorm(x, norm_style):
   # If number of channels specified in norm_style:
@@ -450,7 +797,7 @@ class ccbn(nn.Module):
     self.norm_style = norm_style
 
     if self.cross_replica:
-      self.bn = SyncBN2d(output_size, eps=self.eps, momentum=self.momentum, affine=False)
+      self.bn = cross_replica_bn(output_size, eps=self.eps, momentum=self.momentum)
     elif self.mybn:
       self.bn = myBN(output_size, self.eps, self.momentum)
     elif self.norm_style in ['bn', 'in']:
@@ -468,10 +815,10 @@ class ccbn(nn.Module):
     # else:
     else:
       if self.norm_style == 'bn':
-        out = F.batch_norm(x, self.stored_mean, self.stored_var, None, None,
+        out = F.batch_norm(x, *running_stats(self), None, None,
                           self.training, 0.1, self.eps)
       elif self.norm_style == 'in':
-        out = F.instance_norm(x, self.stored_mean, self.stored_var, None, None,
+        out = F.instance_norm(x, *running_stats(self), None, None,
                           self.training, 0.1, self.eps)
       elif self.norm_style == 'gn':
         out = groupnorm(x, self.normstyle)
@@ -507,7 +854,7 @@ class ccbn5D(nn.Module):
     self.norm_style = norm_style
 
     if self.cross_replica:
-      self.bn = SyncBN2d(output_size, eps=self.eps, momentum=self.momentum, affine=False)
+      self.bn = cross_replica_bn(output_size, eps=self.eps, momentum=self.momentum)
     elif self.mybn:
       self.bn = myBN(output_size, self.eps, self.momentum)
     elif self.norm_style in ['bn', 'in']:
@@ -516,36 +863,49 @@ class ccbn5D(nn.Module):
 
 
   def forward(self, x, y): #x:[BT,C,H,W]
-    # xiaodan: make x back to [B,T,C,H,W] and reshape into [B,TC,H,W]
-    x_TC = x.contiguous().view(-1,self.time_steps,*x.shape[1:]).contiguous()\
-                                            .view(x.shape[0],-1,*x.shape[2:])
-    # Calculate class-conditional gains and biases
-    # print('input and output size',self.input_size,self.output_size)
-    # print('y shape',y.shape)
-    gain = (1 + self.gain(y)).view(y.size(0), -1, 1, 1)
-    bias = self.bias(y).view(y.size(0), -1, 1, 1)
-    # print('gain and bias shapes:',gain.shape,bias.shape)
+    # Normalized per channel C over all BT frames; the [B,T,C,H,W] view is
+    # for the per-video gains and the channels_last path
+    x_5D = x.reshape(-1, self.time_steps, *x.shape[1:]) # [B,T,C,H,W]
+    # y is either the per-frame conditioning [BT,D], or a dict holding this
+    # layer's per-video gain and bias [B,C], precomputed by the Generator
+    if isinstance(y, dict):
+      gain, bias = y[self]
+      # Broadcast over the frames of each video as [B,1,C,1,1]
+      gain = gain.view(gain.size(0), 1, -1, 1, 1)
+      bias = bias.view(bias.size(0), 1, -1, 1, 1)
+      if self.mybn or self.cross_replica:
+        gain = gain.expand(-1, self.time_steps, -1, -1, -1).reshape(x.shape[0], -1, 1, 1)
+        bias = bias.expand(-1, self.time_steps, -1, -1, -1).reshape(x.shape[0], -1, 1, 1)
+    else:
+      # Calculate class-conditional gains and biases
+      gain = (1 + self.gain(y)).view(y.size(0), -1, 1, 1)
+      bias = self.bias(y).view(y.size(0), -1, 1, 1)
     # If using my batchnorm
     if self.mybn or self.cross_replica:
-      return self.bn(x_TC, gain=gain, bias=bias).contiguous().view(-1,self.time_steps,*x.shape[1:]).contiguous().view(*x.shape)
-                                            # [B,TC,H,W]             # [B,T,C,H,W]                  # [BT,C,H,W]
+      return self.bn(x, gain=gain, bias=bias) # [BT,C,H,W]
     # else:
+    elif self.norm_style == 'bn' and not x.is_contiguous():
+      # channels_last x: normalize the [B,T,C,H,W] view, keeping its layout
+      out = batch_norm_5D(x_5D, self.stored_mean, self.stored_var,
+                          self.training, 0.1, self.eps)
     else:
       if self.norm_style == 'bn':
-        out = F.batch_norm(x_TC, self.stored_mean, self.stored_var, None, None,
+        out = F.batch_norm(x, *running_stats(self), None, None,
                           self.training, 0.1, self.eps)
       elif self.norm_style == 'in':
-        out = F.instance_norm(x_TC, self.stored_mean, self.stored_var, None, None,
+        out = F.instance_norm(x, *running_stats(self), None, None,
                           self.training, 0.1, self.eps)
       elif self.norm_style == 'gn':
-        out = groupnorm(x_TC, self.normstyle)
+        out = groupnorm(x, self.normstyle)
       elif self.norm_style == 'nonorm':
-        out = x_TC
+        out = x
 
       # print('out shape',out.shape)
       # print('x shape',x.shape)
-      out  = out.contiguous().view(-1,self.time_steps,*x.shape[1:]) # [B,T,C,H,W]
-      return out.contiguous().view(*x.shape) * gain + bias # [BT,C,H,W]
+      out  = out.view(-1,self.time_steps,*x.shape[1:]) # [B,T,C,H,W]
+    if gain.dim() == 5:
+      return (out * gain + bias).view(*x.shape) # [BT,C,H,W]
+    return out.view(*x.shape) * gain + bias # [BT,C,H,W]
 
   def extra_repr(self):
     s = 'out: {output_size}, in: {input_size},'
@@ -572,7 +932,7 @@ class bn(nn.Module):
     self.mybn = mybn
 
     if self.cross_replica:
-      self.bn = SyncBN2d(output_size, eps=self.eps, momentum=self.momentum, affine=False)
+      self.bn = cross_replica_bn(output_size, eps=self.eps, momentum=self.momentum)
     elif mybn:
       self.bn = myBN(output_size, self.eps, self.momentum)
      # Register buffers if neither of the above
@@ -586,10 +946,50 @@ class bn(nn.Module):
       bias = self.bias.view(1,-1,1,1)
       return self.bn(x, gain=gain, bias=bias)
     else:
-      return F.batch_norm(x, self.stored_mean, self.stored_var, self.gain,
+      return F.batch_norm(x, *running_stats(self), self.gain,
                           self.bias, self.training, self.momentum, self.eps)
 
 
+# Statistics an eval-mode ccbn5D or bn normalizes with: the stored running
+# stats, or the standing stats if they were accumulated
+def eval_bn_stats(module):
+  if module.cross_replica:
+    return module.bn.running_mean, module.bn.running_var, module.eps
+  if module.mybn:
+    mean, var = module.bn.stored_mean, module.bn.stored_var
+    if module.bn.accumulate_standing:
+      mean, var = mean / module.bn.accumulation_counter, var / module.bn.accumulation_counter
+    return mean, var, module.eps
+  if getattr(module, 'norm_style', 'bn') != 'bn':
+    raise NotImplementedError('Cannot fold %s normalization' % module.norm_style)
+  return module.stored_mean, module.stored_var, module.eps
+
+
+# Per-channel affine map x * scale + shift; an eval-mode bn folded into plain weights
+class affine(nn.Module):
+  def __init__(self, scale, shift):
+    super(affine, self).__init__()
+    self.register_buffer('scale', scale.view(1, -1, 1, 1))
+    self.register_buffer('shift', shift.view(1, -1, 1, 1))
+  def forward(self, x, y=None):
+    return torch.addcmul(self.shift, x, self.scale)
+
+
+# Class-conditional per-channel affine map; an eval-mode ccbn5D folded into
+# plain weights. y is a dict holding this layer's per-video scale and shift
+# [B,C], broadcast over the time_steps frames of each video.
+class ccaffine5D(nn.Module):
+  def __init__(self, output_size, time_steps):
+    super(ccaffine5D, self).__init__()
+    self.output_size, self.time_steps = output_size, time_steps
+  def forward(self, x, y): #x:[BT,C,H,W]
+    scale, shift = y[self]
+    out = torch.addcmul(shift.view(shift.size(0), 1, -1, 1, 1),
+                        x.view(-1, self.time_steps, *x.shape[1:]),
+                        scale.view(scale.size(0), 1, -1, 1, 1))
+    return out.view(*x.shape)
+
+
 # Generator blocks
 # Note that this class assumes the kernel size and padding (and any other
 # settings) have been selected in the main generator module and passed in
@@ -726,5 +1126,46 @@ class Conv3DBlock(nn.Module):
         out = self.relu(out)
 
         return out
+
+
+# Run module(*args) with activation checkpointing: its activations are freed
+# after the forward and recomputed during backward. The recompute reuses the
+# (u, v) each SN layer in module had in the first forward, so the power
+# iteration is neither run twice nor given a different sigma, and BN running
+# stats are only updated once. Cross-replica BN still updates twice.
+def checkpoint_module(module, *args):
+  sn_layers = [item for item in module.modules() if isinstance(item, SN)]
+  saved_uv = []
+  def run(*args):
+    if not saved_uv:
+      out = module(*args)
+      saved_uv.append([item._last_uv for item in sn_layers])
+      return out
+    previous = recomputing()
+    _recompute.active = True
+    for item, uv in zip(sn_layers, saved_uv[0]):
+      item._recompute_uv = uv
+    try:
+      return module(*args)
+    finally:
+      _recompute.active = previous
+      for item in sn_layers:
+        item._recompute_uv = None
+  return checkpoint(run, *args, use_reentrant=False)
+
+
+# Block types a net checkpoints, from the --checkpoint list: the net's own
+# blocks if its name (G, D or Dv) is in it, its attention modules if attn is
+def checkpoint_types(checkpoint, name, block_types, attention_types):
+  which = checkpoint.split('_') if checkpoint else []
+  return ((block_types if name in which else ())
+          + (attention_types if 'attn' in which else ()))
+
+
+# Call module(*args), checkpointed if it is one of types and grads are on
+def maybe_checkpoint(module, types, *args):
+  if isinstance(module, types) and module.training and torch.is_grad_enabled():
+    return checkpoint_module(module, *args)
+  return module(*args)
 # dogball
 #test
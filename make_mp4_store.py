@@ -0,0 +1,137 @@
+''' Make MP4 clip store
+    This script re-encodes each training video once as a short, target
+    resolution mp4 and writes a frame index next to it, as a compact
+    alternative to the JPEG frame tree written by extract_jpegs.py.
+    The GOP length sets the trade-off between bytes on disk/network and the
+    CPU cost of decoding a clip: --gop 1 gives all-intra files where any
+    window decodes with no wasted frames, larger GOPs give smaller files
+    but may decode up to gop-1 frames that are thrown away per clip. '''
+import os
+import subprocess
+from argparse import ArgumentParser
+from joblib import delayed
+from joblib import Parallel
+
+import numpy as np
+import pandas as pd
+
+
+def prepare_parser():
+  usage = 'Parser for the mp4 clip store script.'
+  parser = ArgumentParser(description=usage)
+  parser.add_argument(
+    '--video_root', type=str,
+    default='/home/ubuntu/kinetics-400/kinetics/Kinetics_trimmed_videos_train_merge',
+    help='Where are the source videos? (default: %(default)s)')
+  parser.add_argument(
+    '--cache_csv_path', type=str,
+    default='/home/ubuntu/kinetics-400/kinetics/file_cache.csv',
+    help='Frames cache file listing the videos and labels to store '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--store_root', type=str, default='/home/ubuntu/kinetics-400/kinetics/mp4_store',
+    help='Where to write the re-encoded videos and index (default: %(default)s)')
+  parser.add_argument(
+    '--frame_size', type=int, default=64,
+    help='Side of the square, center-cropped frames to store (default: %(default)s)')
+  parser.add_argument(
+    '--frame_rate', type=int, default=12,
+    help='Frame rate to resample the videos to (default: %(default)s)')
+  parser.add_argument(
+    '--gop', type=int, default=1,
+    help='Keyframe interval; 1 for all-intra (default: %(default)s)')
+  parser.add_argument(
+    '--crf', type=int, default=18,
+    help='x264 constant rate factor, lower is higher quality (default: %(default)s)')
+  parser.add_argument(
+    '--preset', type=str, default='medium',
+    help='x264 preset (default: %(default)s)')
+  parser.add_argument(
+    '--num_jobs', type=int, default=10,
+    help='Number of videos to encode in parallel (default: %(default)s)')
+  return parser
+
+
+# Read the presentation timestamps and keyframe flags of a video's packets
+# without decoding it. Frames are stored without B-frames, so decode order
+# and presentation order are the same.
+def index_video(path):
+  import av
+  with av.open(path) as container:
+    stream = container.streams.video[0]
+    packets = [(packet.pts, packet.is_keyframe)
+               for packet in container.demux(stream) if packet.pts is not None]
+  packets = sorted(packets)
+  pts = np.array([item[0] for item in packets], dtype=np.int64)
+  keyframe = np.array([item[1] for item in packets], dtype=np.bool_)
+  return pts, keyframe
+
+
+def encode_video(inname, outname, config):
+  size = config['frame_size']
+  command = ("ffmpeg -loglevel panic -y -i '{}' -an "
+             "-vf 'fps={},scale={}:{}:force_original_aspect_ratio=increase,crop={}:{}' "
+             "-c:v libx264 -preset {} -crf {} -g {} -keyint_min {} -sc_threshold 0 -bf 0 "
+             "-pix_fmt yuv420p '{}'").format(inname, config['frame_rate'],
+                                             size, size, size, size,
+                                             config['preset'], config['crf'],
+                                             config['gop'], config['gop'], outname)
+  try:
+    subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT)
+  except subprocess.CalledProcessError as err:
+    print(err.output)
+    return False
+  return os.path.exists(outname)
+
+
+def store_video_wrapper(row, config):
+  """Wrapper for parallel processing purposes."""
+  videoname = os.path.basename(os.path.normpath(row['path']))
+  inname = os.path.join(config['video_root'], videoname + '.mp4')
+  outname = os.path.join(config['store_root'], videoname + '.mp4')
+  if not os.path.exists(outname) and not encode_video(inname, outname, config):
+    print('Could not encode video: {}'.format(inname))
+    return None
+  pts, keyframe = index_video(outname)
+  if len(pts) == 0:
+    return None
+  return videoname + '.mp4', row['label'], pts, keyframe
+
+
+def run(config):
+  if not os.path.isdir(config['store_root']):
+    os.makedirs(config['store_root'], 0o755)
+  cache_df = pd.read_csv(config['cache_csv_path'])
+  print('Encoding %d videos at %dx%d, %d fps, gop %d...' % (len(cache_df),
+        config['frame_size'], config['frame_size'], config['frame_rate'], config['gop']))
+  records = Parallel(n_jobs=config['num_jobs'])(delayed(store_video_wrapper)(row, config)
+                                                for _, row in cache_df.iterrows())
+  records = [item for item in records if item is not None]
+  print('Stored %d of %d videos' % (len(records), len(cache_df)))
+
+  # The frame index holds every video's packet timestamps back to back;
+  # offsets[i]:offsets[i] + num_frames[i] slices out video i.
+  num_frames = np.array([len(item[2]) for item in records], dtype=np.int64)
+  offsets = np.concatenate([[0], np.cumsum(num_frames)[:-1]]).astype(np.int64)
+  np.savez(os.path.join(config['store_root'], 'index.npz'),
+           paths=np.array([item[0] for item in records]),
+           labels=np.array([item[1] for item in records]),
+           # Keep the class order of the frames cache so labels match the
+           # JPEG pipeline and the class names logged in train_fns
+           classes=np.array(cache_df['label'].unique()),
+           num_frames=num_frames, offsets=offsets,
+           pts=np.concatenate([item[2] for item in records]),
+           keyframe=np.concatenate([item[3] for item in records]),
+           frame_size=config['frame_size'], frame_rate=config['frame_rate'],
+           gop=config['gop'])
+
+
+def main():
+  # parse command line and run
+  parser = prepare_parser()
+  config = vars(parser.parse_args())
+  print(config)
+  run(config)
+
+if __name__ == '__main__':
+  main()
@@ -1,5 +1,6 @@
 ''' Sample
    This script loads a pretrained net and a weightsfile and sample '''
+import os
 import functools
 import math
 import numpy as np
@@ -47,6 +48,9 @@ def run(config):
   config['skip_init'] = True
   config['no_optim'] = True
   device = 'cuda'
+  # Without the ConvGRU, the chunks of a long video would be unconnected
+  if config['sample_long_video'] and config['no_convgru']:
+    raise ValueError('--sample_long_video needs a G with a ConvGRU (drop --no_convgru)')
   
   # Seed RNG
   utils.seed_rng(config['seed'])
@@ -70,6 +74,8 @@ def run(config):
                      config['weights_root'], experiment_name, config['load_weights'],
                      G if config['ema'] and config['use_ema'] else None,
                      strict=False, load_optim=False)
+  if config['channels_last']:
+    utils.to_channels_last(G)
   # Update batch size setting used for G
   G_batch_size = max(config['G_batch_size'], config['batch_size']) 
   z_, y_ = utils.prepare_z_y(G_batch_size, G.dim_z, config['n_classes'],
@@ -138,6 +144,19 @@ def run(config):
                                  nrow=int(G_batch_size**0.5),
                                  normalize=True)
 
+  # Stream a long video chunk by chunk, saving each frame as it arrives
+  if config['sample_long_video']:
+    print('Streaming %d frames per video...' % (config['sample_long_video'] * G.time_steps))
+    frames_root = '%s/%s/long_video' % (config['samples_root'], experiment_name)
+    if not os.path.isdir(frames_root):
+      os.makedirs(frames_root)
+    z_.sample_()
+    y_.sample_()
+    for t, frame in enumerate(utils.stream_video(G, z_, y_, config['sample_long_video'],
+                                                 parallel=config['parallel'])):
+      torchvision.utils.save_image(frame.float(), '%s/frame_%05d.jpg' % (frames_root, t),
+                                   nrow=int(G_batch_size**0.5), normalize=True)
+
   # Get Inception Score and FID
   get_inception_metrics = inception_utils.prepare_inception_metrics(config['dataset'], config['parallel'], config['no_fid'])
   # Prepare a simple function get metrics that we use for trunc curves
@@ -0,0 +1,14 @@
+#!/bin/bash
+# Distributed training on CPU with the gloo backend, e.g. to try out the
+# --distributed path without GPUs. batch_size is per process.
+torchrun --standalone --nproc_per_node 2 train.py \
+--distributed --dist_backend gloo \
+--shuffle --batch_size 8 --num_workers 2 \
+--num_G_accumulations 1 --num_D_accumulations 1 --num_epochs 1 \
+--num_D_steps 2 --G_lr 2e-4 --D_lr 2e-4 \
+--dataset C10 \
+--G_ch 16 --D_ch 16 --time_steps 4 --k 2 \
+--G_ortho 0.0 \
+--G_attn 0 --D_attn 0 \
+--G_init N02 --D_init N02 \
+--skip_testing --save_every 100 --num_save_copies 0 --seed 0
@@ -13,8 +13,6 @@ import math
 import numpy as np
 from tqdm import tqdm, trange
 
-os.environ["CUDA_VISIBLE_DEVICES"]="0, 1, 2, 3, 4, 5, 6, 7, 8"
-
 import torch
 import torch.nn as nn
 from torch.nn import init
@@ -26,6 +24,7 @@ import datetime
 # Import my stuff
 import inception_utils
 import utils
+import layers
 import losses
 import train_fns
 from sync_batchnorm import patch_replication_callback
@@ -49,13 +48,21 @@ def run(config):
     print('Skipping initialization for training resumption...')
     config['skip_init'] = True
   config = utils.update_config_roots(config)
-  device = 'cuda'
+  # One process per device under torchrun, else one process for all GPUs
+  if config['distributed']:
+    if config['parallel']:
+      raise ValueError('--distributed replaces --parallel; pass only one')
+    device = utils.init_distributed(config['dist_backend'])
+  else:
+    device = 'cuda'
   num_devices = torch.cuda.device_count()
-  # Seed RNG
+  main_process = utils.is_main_process()
+  # Seed RNG; every process builds the same nets from it
   utils.seed_rng(config['seed'])
 
   # Prepare root folders if necessary
-  utils.prepare_root(config)
+  if main_process:
+    utils.prepare_root(config)
 
   # Setup cudnn.benchmark for free speed
   torch.backends.cudnn.benchmark = True
@@ -78,11 +85,22 @@ def run(config):
   if config['ema']:
     print('Preparing EMA for G with decay of {}'.format(config['ema_decay']))
     G_ema = model.Generator(**{**config, 'skip_init':True,
-                               'no_optim': True}).to(device)
-    ema = utils.ema(G, G_ema, config['ema_decay'], config['ema_start'])
+                               'no_optim': True}).to('cpu' if config['ema_offload'] else device)
   else:
-    G_ema, ema = None, None
+    G_ema = None
 
+  # Autocast mixed precision replaces casting the nets to half
+  if config['amp'] and (config['G_fp16'] or config['D_fp16']):
+    raise ValueError('--amp keeps fp32 params; drop --G_fp16/--D_fp16 to use it')
+  # The reused G output is the last D step's batch, so G can't train on more
+  if config['reuse_G_forward'] and config['G_batch_size'] > config['batch_size']:
+    raise ValueError('--reuse_G_forward needs G_batch_size <= batch_size')
+  # Cross-replica BN makes every G forward a collective, which all processes
+  # must run, so they can't each decide to replay fakes instead
+  if config['distributed'] and config['cross_replica'] and config['fake_replay_size'] > 0:
+    raise ValueError('--fake_replay_size needs --cross_replica off under --distributed')
+  # Loss scaling for fp16 autocast, shared by the G, D and Dv optimizers
+  scaler = torch.cuda.amp.GradScaler() if config['amp'] == 'fp16' else None
   # FP16?
   if config['G_fp16']:
     print('Casting G to float16...')
@@ -95,7 +113,30 @@ def run(config):
     if config['no_Dv'] == False:
       Dv = Dv.half()
     # Consider automatically reducing SN_eps?
-  GD = model.G_D(G, D,Dv, config['k'], config['T_into_B']) #xiaodan: add an argument k and T_into_B
+  if config['channels_last']:
+    print('Converting G, D and Dv to channels_last...')
+    for net in [G, D, Dv, G_ema]:
+      if net is not None:
+        utils.to_channels_last(net)
+  # Shard the optimizer states across processes, before loading the shards
+  if config['zero_optim']:
+    if not config['distributed']:
+      raise ValueError('--zero_optim shards across processes; it needs --distributed')
+    for net in [G, D, Dv]:
+      if net is not None:
+        utils.shard_optimizer(net)
+  # Built after any casts and layout changes, since those replace the
+  # tensors the EMA keeps lists of
+  if config['ema']:
+    which_ema = utils.offloaded_ema if config['ema_offload'] else utils.ema
+    ema = which_ema(G, G_ema, config['ema_decay'], config['ema_start'],
+                    config['ema_update_every'])
+    # An offloaded EMA keeps its own host copy of G_ema
+    G_ema = ema.target
+  else:
+    ema = None
+  GD = model.G_D(G, D,Dv, config['k'], config['T_into_B'],
+                 amp_dtype=utils.amp_dtype_dict[config['amp']]) #xiaodan: add an argument k and T_into_B
   # print('GD.k in train.py line 91',GD.k)
   # print(G) # xiaodan: print disabled by xiaodan. Too many stuffs
   # print(D)
@@ -105,6 +146,14 @@ def run(config):
   else:
     print('Number of params in G: {} D: {}'.format(
       *[sum([p.data.nelement() for p in net.parameters()]) for net in [G,D]]))
+  # Batch the SN power iterations of G, D and Dv? Built after any fp16 casts,
+  # since layers are grouped by dtype.
+  if config['SN_batched']:
+    sn_manager = layers.SNManager(G, D, Dv)
+    print('Batching power iterations of {} SN layers in {} groups'.format(
+      sn_manager.num_layers, len(sn_manager.groups)))
+  else:
+    sn_manager = None
   # Prepare state dict, which holds things like epoch # and itr #
   state_dict = {'itr': 0, 'epoch': 0, 'save_num': 0, 'save_best_num': 0,
                 'best_IS': 0, 'best_FID': 999999, 'config': config}
@@ -125,8 +174,15 @@ def run(config):
                        config['load_weights'] if config['load_weights'] else None,
                        G_ema if config['ema'] else None)
 
-  # If parallel, parallelize the GD module
-  if config['parallel']:
+  # If distributed, wrap G, D and Dv in DDP, else if parallel, parallelize
+  # the GD module
+  if config['distributed']:
+    hooks = {name: utils.comm_hook(config['%s_comm_hook' % name], config['powerSGD_rank'],
+                                   config['powerSGD_start_itr'])
+             for name in ['G', 'D', 'Dv']}
+    GD.distribute([device] if device.type == 'cuda' else None, hooks,
+                  bucket_cap_mb=config['bucket_cap_mb'])
+  elif config['parallel']:
     GD = nn.DataParallel(GD)
     if config['cross_replica']:
       patch_replication_callback(GD)
@@ -136,15 +192,16 @@ def run(config):
   test_metrics_fname = '%s/%s_log.jsonl' % (config['logs_root'],
                                             experiment_name)
   train_metrics_fname = '%s/%s' % (config['logs_root'], experiment_name)
-  print('Inception Metrics will be saved to {}'.format(test_metrics_fname))
-  test_log = utils.MetricsLogger(test_metrics_fname,
-                                 reinitialize=(not config['resume']))
-  print('Training Metrics will be saved to {}'.format(train_metrics_fname))
-  train_log = utils.MyLogger(train_metrics_fname,
-                             reinitialize=(not config['resume']),
-                             logstyle=config['logstyle'])
-  # Write metadata
-  utils.write_metadata(config['logs_root'], experiment_name, config, state_dict)
+  if main_process:
+    print('Inception Metrics will be saved to {}'.format(test_metrics_fname))
+    test_log = utils.MetricsLogger(test_metrics_fname,
+                                   reinitialize=(not config['resume']))
+    print('Training Metrics will be saved to {}'.format(train_metrics_fname))
+    train_log = utils.MyLogger(train_metrics_fname,
+                               reinitialize=(not config['resume']),
+                               logstyle=config['logstyle'])
+    # Write metadata
+    utils.write_metadata(config['logs_root'], experiment_name, config, state_dict)
   # Prepare data; the Discriminator's batch size is all that needs to be passed
   # to the dataloader, as G doesn't require dataloading.
   # Note that at every loader iteration we pass in enough data to complete
@@ -161,11 +218,13 @@ def run(config):
   # print(loaders[0])
   print('D loss weight:',config['D_loss_weight'])
   # Prepare inception metrics: FID and IS
-  if config['skip_testing'] == False:
+  if config['skip_testing'] == False and main_process:
     get_inception_metrics = inception_utils.prepare_inception_metrics(config['dataset'], config['parallel'], config['no_fid'])
 
   # Prepare noise and randomly sampled label arrays
-  # Allow for different batch sizes in G
+  # Allow for different batch sizes in G. Each process draws its own z and y.
+  if config['distributed']:
+    utils.seed_rng(config['seed'] + utils.get_rank())
   G_batch_size = max(config['G_batch_size'], config['batch_size']) # * num_devices #xiaodan: num_devices added by xiaodan
   # print('num_devices:',num_devices,'G_batch_size:',G_batch_size)
   z_, y_ = utils.prepare_z_y(G_batch_size, G.dim_z, config['n_classes'],
@@ -179,31 +238,69 @@ def run(config):
                                        fp16=config['G_fp16'])
   fixed_z.sample_()
   fixed_y.sample_()
+  # Power iterations only every few iterations, or once per optimizer step?
+  # Built after loading weights, since v is initialized from the loaded u.
+  if config['SN_update_every'] > 1 or config['SN_update_per_step']:
+    sn_schedule = layers.SNSchedule({'G': G, 'D': D, 'Dv': Dv}, config['SN_update_every'],
+                                    config['SN_update_per_step'], sn_manager)
+  else:
+    sn_schedule = None
+  # Recent fakes that D steps can train on instead of running G
+  if config['fake_replay_size'] > 0:
+    fake_replay = utils.FakeReplayBuffer(config['fake_replay_size'],
+                                         config['fake_replay_max_age'],
+                                         config['fake_replay_prob'],
+                                         config['fake_replay_offload'])
+  else:
+    fake_replay = None
   # Loaders are loaded, prepare the training function
   if config['which_train_fn'] == 'GAN':
     train = train_fns.GAN_training_function(G, D, Dv, GD, z_, y_,
-                                            ema, state_dict, config)
+                                            ema, state_dict, config,
+                                            sn_manager=sn_manager, scaler=scaler,
+                                            sn_schedule=sn_schedule,
+                                            fake_replay=fake_replay)
   # Else, assume debugging and use the dummy train fn
   else:
     train = train_fns.dummy_training_function()
   # Prepare Sample function for use with inception metrics
-  sample = functools.partial(utils.sample,
-                              G=(G_ema if config['ema'] and config['use_ema']
-                                 else G),
-                              z_=z_, y_=y_, config=config)
+  def sample_fn(G_ema):
+    return functools.partial(utils.sample,
+                             G=(G_ema if config['ema'] and config['use_ema']
+                                else G),
+                             z_=z_, y_=y_, config=config)
+  sample = sample_fn(G_ema)
+
+  # G_ema as saving, sampling and testing see it: an offloaded EMA is copied
+  # to the device only for those, and any standing stats accumulated on the
+  # copy are written back to it afterwards
+  def device_G_ema():
+    if config['ema'] and config['ema_offload']:
+      return ema.materialize(device)
+    return G_ema
+
+  def release_G_ema(device_copy):
+    if config['ema'] and config['ema_offload']:
+      ema.write_back(device_copy)
 
   print('Beginning training at epoch %d...' % state_dict['epoch'])
-  unique_id = datetime.datetime.now().strftime('%Y%m-%d%H-%M%S-')
-  tensorboard_path = os.path.join(config['logs_root'], 'tensorboard_logs', unique_id)
-  os.makedirs(tensorboard_path)
+  if main_process:
+    unique_id = datetime.datetime.now().strftime('%Y%m-%d%H-%M%S-')
+    tensorboard_path = os.path.join(config['logs_root'], 'tensorboard_logs', unique_id)
+    os.makedirs(tensorboard_path)
+    writer = SummaryWriter(log_dir=tensorboard_path)
+  else:
+    writer = None
   # Train for specified number of epochs, although we mostly track G iterations.
-  writer = SummaryWriter(log_dir=tensorboard_path)
   for epoch in range(state_dict['epoch'], config['num_epochs']):
+    # Reshuffle each process's shard of the data
+    if hasattr(loaders[0].sampler, 'set_epoch'):
+      loaders[0].sampler.set_epoch(epoch)
     # Which progressbar to use? TQDM or my own?
     if config['pbar'] == 'mine':
       pbar = utils.progress(loaders[0],displaytype='s1k' if config['use_multiepoch_sampler'] else 'eta')
     else:
-      pbar = tqdm(loaders[0])
+      pbar = tqdm(loaders[0], disable=not main_process)
     iteration = epoch * len(pbar)
     for i, (x, y) in enumerate(pbar):
       # Increment the iteration counter
@@ -221,7 +318,23 @@ def run(config):
         x, y = x.to(device).half(), y.to(device)
       else:
         x, y = x.to(device), y.to(device)
+      if config['channels_last']:
+        x = utils.video_channels_last(x)
       metrics = train(x, y, writer, iteration+i)
+      save_now = not (state_dict['itr'] % config['save_every'])
+      test_now = (not (state_dict['itr'] % config['test_every'])
+                  and config['skip_testing'] == False)
+      # Only the main process logs, saves and tests; the others only save
+      # their optimizer shards, then take G's buffers from the main process,
+      # as its sampling and test forwards may have moved them
+      if not main_process:
+        if config['zero_optim'] and save_now:
+          train_fns.save_optim_shards(G, D, Dv, state_dict, config, experiment_name)
+        if config['zero_optim'] and test_now:
+          train_fns.save_best_optim_shards(G, D, Dv, config, experiment_name)
+        if save_now or test_now:
+          utils.broadcast_buffers(G)
+        continue
       train_log.log(itr=int(state_dict['itr']), **metrics)
 
       # Every sv_log_interval, log singular values
@@ -240,27 +353,45 @@ def run(config):
                            for key in metrics]), end=' ')
 
       # Save weights and copies as configured at specified interval
-      if not (state_dict['itr'] % config['save_every']):
+      if save_now:
         if config['G_eval_mode']:
           print('Switchin G to eval mode...')
           G.eval()
           if config['ema']:
             G_ema.eval()
-        train_fns.save_and_sample(G, D, Dv, G_ema, z_, y_, fixed_z, fixed_y,
-                                  state_dict, config, experiment_name)
+        # Only this process runs these forwards, so BN can't sync in them
+        save_G_ema = device_G_ema()
+        with layers.local_bn():
+          train_fns.save_and_sample(G, D, Dv, save_G_ema, z_, y_, fixed_z, fixed_y,
+                                    state_dict, config, experiment_name)
+        release_G_ema(save_G_ema)
       #xiaodan: Disabled test for now because we don't have inception data
       # Test every specified interval
-      if not (state_dict['itr'] % config['test_every']) and config['skip_testing'] == False:
+      if test_now:
         if config['G_eval_mode']:
           print('Switchin G to eval mode...')
           G.eval()
-        IS_mean, IS_std, FID = train_fns.test(G, D, Dv, G_ema, z_, y_, state_dict, config, sample,
-                       get_inception_metrics, experiment_name, test_log)
+        test_G_ema = device_G_ema()
+        best_num = state_dict['save_best_num']
+        best = state_dict['best_%s' % config['which_best']]
+        with layers.local_bn():
+          IS_mean, IS_std, FID = train_fns.test(G, D, Dv, test_G_ema, z_, y_, state_dict, config,
+                         sample_fn(test_G_ema) if config['ema_offload'] else sample,
+                         get_inception_metrics, experiment_name, test_log)
+        release_G_ema(test_G_ema)
+        if config['zero_optim']:
+          improved = state_dict['best_%s' % config['which_best']] != best
+          train_fns.save_best_optim_shards(G, D, Dv, config, experiment_name,
+                                           'best%d' % best_num if improved else None)
         writer.add_scalar('Inception/IS', IS_mean, iteration+i)
         writer.add_scalar('Inception/IS_std', IS_std, iteration+i)
         writer.add_scalar('Inception/FID', FID, iteration+i)
+      if save_now or test_now:
+        utils.broadcast_buffers(G)
     # Increment epoch counter at end of epoch
     state_dict['epoch'] += 1
+  if config['distributed']:
+    torch.distributed.destroy_process_group()
 
 
 def main():
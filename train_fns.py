@@ -19,7 +19,8 @@ def dummy_training_function():
   return train
 
 
-def GAN_training_function(G, D, Dv, GD, z_, y_, ema, state_dict, config):
+def GAN_training_function(G, D, Dv, GD, z_, y_, ema, state_dict, config, sn_manager=None,
+                          scaler=None, sn_schedule=None, fake_replay=None):
   if 'UCF' in config['dataset']:
     classes = list(sorted(list_dir(config['data_root'])))
     idx_to_classes = {i: classes[i] for i in range(len(classes))}
@@ -30,8 +31,62 @@ def GAN_training_function(G, D, Dv, GD, z_, y_, ema, state_dict, config):
     idx_to_classes = {0:'airplane',1:'automobile',2:'bird',3:'cat',4:'deer',\
                         5:'dog',6:'frog',7:'horse',8:'ship',9:'truck'}
 
+  # With --amp fp16, losses are scaled by a GradScaler shared by all the
+  # optimizers: grads are unscaled before anything reads them (ortho reg,
+  # logging), and steps with inf/nan grads are skipped. The scale moves once
+  # per iteration, in update_scale(), after every optimizer has stepped.
+  def backward(loss):
+    (scaler.scale(loss) if scaler is not None else loss).backward()
+
+  def unscale(*optims):
+    if scaler is not None:
+      for optim in optims:
+        scaler.unscale_(optim)
+
+  # GradScaler steps each optimizer once between updates, so before D's
+  # optimizers step again (num_D_steps > 1) it is reset at the same scale,
+  # and the overflows found so far are kept for update_scale()
+  stepped, found_infs = [], []
+  def step(*optims):
+    for optim in optims:
+      if scaler is None:
+        optim.step()
+        continue
+      if optim in stepped:
+        found_infs.extend(found_inf for stepped_optim in stepped
+                          for found_inf in scaler._found_inf_per_device(stepped_optim).values())
+        scaler.update(scaler.get_scale())
+        del stepped[:]
+      scaler.step(optim)
+      stepped.append(optim)
+
+  def update_scale():
+    if scaler is None:
+      return
+    if found_infs and sum(found_inf.item() for found_inf in found_infs):
+      scaler.update(scaler.get_scale() * scaler.get_backoff_factor())
+    else:
+      scaler.update()
+    del stepped[:], found_infs[:]
+
+  # Let the SN layers advance their power iterations for the next GD call:
+  # as an SNSchedule allows, else all at once with an SNManager, else in
+  # every forward. first_forward names the nets whose first forward since
+  # their last optimizer step this is. A batched SNManager update also
+  # rewrites G's u and v in place, which a reused G graph saved for its
+  # backward, so with reused_G it is skipped (for D and Dv too).
+  def prepare_SN(first_forward, reused_G=False):
+    if reused_G and sn_manager is not None:
+      return
+    if sn_schedule is not None:
+      sn_schedule.prepare(state_dict['itr'], first_forward)
+    elif sn_manager is not None:
+      sn_manager.update()
+
   def train(x, y, tensor_writer = None, iteration=None):
     print('Summation will be taken',config['D_hinge_loss_sum'],'D hinge loss')
+    # Lazy ortho reg: only every ortho_every iterations, scaled to match
+    apply_ortho = not (state_dict['itr'] % config['ortho_every'])
     G.optim.zero_grad()
     D.optim.zero_grad()
     if config['no_Dv'] == False:
@@ -64,14 +119,29 @@ def GAN_training_function(G, D, Dv, GD, z_, y_, ema, state_dict, config):
         utils.toggle_grad(Dv, True)
       utils.toggle_grad(G, False)
 
+    kept_G_z = None
     for step_index in range(config['num_D_steps']):
       # If accumulating gradients, loop multiple times before an optimizer step
       D.optim.zero_grad()
       if config['no_Dv'] == False:
         Dv.optim.zero_grad()
       for accumulation_index in range(config['num_D_accumulations']):
-        z_.sample_()
-        y_.sample_()
+        # On the very last D pass, optionally keep G's graph for the G step
+        keep_G = (config['reuse_G_forward']
+                  and step_index == config['num_D_steps'] - 1
+                  and accumulation_index == config['num_D_accumulations'] - 1)
+        # Optionally train D on recent fakes instead of running G
+        replayed = None
+        if fake_replay is not None and not keep_G:
+          replayed = fake_replay.draw(state_dict['itr'])
+        if replayed is None:
+          z_.sample_()
+          y_.sample_()
+        fake_G_z, fake_y = (None, y_[:config['batch_size']]) if replayed is None else replayed
+        if keep_G and config['toggle_grads']:
+          utils.toggle_grad(G, True)
+        prepare_SN((['D', 'Dv'] if accumulation_index == 0 else [])
+                   + (['G'] if keep_G else []))
         # print('z_ size in GAN tranining func:',z_.shape)
         # print('y_ size in GAN tranining func:',y_.shape)
         #xiaodan: D_fake, D_real [B*8,1]
@@ -79,18 +149,23 @@ def GAN_training_function(G, D, Dv, GD, z_, y_, ema, state_dict, config):
         # print('Shape of z_[:config[batch_size]]:',z_[:config['batch_size']].shape)
         # print('config[batch_size]',config['batch_size'])
         if config['no_Dv'] == False:
-          D_fake, D_real, Dv_fake, Dv_real, G_z = GD(z_[:config['batch_size']], y_[:config['batch_size']],
-                              x[counter], y[counter], train_G=False,
-                              split_D=config['split_D'], tensor_writer=tensor_writer, iteration=iteration)
+          D_fake, D_real, Dv_fake, Dv_real, G_z = GD(z_[:config['batch_size']], fake_y,
+                              x[counter], y[counter], train_G=keep_G, detach_G_z=keep_G,
+                              split_D=config['split_D'], tensor_writer=tensor_writer, iteration=iteration,
+                              G_z=fake_G_z)
         else:
-          D_fake, D_real, G_z = GD(z_[:config['batch_size']], y_[:config['batch_size']],
-                              x[counter], y[counter], train_G=False,
-                              split_D=config['split_D'], tensor_writer=tensor_writer, iteration=iteration)
-        # print('GD.k in train_fns line 49',GD.module.k) #GD.module because GD is now dataparallel class
+          D_fake, D_real, G_z = GD(z_[:config['batch_size']], fake_y,
+                              x[counter], y[counter], train_G=keep_G, detach_G_z=keep_G,
+                              split_D=config['split_D'], tensor_writer=tensor_writer, iteration=iteration,
+                              G_z=fake_G_z)
+        if keep_G:
+          kept_G_z = G_z
+        if fake_replay is not None and replayed is None:
+          fake_replay.add(G_z, fake_y, state_dict['itr'])
         # D_fake & D_real shapes: [Bk,1], [Bk,1]
         # xiaodan: Make scores back to [B,k,1] for easier summation in discriminator_loss
-        D_fake = D_fake.contiguous().view(-1,GD.module.k,*D_fake.shape[1:])#[B,k,1]
-        D_real = D_real.contiguous().view(-1,GD.module.k,*D_real.shape[1:])#[B,k,1]
+        D_fake = D_fake.contiguous().view(-1,config['k'],*D_fake.shape[1:])#[B,k,1]
+        D_real = D_real.contiguous().view(-1,config['k'],*D_real.shape[1:])#[B,k,1]
         if config['D_hinge_loss_sum'] == 'before':
           D_fake = torch.sum(D_fake,1) #xiaodan: add k scores before doing hinge loss, according to the paper
           D_real = torch.sum(D_real,1) #[B,1]
@@ -114,22 +189,18 @@ def GAN_training_function(G, D, Dv, GD, z_, y_, ema, state_dict, config):
           D_loss = (D_loss_real + D_loss_fake + Dv_loss_fake + Dv_loss_real) / float(config['num_D_accumulations'])
         else:
           D_loss = (D_loss_real + D_loss_fake) / float(config['num_D_accumulations'])
-        D_loss.backward()
+        backward(D_loss)
         counter += 1
 
-      # Optionally apply ortho reg in D
-      if config['D_ortho'] > 0.0:
-        # Debug print to indicate we're using ortho reg in D.
+      unscale(*([D.optim] if config['no_Dv'] else [D.optim, Dv.optim]))
+      # Optionally apply ortho reg in D (in Dv instead when it exists)
+      if config['D_ortho'] > 0.0 and apply_ortho:
         if config['no_Dv'] == False:
-          print('using modified ortho reg in D and Dv')
-          utils.ortho(Dv, config['D_ortho'])
+          utils.ortho(Dv, config['D_ortho'] * config['ortho_every'])
         else:
-          print('using modified ortho reg in D')
-          utils.ortho(D, config['D_ortho'])
+          utils.ortho(D, config['D_ortho'] * config['ortho_every'])
 
-      D.optim.step()
-      if config['no_Dv'] == False:
-        Dv.optim.step()
+      step(*([D.optim] if config['no_Dv'] else [D.optim, Dv.optim]))
 
     # Optionally toggle "requires_grad"
     if config['toggle_grads']:
@@ -143,15 +214,27 @@ def GAN_training_function(G, D, Dv, GD, z_, y_, ema, state_dict, config):
 
     # If accumulating gradients, loop multiple times
     for accumulation_index in range(config['num_G_accumulations']):
-      z_.sample_()
-      y_.sample_()
+      # The first pass may reuse the last D step's G output: same z and y, and
+      # G's weights haven't changed since, so only D and Dv run again (with
+      # their freshly stepped weights) and G's BN stats and SN move only once.
+      # With an SNManager, D and Dv's SN then doesn't advance on this pass.
+      reuse_G_z = kept_G_z if accumulation_index == 0 else None
+      if reuse_G_z is None:
+        z_.sample_()
+        y_.sample_()
+      prepare_SN(['G'] if accumulation_index == 0 and reuse_G_z is None else [],
+                 reused_G=reuse_G_z is not None)
+      # Match the batch the kept G output was made from
+      z, gy = ((z_, y_) if reuse_G_z is None
+               else (z_[:config['batch_size']], y_[:config['batch_size']]))
       # print('z_,y_ shapes before pass into GD:',z_.shape,y_.shape)
       if config['no_Dv'] == False:
-        D_fake, Dv_fake, G_z= GD(z_, y_, train_G=True, split_D=config['split_D'], tensor_writer=tensor_writer, iteration=iteration)
+        D_fake, Dv_fake, G_z= GD(z, gy, train_G=True, split_D=config['split_D'], tensor_writer=tensor_writer, iteration=iteration, G_z=reuse_G_z)
       else:
-        D_fake, G_z= GD(z_, y_, train_G=True, split_D=config['split_D'], tensor_writer=tensor_writer, iteration=iteration)
+        D_fake, G_z= GD(z, gy, train_G=True, split_D=config['split_D'], tensor_writer=tensor_writer, iteration=iteration, G_z=reuse_G_z)
+      kept_G_z = None
 
-      D_fake = D_fake.contiguous().view(-1,GD.module.k,*D_fake.shape[1:]) #[B, k, 1]
+      D_fake = D_fake.contiguous().view(-1,config['k'],*D_fake.shape[1:]) #[B, k, 1]
       D_fake = torch.mean(D_fake,1) # [B,1]  xiaodan: average k scores before doing hinge loss
 
       G_loss = config['D_loss_weight'] * losses.generator_loss(D_fake) / float(config['num_G_accumulations'])
@@ -170,13 +253,13 @@ def GAN_training_function(G, D, Dv, GD, z_, y_, ema, state_dict, config):
           G_loss += mean_pixel_loss
         else:
           mean_pixel_loss = 0
-      G_loss.backward()
+      backward(G_loss)
 
+    unscale(G.optim)
     # Optionally apply modified ortho reg in G
-    if config['G_ortho'] > 0.0:
-      print('using modified ortho reg in G') # Debug print to indicate we're using ortho reg in G
+    if config['G_ortho'] > 0.0 and apply_ortho:
       # Don't ortho reg shared, it makes no sense. Really we should blacklist any embeddings for this
-      utils.ortho(G, config['G_ortho'],
+      utils.ortho(G, config['G_ortho'] * config['ortho_every'],
                   blacklist=[param for param in G.shared.parameters()])
     if config['no_convgru'] == False:
       G_grad_gates = G.convgru.convgru.cell_list[0].conv_gates.weight.grad.abs().sum()
@@ -185,7 +268,8 @@ def GAN_training_function(G, D, Dv, GD, z_, y_, ema, state_dict, config):
       G_weight_gates = G.convgru.convgru.cell_list[0].conv_gates.weight.abs().mean()
       G_weight_can = G.convgru.convgru.cell_list[0].conv_can.weight.abs().mean()
       G_weight_first_layer = G.blocks[0][0].conv1.weight.abs().mean()
-    G.optim.step()
+    step(G.optim)
+    update_scale()
 
     # If we have an ema, update it, regardless of if we test with it or not
     if config['ema']:
@@ -200,6 +284,8 @@ def GAN_training_function(G, D, Dv, GD, z_, y_, ema, state_dict, config):
       out = {'G_loss': float(G_loss.item()),
               'D_loss_real': float(D_loss_real.item()),
               'D_loss_fake': float(D_loss_fake.item())}
+    if fake_replay is not None:
+      out['fake_replay_hit_ratio'] = fake_replay.hit_ratio()
     if tensor_writer != None and iteration % config['log_results_every'] == 0:
       tensor_writer.add_video('Video Results', (G_z + 1)/2, iteration)
       mean_pixel_val = torch.mean((G_z + 1)/2, dim=[0, 1, 3, 4])
@@ -217,6 +303,8 @@ def GAN_training_function(G, D, Dv, GD, z_, y_, ema, state_dict, config):
       tensor_writer.add_scalar('Loss/G_loss', out['G_loss'], iteration)
       tensor_writer.add_scalar('Loss/D_loss_real', out['D_loss_real'], iteration)
       tensor_writer.add_scalar('Loss/D_loss_fake', out['D_loss_fake'], iteration)
+      if fake_replay is not None:
+        tensor_writer.add_scalar('Replay/fake_replay_hit_ratio', out['fake_replay_hit_ratio'], iteration)
       if config['no_Dv'] == False:
         tensor_writer.add_scalar('Loss/Dv_loss_fake', out['Dv_loss_fake'], iteration)
         tensor_writer.add_scalar('Loss/Dv_loss_real', out['Dv_loss_real'], iteration)
@@ -235,6 +323,24 @@ def GAN_training_function(G, D, Dv, GD, z_, y_, ema, state_dict, config):
     requested), and prepares sample sheets: one consisting of samples given
     a fixed noise seed (to show how the model evolves throughout training),
     a set of full conditional sample sheets, and a set of interp sheets. '''
+# Under --zero_optim, the processes other than the main one save their own
+# optimizer shards whenever it saves, under the same names
+def save_optim_shards(G, D, Dv, state_dict, config, experiment_name):
+  utils.save_optim_states(G, D, Dv, config['weights_root'], experiment_name)
+  if config['num_save_copies'] > 0:
+    utils.save_optim_states(G, D, Dv, config['weights_root'], experiment_name,
+                            'copy%d' %  state_dict['save_num'])
+    state_dict['save_num'] = (state_dict['save_num'] + 1 ) % config['num_save_copies']
+
+# Likewise for best copies, which only the main process's test decides on:
+# it passes the suffix of the best copy it just saved, if any, and the other
+# processes save their shards under it. Every process must call this.
+def save_best_optim_shards(G, D, Dv, config, experiment_name, best_suffix=None):
+  best_suffix = utils.broadcast_object(best_suffix)
+  if best_suffix is not None and not utils.is_main_process():
+    utils.save_optim_states(G, D, Dv, config['weights_root'], experiment_name, best_suffix)
+
+
 def save_and_sample(G, D, Dv, G_ema, z_, y_, fixed_z, fixed_y,
                     state_dict, config, experiment_name):
   utils.save_weights(G, D, Dv, state_dict, config['weights_root'],
@@ -15,6 +15,9 @@ import time
 import datetime
 import json
 import pickle
+import copy
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
 import animal_hash
 
@@ -27,6 +30,7 @@ import torchvision.transforms as transforms
 from torch.utils.data import DataLoader, Dataset
 
 import datasets as dset
+import layers
 
 def prepare_parser():
   usage = 'Parser for all scripts.'
@@ -67,6 +71,14 @@ def prepare_parser():
   parser.add_argument(
     '--cache_csv_path', type = str, default='/home/ubuntu/kinetics-400/kinetics/file_cache.csv',
     help='Where is the frames cache file? (default: %(default)s)')
+  parser.add_argument(
+    '--video_store', type=str, default='jpeg',
+    help='Which Kinetics store to load clips from, jpeg (the frame tree from '
+         'extract_jpegs.py) or mp4 (the store from make_mp4_store.py) '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--mp4_store_root', type=str, default='/home/ubuntu/kinetics-400/kinetics/mp4_store',
+    help='Where is the mp4 clip store? (default: %(default)s)')
 
   ### Model stuff ###
   parser.add_argument(
@@ -113,7 +125,8 @@ def prepare_parser():
     help='Use hierarchical z in G? (default: %(default)s)')
   parser.add_argument(
     '--cross_replica', action='store_true', default=False,
-    help='Cross_replica batchnorm in G?(default: %(default)s)')
+    help='Cross_replica batchnorm in G, across DataParallel replicas or, '
+         'under --distributed, across processes? (default: %(default)s)')
   parser.add_argument(
     '--mybn', action='store_true', default=False,
     help='Use my batchnorm (which supports standing stats?) %(default)s)')
@@ -127,6 +140,16 @@ def prepare_parser():
     '--G_attn', type=str, default='64',
     help='What resolutions to use attention on for G (underscore separated) '
          '(default: %(default)s)')
+  parser.add_argument(
+    '--G_attn_chunk', type=int, default=0,
+    help='Chunk length for memory-bounded full attention in G, recomputed in '
+         'backward; 0 to build the full THW x THW map (default: %(default)s)')
+  parser.add_argument(
+    '--checkpoint', type=str, default='',
+    help='What to recompute in backward instead of storing activations '
+         '(underscore separated): G for GBlocks, D for DBlocks, Dv for Dv\'s '
+         'blocks, attn for the attention modules of all three '
+         '(default: %(default)s)')
   # xiaodan: add the argument of video length time step.
   parser.add_argument(
     '--time_steps', type=int, default=12,
@@ -256,6 +279,28 @@ def prepare_parser():
     '--num_D_accumulations', type=int, default=1,
     help='Number of passes to accumulate D''s gradients over '
          '(default: %(default)s)')
+  parser.add_argument(
+    '--reuse_G_forward', action='store_true', default=False,
+    help='Keep G\'s graph from the last D step and reuse its output for the '
+         'first G accumulation instead of running G again? Trains on the last '
+         'D step\'s z and y; needs G_batch_size <= batch_size. With '
+         '--SN_batched, that pass doesn\'t advance SN. (default: %(default)s)')
+  parser.add_argument(
+    '--fake_replay_size', type=int, default=0,
+    help='Keep this many recent batches of G output for D steps to train on '
+         'in place of fresh fakes; 0 disables (default: %(default)s)')
+  parser.add_argument(
+    '--fake_replay_prob', type=float, default=0.5,
+    help='Chance that a D pass trains on replayed fakes when fresh enough '
+         'ones are stored (default: %(default)s)')
+  parser.add_argument(
+    '--fake_replay_max_age', type=int, default=1,
+    help='Only replay fakes generated at most this many G steps ago '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--fake_replay_offload', action='store_true', default=False,
+    help='Keep the replayed fakes in pinned host memory rather than on the '
+         'GPU? (default: %(default)s)')
   parser.add_argument(
     '--split_D', action='store_true', default=False,
     help='Run D twice rather than concatenating inputs? (default: %(default)s)')
@@ -265,6 +310,38 @@ def prepare_parser():
   parser.add_argument(
     '--parallel', action='store_true', default=False,
     help='Train with multiple GPUs (default: %(default)s)')
+  parser.add_argument(
+    '--distributed', action='store_true', default=False,
+    help='Train with one process per device, as launched by torchrun, with '
+         'G, D and Dv in DistributedDataParallel? batch_size is then per '
+         'process. (default: %(default)s)')
+  for net in ['G', 'D', 'Dv']:
+    parser.add_argument(
+      '--%s_comm_hook' % net, type=str, default='',
+      help='How DDP communicates %s\'s grads under --distributed: \'\' for '
+           'an fp32 all_reduce, fp16 or bf16 to all_reduce compressed grads, '
+           'powerSGD for low-rank approximations (default: %%(default)s)' % net)
+  parser.add_argument(
+    '--powerSGD_rank', type=int, default=1,
+    help='Rank of the PowerSGD grad approximations (default: %(default)s)')
+  parser.add_argument(
+    '--powerSGD_start_itr', type=int, default=1000,
+    help='Communicate full fp32 grads for this many steps before starting '
+         'PowerSGD (default: %(default)s)')
+  parser.add_argument(
+    '--zero_optim', action='store_true', default=False,
+    help='Under --distributed, shard the optimizer states of G, D and Dv '
+         'across processes, ZeRO-1 style? Each process then saves and loads '
+         'its own shard, so resuming needs the same number of processes. '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--bucket_cap_mb', type=float, default=25,
+    help='Size in MB of the buckets DDP groups grads into for each '
+         'all_reduce (default: %(default)s)')
+  parser.add_argument(
+    '--dist_backend', type=str, default='nccl',
+    help='torch.distributed backend for --distributed: nccl for GPUs, gloo '
+         'to run the processes on CPU (default: %(default)s)')
   parser.add_argument(
     '--G_fp16', action='store_true', default=False,
     help='Train with half-precision in G? (default: %(default)s)')
@@ -275,10 +352,28 @@ def prepare_parser():
     '--D_mixed_precision', action='store_true', default=False,
     help='Train with half-precision activations but fp32 params in D? '
          '(default: %(default)s)')
+  parser.add_argument(
+    '--G_adam8bit', action='store_true', default=False,
+    help='Keep G\'s Adam moments in blockwise-quantized 8 bits? '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--D_adam8bit', action='store_true', default=False,
+    help='Keep D\'s and Dv\'s Adam moments in blockwise-quantized 8 bits? '
+         '(default: %(default)s)')
   parser.add_argument(
     '--G_mixed_precision', action='store_true', default=False,
     help='Train with half-precision activations but fp32 params in G? '
          '(default: %(default)s)')
+  parser.add_argument(
+    '--amp', type=str, default='', choices=['', 'fp16', 'bf16'],
+    help='Run G, D and Dv under autocast with fp32 params, in place of '
+         '--G_fp16/--D_fp16; fp16 scales the losses with a GradScaler shared '
+         'by all optimizers, bf16 also runs on CPU (default: %(default)s)')
+  parser.add_argument(
+    '--channels_last', action='store_true', default=False,
+    help='Store the conv weights and activations of G, D and Dv as '
+         'channels_last (2D) / channels_last_3d (3D), so cuDNN and oneDNN '
+         'run their NHWC kernels? (default: %(default)s)')
   parser.add_argument(
     '--accumulate_stats', action='store_true', default=False,
     help='Accumulate "standing" batchnorm stats? (default: %(default)s)')
@@ -373,6 +468,15 @@ def prepare_parser():
   parser.add_argument(
     '--ema_start', type=int, default=0,
     help='When to start updating the EMA weights (default: %(default)s)')
+  parser.add_argument(
+    '--ema_update_every', type=int, default=1,
+    help='Update the EMA weights every this many iterations, with the decay '
+         'raised to the same power (default: %(default)s)')
+  parser.add_argument(
+    '--ema_offload', action='store_true', default=False,
+    help='Keep the EMA generator in pinned host memory, updated from a '
+         'background thread, and only copy it to the GPU to sample or test? '
+         '(default: %(default)s)')
 
   ### Numerical precision and SV stuff ###
   parser.add_argument(
@@ -396,6 +500,19 @@ def prepare_parser():
   parser.add_argument(
     '--num_D_SV_itrs', type=int, default=1,
     help='Number of SV itrs in D (default: %(default)s)')
+  parser.add_argument(
+    '--SN_batched', action='store_true', default=False,
+    help='Run the power iterations of all SN layers in G, D and Dv as a few '
+         'batched calls per step instead of per layer? (default: %(default)s)')
+  parser.add_argument(
+    '--SN_update_every', type=int, default=1,
+    help='Advance the SN power iterations of G, D and Dv only every this many '
+         'iterations, reusing u and v in between (default: %(default)s)')
+  parser.add_argument(
+    '--SN_update_per_step', action='store_true', default=False,
+    help='Advance each net\'s SN power iterations once per optimizer step, in '
+         'its first forward after the step, rather than in every forward? '
+         '(default: %(default)s)')
 
   ### Ortho reg stuff ###
   parser.add_argument(
@@ -404,6 +521,10 @@ def prepare_parser():
   parser.add_argument(
     '--D_ortho', type=float, default=0.0,
     help='Modified ortho reg coefficient in D (default: %(default)s)')
+  parser.add_argument(
+    '--ortho_every', type=int, default=1,
+    help='Apply ortho reg only every this many iterations, with its strength '
+         'multiplied by the same factor (default: %(default)s)')
   parser.add_argument(
     '--toggle_grads', action='store_true', default=True,
     help='Toggle D and G''s "requires_grad" settings when not training them? '
@@ -482,6 +603,11 @@ def add_sample_parser(parser):
   parser.add_argument(
     '--sample_inception_metrics', action='store_true', default=False,
     help='Calculate Inception metrics with sample.py? (default: %(default)s)')
+  parser.add_argument(
+    '--sample_long_video', type=int, default=0,
+    help='Stream a video of this many chunks of time_steps frames, carrying '
+         'the ConvGRU state between chunks, and save its frames to the '
+         'samples root? (default: %(default)s)')
   return parser
 
 # Convenience dicts
@@ -518,6 +644,8 @@ classes_per_sheet_dict = {'I32': 50, 'I32_hdf5': 50,
 activation_dict = {'inplace_relu': nn.ReLU(inplace=True),
                    'relu': nn.ReLU(inplace=False),
                    'ir': nn.ReLU(inplace=True),}
+# Autocast dtype for each --amp setting
+amp_dtype_dict = {'': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
 
 class CenterCropLongEdge(object):
   """Crops the given PIL Image on the long edge.
@@ -670,6 +798,13 @@ def get_data_loaders(dataset, data_root=None, augment=False, batch_size=64,
   loaders.append(train_loader)
   return loaders
 
+# Under --distributed, each process loads its own shard of the dataset, which
+# is reshuffled every epoch by calling the sampler's set_epoch. None otherwise.
+def distributed_sampler(dataset, shuffle=True, distributed=False):
+  if not distributed:
+    return None
+  return torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle)
+
 def get_video_cifar_data_loader(dataset, data_root=None, augment=False, batch_size=64,
                      num_workers=8, shuffle=True, load_in_mem=False, hdf5=False,
                      pin_memory=True, drop_last=True, start_itr=0,
@@ -718,8 +853,10 @@ def get_video_cifar_data_loader(dataset, data_root=None, augment=False, batch_si
 
   loader_kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory,
                    'drop_last': drop_last} # Default, drop last incomplete batch
+  sampler = distributed_sampler(train_set, shuffle, kwargs.get('distributed', False))
   train_loader = DataLoader(train_set, batch_size=batch_size,
-                            shuffle=shuffle, **loader_kwargs)
+                            shuffle=shuffle and sampler is None, sampler=sampler,
+                            **loader_kwargs)
   return [train_loader]
 
 def get_video_data_loaders(dataset, data_root=None, annotation_path=None, augment=False, batch_size=64,
@@ -727,6 +864,7 @@ def get_video_data_loaders(dataset, data_root=None, annotation_path=None, augmen
                      num_workers=8, shuffle=True, load_in_mem=False, hdf5=True,
                      pin_memory=True, drop_last=True, start_itr=0,
                      num_epochs=500, use_multiepoch_sampler=False, frame_size = 128,
+                     video_store='jpeg', mp4_store_root=None,
                      **kwargs):
 
   # # Append /FILENAME.hdf5 to root if using hdf5
@@ -756,10 +894,17 @@ def get_video_data_loaders(dataset, data_root=None, annotation_path=None, augmen
     save_path = '/home/ubuntu/kinetics-400/kinetics/frames'
     label_csv_path = '/home/ubuntu/kinetics-400/kinetics/csv/kinetics-400_train.csv'
     cache_csv_path = '/home/ubuntu/kinetics-400/kinetics/file_cache.csv'
-    video_dataset = dset.vid2frame_dataset(data_root=data_root, save_path=save_path, label_csv_path=label_csv_path,
-                        cache_csv_path=cache_csv_path, extensions=None, clip_length_in_frames=time_steps,
-                        frame_rate=12, transforms=train_transform, cache_exists=True)
-  return [DataLoader(video_dataset, batch_size=batch_size, shuffle=shuffle, **loader_kwargs)]
+    if video_store == 'mp4':
+      print('Loading clips from the mp4 store at %s' % mp4_store_root)
+      video_dataset = dset.mp4_clip_dataset(mp4_store_root, clip_length_in_frames=time_steps,
+                                            transforms=train_transform)
+    else:
+      video_dataset = dset.vid2frame_dataset(data_root=data_root, save_path=save_path, label_csv_path=label_csv_path,
+                          cache_csv_path=cache_csv_path, extensions=None, clip_length_in_frames=time_steps,
+                          frame_rate=12, transforms=train_transform, cache_exists=True)
+  sampler = distributed_sampler(video_dataset, shuffle, kwargs.get('distributed', False))
+  return [DataLoader(video_dataset, batch_size=batch_size, shuffle=shuffle and sampler is None,
+                     sampler=sampler, **loader_kwargs)]
 
 def get_inception_video_data_loaders(dataset, data_root=None, annotation_path=None, augment=False, batch_size=64,
                      time_steps=12, frames_between_clips=10e6,
@@ -837,6 +982,65 @@ def seed_rng(seed):
   np.random.seed(seed)
 
 
+# Join the process group torchrun describes in the environment and return
+# this process's device: its local GPU under nccl, the CPU under gloo.
+def init_distributed(backend='nccl'):
+  torch.distributed.init_process_group(backend)
+  if backend == 'nccl':
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    torch.cuda.set_device(local_rank)
+    return torch.device('cuda', local_rank)
+  return torch.device('cpu')
+
+# DDP communication hook for --G_comm_hook etc., as the (state, hook) pair
+# for register_comm_hook, or None to keep DDP's own fp32 all_reduce. Every
+# net gets its own state, as PowerSGD keeps per-bucket errors and factors.
+def comm_hook(name, powerSGD_rank=1, powerSGD_start_itr=1000):
+  from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+  if not name:
+    return None
+  if name == 'fp16':
+    return None, default_hooks.fp16_compress_hook
+  if name == 'bf16':
+    return None, default_hooks.bf16_compress_hook
+  if name == 'powerSGD':
+    state = powerSGD_hook.PowerSGDState(process_group=None,
+                                        matrix_approximation_rank=powerSGD_rank,
+                                        start_powerSGD_iter=powerSGD_start_itr)
+    return state, powerSGD_hook.powerSGD_hook
+  raise ValueError('Unknown DDP comm hook %s' % name)
+
+def is_distributed():
+  return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+def get_rank():
+  return torch.distributed.get_rank() if is_distributed() else 0
+
+def get_world_size():
+  return torch.distributed.get_world_size() if is_distributed() else 1
+
+# Only the main process logs, saves and tests
+def is_main_process():
+  return get_rank() == 0
+
+# Send a picklable object from rank 0 to every process, which must all call
+# this; returns it unchanged when not distributed
+def broadcast_object(obj, src=0):
+  if not is_distributed():
+    return obj
+  objs = [obj]
+  torch.distributed.broadcast_object_list(objs, src)
+  return objs[0]
+
+# Copy a net's buffers (BN stats, SN vectors) from rank 0 to every process,
+# after forwards that only rank 0 ran. Every process must call it.
+def broadcast_buffers(net, src=0):
+  if not is_distributed():
+    return
+  for buf in net.buffers():
+    torch.distributed.broadcast(buf, src)
+
+
 # Utility to peg all roots to a base root
 # If a base root folder is provided, peg all other root folders to it.
 def update_config_roots(config):
@@ -859,62 +1063,239 @@ def prepare_root(config):
 # the parameters() and buffers() module functions, but for now this works
 # with state_dicts using .copy_
 class ema(object):
-  def __init__(self, source, target, decay=0.9999, start_itr=0):
+  def __init__(self, source, target, decay=0.9999, start_itr=0, update_every=1):
     self.source = source
     self.target = target
     self.decay = decay
     # Optional parameter indicating what iteration to start the decay at
     self.start_itr = start_itr
+    # Only update every this many iterations, with decay ** update_every
+    self.update_every = update_every
     # Initialize target's params to be source's
     self.source_dict = self.source.state_dict()
     self.target_dict = self.target.state_dict()
     print('Initializing EMA parameters to be source parameters...')
     with torch.no_grad():
       for key in self.source_dict:
-        self.target_dict[key].data.copy_(self.source_dict[key].data)
+        self.target_dict[key].copy_(self.source_dict[key])
         # target_dict[key].data = source_dict[key].data # Doesn't work!
+    # Float parameters are averaged; buffers (SN's u and sv, BN stats,
+    # counters) are copied. The lists hold the state_dict tensors rather than
+    # .data, so writes advance the target's version counters and invalidate
+    # its cached SN weights.
+    param_names = set(name for name, _ in self.source.named_parameters())
+    params = [key for key in self.source_dict
+              if key in param_names and self.source_dict[key].is_floating_point()]
+    buffers = [key for key in self.source_dict if key not in params]
+    self.source_params = [self.source_dict[key] for key in params]
+    self.target_params = [self.target_dict[key] for key in params]
+    self.source_buffers = [self.source_dict[key] for key in buffers]
+    self.target_buffers = [self.target_dict[key] for key in buffers]
 
   def update(self, itr=None):
+    if itr and self.update_every > 1 and itr % self.update_every:
+      return
     # If an iteration counter is provided and itr is less than the start itr,
     # peg the ema weights to the underlying weights.
     if itr and itr < self.start_itr:
       decay = 0.0
     else:
-      decay = self.decay
+      decay = self.decay ** self.update_every
     with torch.no_grad():
-      for key in self.source_dict:
-        self.target_dict[key].data.copy_(self.target_dict[key].data * decay
-                                     + self.source_dict[key].data * (1 - decay))
+      # target = decay * target + (1 - decay) * source, in place
+      layers.foreach_lerp_(self.target_params, self.source_params, 1 - decay)
+      layers.foreach_copy_(self.target_buffers, self.source_buffers)
+
+
+# EMA of G held in (pinned) host memory and updated off the training thread.
+# On each update G's params and buffers are copied into pinned snapshots with
+# non-blocking copies on the current stream, so later optimizer steps are
+# ordered after them, and a background thread folds the snapshot into the
+# CPU target once the copies have landed. Use materialize() to get a device
+# copy for sampling or evaluation.
+class offloaded_ema(ema):
+  def __init__(self, source, target, decay=0.9999, start_itr=0, update_every=1):
+    self.pin = torch.cuda.is_available()
+    target = target.cpu()
+    if self.pin:
+      for tensor in list(target.parameters()) + list(target.buffers()):
+        tensor.data = tensor.data.pin_memory()
+    super(offloaded_ema, self).__init__(source, target, decay, start_itr, update_every)
+    self.snapshots = [torch.empty(item.shape, dtype=item.dtype, pin_memory=self.pin)
+                      for item in self.source_params + self.source_buffers]
+    self.executor = ThreadPoolExecutor(max_workers=1)
+    self.job = None
+
+  def update(self, itr=None):
+    if itr and self.update_every > 1 and itr % self.update_every:
+      return
+    if itr and itr < self.start_itr:
+      decay = 0.0
+    else:
+      decay = self.decay ** self.update_every
+    # The last fold must be done with the snapshots before they're overwritten
+    self.synchronize()
+    with torch.no_grad():
+      for snapshot, item in zip(self.snapshots, self.source_params + self.source_buffers):
+        snapshot.copy_(item, non_blocking=True)
+    event = None
+    if self.source_params and self.source_params[0].is_cuda:
+      event = torch.cuda.Event()
+      event.record()
+    num_params = len(self.source_params)
+    def fold():
+      if event is not None:
+        event.synchronize()
+      with torch.no_grad():
+        layers.foreach_lerp_(self.target_params, self.snapshots[:num_params], 1 - decay)
+        layers.foreach_copy_(self.target_buffers, self.snapshots[num_params:])
+    self.job = self.executor.submit(fold)
+
+  # Wait for the pending update, if any
+  def synchronize(self):
+    if self.job is not None:
+      self.job.result()
+      self.job = None
+
+  # An up-to-date copy of the EMA generator on device
+  def materialize(self, device='cuda'):
+    self.synchronize()
+    return copy.deepcopy(self.target).to(device)
+
+  # Copy a materialized copy's buffers and standing-stats mode back into the
+  # host EMA, so stats accumulated on the copy are kept, as they are when
+  # the EMA is not offloaded
+  def write_back(self, copied):
+    self.synchronize()
+    with torch.no_grad():
+      for target, item in zip(self.target.buffers(), copied.buffers()):
+        target.copy_(item)
+    for target, module in zip(self.target.modules(), copied.modules()):
+      if hasattr(module, 'accumulate_standing'):
+        target.accumulate_standing = module.accumulate_standing
+
+
+# Recent batches of G output, with the labels they were generated for, for D
+# steps to train on in place of a fresh G forward. Holds up to size batches in
+# a ring, on G's device or, if offload, in pinned host memory, and only serves
+# batches generated at most max_age iterations (G steps) ago. Each draw hits
+# with probability prob when a fresh enough batch exists; hit_ratio() reports
+# the share of draws served from the buffer.
+class FakeReplayBuffer(object):
+  def __init__(self, size, max_age=1, prob=0.5, offload=False):
+    self.size = size
+    self.max_age = max_age
+    self.prob = prob
+    self.offload = offload
+    self.pin = offload and torch.cuda.is_available()
+    # [itr, G_z, gy] per slot, and the slot to overwrite next
+    self.entries = []
+    self.next = 0
+    self.hits = 0
+    self.draws = 0
+
+  def add(self, G_z, gy, itr):
+    G_z, gy = G_z.detach(), gy.detach()
+    self.device = G_z.device
+    if len(self.entries) < self.size:
+      self.entries.append([itr, None, None])
+    entry = self.entries[self.next]
+    # Reuse the slot's storage when the batch shape allows it
+    if entry[1] is None or entry[1].shape != G_z.shape or entry[2].shape != gy.shape:
+      entry[1:] = [torch.empty(item.shape, dtype=item.dtype,
+                               device='cpu' if self.offload else item.device,
+                               pin_memory=self.pin)
+                   for item in [G_z, gy]]
+    entry[0] = itr
+    entry[1].copy_(G_z, non_blocking=self.pin)
+    entry[2].copy_(gy, non_blocking=self.pin)
+    self.next = (self.next + 1) % self.size
+
+  # A stored (G_z, gy) pair on G's device, or None to generate fresh fakes
+  def draw(self, itr):
+    self.draws += 1
+    fresh = [entry for entry in self.entries if itr - entry[0] <= self.max_age]
+    if not fresh or np.random.rand() >= self.prob:
+      return None
+    self.hits += 1
+    _, G_z, gy = fresh[np.random.randint(len(fresh))]
+    return (G_z.to(self.device, non_blocking=self.pin),
+            gy.to(self.device, non_blocking=self.pin))
+
+  def hit_ratio(self):
+    return self.hits / float(max(self.draws, 1))
+
+
+# Parameters ortho reg applies to (at least 2 axes, not blacklisted), grouped
+# by flattened shape, dtype and device so that each group is one batched
+# matmul. Cached per model and blacklist, as the parameters don't change;
+# the cache holds models weakly, so it doesn't keep them alive.
+_ortho_groups = weakref.WeakKeyDictionary()
+def ortho_groups(model, blacklist=[]):
+  cache = _ortho_groups.setdefault(model, {})
+  key = tuple(id(item) for item in blacklist)
+  if key not in cache:
+    groups = {}
+    for param in model.parameters():
+      if len(param.shape) < 2 or any([param is item for item in blacklist]):
+        continue
+      groups.setdefault((param.shape[0], param[0].numel(), param.dtype, param.device),
+                        []).append(param)
+    cache[key] = list(groups.values())
+  return cache[key]
+
+
+# Add the gradient of an ortho reg to each group's grads: 2 (W W^T - I) W,
+# or with the diagonal of W W^T dropped altogether if off_diagonal. Either
+# is applied to W W^T's diagonal in place, so no identity masks are built.
+def batched_ortho(model, strength, blacklist=[], off_diagonal=True):
+  with torch.no_grad():
+    for params in ortho_groups(model, blacklist):
+      w = torch.stack([param.reshape(param.shape[0], -1) for param in params])
+      wwt = torch.bmm(w, w.transpose(1, 2))
+      if off_diagonal:
+        wwt.diagonal(dim1=1, dim2=2).zero_()
+      else:
+        wwt.diagonal(dim1=1, dim2=2).sub_(1)
+      grad = 2 * torch.bmm(wwt, w)
+      torch._foreach_add_([param.grad for param in params],
+                          [item.view(param.shape) for item, param in zip(grad.unbind(0), params)],
+                          alpha=strength)
 
 
 # Apply modified ortho reg to a model
 # This function is an optimized version that directly computes the gradient,
 # instead of computing and then differentiating the loss.
 def ortho(model, strength=1e-4, blacklist=[]):
-  with torch.no_grad():
-    for param in model.parameters():
-      # Only apply this to parameters with at least 2 axes, and not in the blacklist
-      if len(param.shape) < 2 or any([param is item for item in blacklist]):
-        continue
-      w = param.view(param.shape[0], -1)
-      grad = (2 * torch.mm(torch.mm(w, w.t())
-              * (1. - torch.eye(w.shape[0], device=w.device)), w))
-      param.grad.data += strength * grad.view(param.shape)
+  batched_ortho(model, strength, blacklist, off_diagonal=True)
 
 
 # Default ortho reg
 # This function is an optimized version that directly computes the gradient,
 # instead of computing and then differentiating the loss.
 def default_ortho(model, strength=1e-4, blacklist=[]):
-  with torch.no_grad():
-    for param in model.parameters():
-      # Only apply this to parameters with at least 2 axes & not in blacklist
-      if len(param.shape) < 2 or param in blacklist:
-        continue
-      w = param.view(param.shape[0], -1)
-      grad = (2 * torch.mm(torch.mm(w, w.t())
-               - torch.eye(w.shape[0], device=w.device), w))
-      param.grad.data += strength * grad.view(param.shape)
+  batched_ortho(model, strength, blacklist, off_diagonal=False)
+
+
+# Convert a net's 4D and 5D parameters to channels_last and channels_last_3d.
+# Convs then produce activations in the same layout, so only the real
+# inputs need converting too (video_channels_last). Reassigning .data keeps
+# the Parameter objects, and with them any optimizer already built on them.
+def to_channels_last(net):
+  for param in net.parameters():
+    if param.dim() == 4:
+      param.data = param.data.contiguous(memory_format=torch.channels_last)
+    elif param.dim() == 5:
+      param.data = param.data.contiguous(memory_format=torch.channels_last_3d)
+  return net
+
+
+# Store a [B,T,C,H,W] video with channels_last frames, i.e. in B,T,H,W,C
+# order: its [BT,C,H,W] view is then channels_last and its permuted
+# [B,C,T,H,W] view channels_last_3d, so neither D nor Dv needs a copy.
+def video_channels_last(x):
+  return x.reshape(-1, *x.shape[2:]).contiguous(
+    memory_format=torch.channels_last).view(*x.shape)
 
 
 # Convenience utility to switch off requires_grad
@@ -931,28 +1312,59 @@ def join_strings(base_string, strings):
 
 
 # Save a model's weights, optimizer, and the state_dict
+# Replace net.optim with a ZeroRedundancyOptimizer of the same class and
+# settings, for --zero_optim: each process keeps the state (Adam's moments,
+# Adam16's fp32 master weights too) of only its shard of the params, steps
+# that shard and broadcasts it to the other processes.
+def shard_optimizer(net):
+  from torch.distributed.optim import ZeroRedundancyOptimizer
+  net.optim = ZeroRedundancyOptimizer(net.parameters(), optimizer_class=type(net.optim),
+                                      **net.optim.defaults)
+
+
+# Save or load an optimizer's state, e.g. as G_optim.pth. A sharded optimizer
+# keeps only this process's shard, in its own file, e.g. G_optim_shard1.pth.
+def optim_file(optim, root, name, name_suffix=None):
+  if hasattr(optim, 'consolidate_state_dict'):
+    name = '%s_shard%d' % (name, get_rank())
+  return '%s/%s.pth' % (root, join_strings('_', [name, name_suffix]))
+
+def save_optim_state(optim, root, name, name_suffix=None):
+  local = optim.optim if hasattr(optim, 'consolidate_state_dict') else optim
+  torch.save(local.state_dict(), optim_file(optim, root, name, name_suffix))
+
+def load_optim_state(optim, root, name, name_suffix=None):
+  local = optim.optim if hasattr(optim, 'consolidate_state_dict') else optim
+  local.load_state_dict(torch.load(optim_file(optim, root, name, name_suffix)))
+
+
+# The optimizer states of G, D and Dv, on their own for the processes
+# that only save their shards
+def save_optim_states(G, D, Dv, weights_root, experiment_name, name_suffix=None):
+  root = '/'.join([weights_root, experiment_name])
+  os.makedirs(root, exist_ok=True)
+  save_optim_state(G.optim, root, 'G_optim', name_suffix)
+  save_optim_state(D.optim, root, 'D_optim', name_suffix)
+  if Dv is not None:
+    save_optim_state(Dv.optim, root, 'Dv_optim', name_suffix)
+
+
 def save_weights(G, D, Dv, state_dict, weights_root, experiment_name,
                  name_suffix=None, G_ema=None):
   root = '/'.join([weights_root, experiment_name])
-  if not os.path.exists(root):
-    os.mkdir(root)
+  os.makedirs(root, exist_ok=True)
   if name_suffix:
     print('Saving weights to %s/%s...' % (root, name_suffix))
   else:
     print('Saving weights to %s...' % root)
   torch.save(G.state_dict(),
               '%s/%s.pth' % (root, join_strings('_', ['G', name_suffix])))
-  torch.save(G.optim.state_dict(),
-              '%s/%s.pth' % (root, join_strings('_', ['G_optim', name_suffix])))
   torch.save(D.state_dict(),
               '%s/%s.pth' % (root, join_strings('_', ['D', name_suffix])))
-  torch.save(D.optim.state_dict(),
-              '%s/%s.pth' % (root, join_strings('_', ['D_optim', name_suffix])))
   if Dv is not None:
     torch.save(Dv.state_dict(),
                 '%s/%s.pth' % (root, join_strings('_', ['Dv', name_suffix])))
-    torch.save(Dv.optim.state_dict(),
-                '%s/%s.pth' % (root, join_strings('_', ['Dv_optim', name_suffix])))
+  save_optim_states(G, D, Dv, weights_root, experiment_name, name_suffix)
   torch.save(state_dict,
               '%s/%s.pth' % (root, join_strings('_', ['state_dict', name_suffix])))
   if G_ema is not None:
@@ -1016,22 +1428,19 @@ def load_weights(G, D, Dv, state_dict, weights_root, experiment_name,
       torch.load('%s/%s.pth' % (root, join_strings('_', ['G', name_suffix]))),
       strict=strict)
     if load_optim:
-      G.optim.load_state_dict(
-        torch.load('%s/%s.pth' % (root, join_strings('_', ['G_optim', name_suffix]))))
+      load_optim_state(G.optim, root, 'G_optim', name_suffix)
   if D is not None:
     D.load_state_dict(
       torch.load('%s/%s.pth' % (root, join_strings('_', ['D', name_suffix]))),
       strict=strict)
     if load_optim:
-      D.optim.load_state_dict(
-        torch.load('%s/%s.pth' % (root, join_strings('_', ['D_optim', name_suffix]))))
+      load_optim_state(D.optim, root, 'D_optim', name_suffix)
   if Dv is not None:
     Dv.load_state_dict(
       torch.load('%s/%s.pth' % (root, join_strings('_', ['Dv', name_suffix]))),
       strict = strict)
     if load_optim:
-      Dv.optim.load_state_dict(
-        torch.load('%s/%s.pth' % (root, join_strings('_', ['Dv_optim', name_suffix]))))
+      load_optim_state(Dv.optim, root, 'Dv_optim', name_suffix)
 
   # Load state dict
   for item in state_dict:
@@ -1176,6 +1585,24 @@ def sample(G, z_, y_, config):
     return G_z, y_
 
 
+# Generate num_chunks * G.time_steps frames per video, G.time_steps at a time,
+# carrying G's ConvGRU state from one chunk to the next. Frames [B,3,H,W] are
+# yielded as each chunk finishes, so memory is bounded by a single chunk
+# however long the video is.
+def stream_video(G, z, y, num_chunks, parallel=False):
+  hidden_state = None
+  with torch.no_grad():
+    gy = G.shared(y)
+    for _ in range(num_chunks):
+      if parallel:
+        G_z, hidden_state = nn.parallel.data_parallel(
+          G, (z, gy), module_kwargs={'hidden_state': hidden_state, 'return_hidden': True})
+      else:
+        G_z, hidden_state = G(z, gy, hidden_state=hidden_state, return_hidden=True)
+      for frame in G_z.unbind(1):
+        yield frame
+
+
 # Sample function for sample sheets
 def sample_sheet(G, classes_per_sheet, num_classes, samples_per_class, parallel,
                  samples_root, experiment_name, folder_number, z_=None):
@@ -1413,6 +1840,11 @@ def initiate_standing_stats(net):
 def accumulate_standing_stats(net, z, y, nclasses, num_accumulations=16):
   initiate_standing_stats(net)
   net.train()
+  # Only the BN stats should move; keeping the SN layers in eval mode leaves
+  # their u vectors alone and lets them reuse their cached weights.
+  for module in net.modules():
+    if isinstance(module, layers.SN):
+      module.eval()
   for i in range(num_accumulations):
     with torch.no_grad():
       z.normal_()
@@ -1446,6 +1878,10 @@ class Adam16(Optimizer):
         self.state[p]['exp_avg_sq'] = self.state[p]['exp_avg_sq'].float()
         self.state[p]['fp32_p'] = self.state[p]['fp32_p'].float()
 
+  # All parameters of a group are updated together through torch._foreach_*
+  # ops: a few multi-tensor kernels per group instead of ~8 ops per
+  # parameter, with the fp16 weights written back in place.
+  @torch.no_grad()
   def step(self, closure=None):
     """Performs a single optimization step.
     Arguments:
@@ -1454,46 +1890,142 @@ class Adam16(Optimizer):
     """
     loss = None
     if closure is not None:
-      loss = closure()
+      with torch.enable_grad():
+        loss = closure()
 
     for group in self.param_groups:
-      for p in group['params']:
-        if p.grad is None:
-          continue
-
-        grad = p.grad.data.float()
+      params = [p for p in group['params'] if p.grad is not None]
+      if not params:
+        continue
+      beta1, beta2 = group['betas']
+      fp32_ps, exp_avgs, exp_avg_sqs, step_sizes = [], [], [], []
+      for p in params:
         state = self.state[p]
-
         # State initialization
         if len(state) == 0:
           state['step'] = 0
-          # Exponential moving average of gradient values
-          state['exp_avg'] = grad.new().resize_as_(grad).zero_()
-          # Exponential moving average of squared gradient values
-          state['exp_avg_sq'] = grad.new().resize_as_(grad).zero_()
+          # Exponential moving averages of gradient values and their squares
+          state['exp_avg'] = torch.zeros_like(p, dtype=torch.float)
+          state['exp_avg_sq'] = torch.zeros_like(p, dtype=torch.float)
           # Fp32 copy of the weights
           state['fp32_p'] = p.data.float()
+        state['step'] += 1
+        fp32_ps.append(state['fp32_p'])
+        exp_avgs.append(state['exp_avg'])
+        exp_avg_sqs.append(state['exp_avg_sq'])
+        # Steps can differ between parameters, e.g. after some had no grad
+        bias_correction1 = 1 - beta1 ** state['step']
+        bias_correction2 = 1 - beta2 ** state['step']
+        step_sizes.append(-group['lr'] * math.sqrt(bias_correction2) / bias_correction1)
 
-        exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-        beta1, beta2 = group['betas']
+      grads = [p.grad.float() for p in params]
+      if group['weight_decay'] != 0:
+        grads = torch._foreach_add(grads, fp32_ps, alpha=group['weight_decay'])
 
-        state['step'] += 1
+      # Decay the first and second moment running average coefficient
+      torch._foreach_mul_(exp_avgs, beta1)
+      torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+      torch._foreach_mul_(exp_avg_sqs, beta2)
+      torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
 
-        if group['weight_decay'] != 0:
-          grad = grad.add(group['weight_decay'], state['fp32_p'])
+      denoms = torch._foreach_sqrt(exp_avg_sqs)
+      torch._foreach_add_(denoms, group['eps'])
+      torch._foreach_addcdiv_(fp32_ps, exp_avgs, denoms, step_sizes)
+      # Copy back into the params in place, in their own dtype
+      layers.foreach_copy_(params, fp32_ps)
 
-        # Decay the first and second moment running average coefficient
-        exp_avg.mul_(beta1).add_(1 - beta1, grad)
-        exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
+    return loss
+
+
+# Blockwise 8-bit quantization: x is split into blocks of block_size values,
+# each stored as codes times its own absmax scale, as int8 codes in [-127,
+# 127] if signed, else as uint8 codes in [0, 255] rounded up, so that a
+# nonnegative x is never underestimated.
+def quantize_blockwise(x, block_size=2048, signed=True):
+  flat = x.float().flatten()
+  flat = F.pad(flat, (0, -flat.numel() % block_size)).view(-1, block_size)
+  scale = flat.abs().amax(1, keepdim=True).clamp(min=1e-12)
+  if signed:
+    return (flat * (127 / scale)).round_().to(torch.int8), scale
+  return (flat * (255 / scale)).ceil_().clamp_(max=255).to(torch.uint8), scale
+
+# The fp32 tensor like `like` that quantize_blockwise's codes and scale hold
+def dequantize_blockwise(codes, scale, like):
+  levels = 127 if codes.dtype == torch.int8 else 255
+  flat = (codes.float() * (scale / levels)).flatten()
+  return flat[:like.numel()].view(like.shape)
+
+
+# Adam with 8-bit moments. Every param with at least min_8bit_size values
+# keeps exp_avg as blockwise int8 codes and the square root of exp_avg_sq as
+# blockwise uint8 codes (the root spreads its range more evenly over the
+# codes), each with fp32 per-block scales: about a quarter of Adam's state.
+# The moments are dequantized to fp32 for each update and requantized after
+# it. Smaller params keep fp32 moments. All of the state is tensors in
+# self.state, so it checkpoints through state_dict() like Adam's.
+class Adam8bit(Optimizer):
+  def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0,
+               block_size=2048, min_8bit_size=4096):
+    defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay,
+                    block_size=block_size, min_8bit_size=min_8bit_size)
+    super(Adam8bit, self).__init__(params, defaults)
+
+  # Loading casts float state to the params' dtype; keep the scales in fp32
+  def load_state_dict(self, state_dict):
+    super(Adam8bit, self).load_state_dict(state_dict)
+    for state in self.state.values():
+      for key, item in state.items():
+        if torch.is_tensor(item) and item.is_floating_point():
+          state[key] = item.float()
 
-        denom = exp_avg_sq.sqrt().add_(group['eps'])
+  @torch.no_grad()
+  def step(self, closure=None):
+    loss = None
+    if closure is not None:
+      with torch.enable_grad():
+        loss = closure()
 
+    for group in self.param_groups:
+      beta1, beta2 = group['betas']
+      block_size = group['block_size']
+      for p in group['params']:
+        if p.grad is None:
+          continue
+        state = self.state[p]
+        quantized = p.numel() >= group['min_8bit_size']
+        # State initialization
+        if len(state) == 0:
+          state['step'] = 0
+          zeros = torch.zeros_like(p, dtype=torch.float)
+          if quantized:
+            state['exp_avg'], state['exp_avg_scale'] = quantize_blockwise(zeros, block_size)
+            state['exp_avg_sq'], state['exp_avg_sq_scale'] = quantize_blockwise(zeros, block_size,
+                                                                                signed=False)
+          else:
+            state['exp_avg'], state['exp_avg_sq'] = zeros, zeros.clone()
+        state['step'] += 1
+        if quantized:
+          exp_avg = dequantize_blockwise(state['exp_avg'], state['exp_avg_scale'], p)
+          exp_avg_sq = dequantize_blockwise(state['exp_avg_sq'], state['exp_avg_sq_scale'], p) ** 2
+        else:
+          exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+
+        grad = p.grad.float()
+        if group['weight_decay'] != 0:
+          grad = grad.add(p.float(), alpha=group['weight_decay'])
+        # Decay the first and second moment running average coefficient
+        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        root = exp_avg_sq.sqrt()
         bias_correction1 = 1 - beta1 ** state['step']
         bias_correction2 = 1 - beta2 ** state['step']
         step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+        p.add_((exp_avg / (root + group['eps'])).to(p.dtype), alpha=-step_size)
 
-        state['fp32_p'].addcdiv_(-step_size, exp_avg, denom)
-        p.data = state['fp32_p'].half()
+        if quantized:
+          state['exp_avg'], state['exp_avg_scale'] = quantize_blockwise(exp_avg, block_size)
+          state['exp_avg_sq'], state['exp_avg_sq_scale'] = quantize_blockwise(root, block_size,
+                                                                              signed=False)
 
     return loss
 